@@ -8,8 +8,8 @@ from PyQt5.QtWidgets import (
     QDialog, QProgressBar, QGridLayout,
     QListWidget, QToolBar, QAction
 )
-from PyQt5.QtGui import QPixmap, QImage
-from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QPixmap, QImage, QImageReader
+from PyQt5.QtCore import Qt, QBuffer, QByteArray, QIODevice
 
 
 class ImageProcessor:
@@ -30,6 +30,9 @@ class ImageProcessor:
                 image,
                 factor,
                 algorithm=Qt.SmoothTransformation) -> QImage
+            - load_image_data(data) -> QImage
+            - fit_image(image, max_edge) -> QImage
+            - encode_image(image, image_format, quality) -> bytes
     """
     @staticmethod
     def load_image(file_path):
@@ -107,6 +110,80 @@ class ImageProcessor:
             algorithm
         )
 
+    @staticmethod
+    def load_image_data(data):
+        """
+        Load an image from encoded bytes (e.g. a file read into memory).
+
+        Parameters:
+        ------------
+            data : bytes
+                The encoded image (JPEG, PNG, ...).
+
+        Returns:
+        ------------
+            QImage object
+                The loaded image, turned upright according to its EXIF
+                orientation; a null image if the data cannot be read.
+        """
+        buffer = QBuffer()
+        buffer.setData(QByteArray(data))
+        buffer.open(QIODevice.ReadOnly)
+        reader = QImageReader(buffer)
+        # Die Ausrichtung geht beim Neukodieren verloren, daher anwenden
+        reader.setAutoTransform(True)
+        return reader.read()
+
+    @staticmethod
+    def fit_image(image, max_edge, algorithm=Qt.SmoothTransformation):
+        """
+        Scale an image down so that its longer edge is at most max_edge.
+
+        Parameters:
+        ------------
+            image : QImage
+                The image to scale.
+
+            max_edge : int
+                The maximum width and height in pixels.
+
+        Returns:
+        ------------
+            QImage object
+                The scaled image, or the image itself if it already fits.
+        """
+        if max(image.width(), image.height()) <= max_edge:
+            return image
+        return image.scaled(max_edge, max_edge, Qt.KeepAspectRatio, algorithm)
+
+    @staticmethod
+    def encode_image(image, image_format='JPEG', quality=85):
+        """
+        Encode an image in memory.
+
+        Parameters:
+        ------------
+            image : QImage
+                The image to encode.
+
+            image_format : str
+                The format to encode to, e.g. 'JPEG' or 'PNG'.
+
+            quality : int
+                The quality of the image (for JPEGs).
+
+        Returns:
+        ------------
+            bytes
+                The encoded image.
+        """
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        if not image.save(buffer, image_format, quality):
+            raise ValueError(f"Could not encode image as {image_format}")
+        return bytes(data)
+
 
 class ImageData:
     """
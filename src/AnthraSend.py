@@ -26,6 +26,7 @@ Description:
 
     The script uses the win32com.client package to interact with Microsoft
     Outlook and send mails using the default Outlook profile and settings.
+    Alternatively an SMTP server can be used, see mail_transport.py.
     It uses pandas to read the Excel file and generate the required mail
     content based on the data found in the Excel file.
 
@@ -39,10 +40,21 @@ Description:
 """
 
 import sys
-import time
-import win32com.client
 import pandas as pd
 
+from bcc_fanout import fanout_limit
+from mail_transport import create_transport
+from recipient_prep import (
+    drop_suppressed, normalize_addresses, prepare_recipients,
+    render_by_content, render_in_order, write_rejection_report
+)
+from retry_scheduler import DeadLetterQueue
+from send_dispatcher import create_dispatcher
+from send_journal import campaign_id, create_send_journal
+from send_metrics import create_send_metrics
+from suppression_list import create_suppression_list
+from template_catalog import ANTHRASEND_CATALOG, TemplateCatalog
+
 from PyQt5.QtWidgets import QApplication, QMessageBox, QProgressBar
 
 
@@ -50,109 +62,20 @@ def read_email_data(excel_file):
     return pd.read_excel(excel_file)
 
 
-def generate_emails(df):
-    emails = []
-
-    for index, row in df.iterrows():
-        to_email = row['Benutzername']
-        anrede = row['Anrede']
-        _ = row['Nachname']  # currently not used
-        vorname = row['Vorname']
-        sprache = row['Sprache'].upper()
-
-        if anrede == 'MR':
-            anrede_text_de = "Lieber"
-            anrede_text_en = "Dear"
-            anrede_text_fr = "Cher"
-            anrede_text_nl = "Beste"
-        elif anrede == 'MS':
-            anrede_text_de = "Liebe"
-            anrede_text_en = "Dear"
-            anrede_text_fr = "Chère"
-            anrede_text_nl = "Beste"
-        elif anrede == 'MX':
-            anrede_text_de = "Liebe(r)"
-            anrede_text_en = "Dear"
-            anrede_text_fr = "Cher(e)"
-            anrede_text_nl = "Beste"
-        else:
-            anrede_text_de = "Liebe(r)"
-            anrede_text_en = "Dear"
-            anrede_text_fr = "Cher(e)"
-            anrede_text_nl = "Beste"
-
-        subject = ""
-        body = ""
-
-        if sprache == 'DE':
-            subject = \
-                "Dringend: Aufschub der geplanten Änderung der URL für d.vinci"
-            body = (
-                f"{anrede_text_de} {vorname},\n\n"
-                "ich möchte euch darüber informieren, dass die geplante Änderung der URL von [job.takko.com] zu [application.takko.com], "
-                "die für den 08.03.2024 angesetzt war, vorerst aufgeschoben wird. Es wird keine Änderung geben, "
-                "bis weitere Informationen bereitgestellt werden.\n\n"
-                "Bitte verwendet weiterhin die aktuelle URL >>> job.takko.com <<< für den Zugriff auf d.vinci. Ich entschuldige mich für die Unannehmlichkeiten und "
-                "danke euch für euer Verständnis und eure Flexibilität.\n\n"
-                "Für Rückfragen stehe ich euch gerne zur Verfügung.\n\n"
-                "Mit freundlichen Grüßen,\nHendrik Siemens"
-            )
-        elif sprache == 'EN':
-            subject = \
-                "Urgent: Postponement of the Planned URL Change for d.vinci"
-            body = (
-                f"{anrede_text_en} {vorname},\n\n"
-                "I wish to inform you that the planned change of the URL from [job.takko.com] to [application.takko.com], which was "
-                "scheduled for 08.03.2024, has been postponed until further notice. There will be no changes made until more information is provided.\n\n"
-                "Please continue to use the current URL >>> job.takko.com <<< to access d.vinci. I apologize for any inconvenience and "
-                "thank you for your understanding and flexibility.\n\n"
-                "Should you have any questions, please do not hesitate to contact me.\n\n"
-                "Kind regards,\nHendrik Siemens"
-            )
-        elif sprache == 'FR':
-            if "Responsable de magasin" in vorname:
-                subject = "Urgent : Report de la modification prévue de l'URL pour d.vinci"
-                body = (
-                    "Bonjour à tous,\n\n"
-                    "Je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour le 08.03.2024, "
-                    "est reportée jusqu'à nouvel ordre. Aucun changement ne sera effectué jusqu'à la communication de nouvelles informations.\n\n"
-                    "Veuillez donc continuer à utiliser l'URL actuelle >>> job.takko.com <<< pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
-                    "vous remercie de votre compréhension et de votre flexibilité.\n\n"
-                    "En cas de questions, n'hésitez pas à me contacter.\n\n"
-                    "Cordialement,\nHendrik Siemens"
-                )
-            else:
-                subject = "Urgent : Report de la modification prévue de l'URL pour d.vinci"
-                body = (
-                    f"{anrede_text_fr} {vorname},\n\n"
-                    "je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour le 08.03.2024, est "
-                    "reportée jusqu'à nouvel ordre. Aucun changement ne sera effectué jusqu'à la communication de nouvelles informations.\n\n"
-                    "Veuillez donc continuer à utiliser l'URL actuelle >>> job.takko.com <<< pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
-                    "vous remercie de votre compréhension et de votre flexibilité.\n\n"
-                    "En cas de questions, n'hésitez pas à me contacter.\n\n"
-                    "Cordialement,\nHendrik Siemens"
-                )
-
-        elif sprache == 'NL':
-            subject = \
-                "Dringend: Uitstel van de geplande URL-wijziging voor d.vinci"
-            body = (
-                f"{anrede_text_nl} {vorname},\n\n"
-                "Ik wil jullie informeren dat de geplande wijziging van de URL van [job.takko.com] naar [application.takko.com], die gepland stond voor 08.03.2024, "
-                "voorlopig is uitgesteld. Er worden geen wijzigingen aangebracht tot nadere informatie beschikbaar is.\n\n"
-                "Gelieve de huidige URL >>> job.takko.com <<< te blijven gebruiken om toegang te krijgen tot d.vinci. Mijn excuses voor eventuele overlast en "
-                "dank voor uw begrip en flexibilitet.\n\n"
-                "Als u vragen heeft, neem dan gerust contact met mij op.\n\n"
-                "Met vriendelijke groet,\nHendrik Siemens"
-            )
-
-        email = {
-            'to_email': to_email,
-            'subject': subject,
-            'body': body
-        }
-
-        emails.append(email)
+def generate_emails(df, suppression=None, suppressed=None, invalid=None):
+    # Ungültige, doppelte und gesperrte Adressen fallen vor dem Rendern
+    # heraus; Sprache und Anrede werden spaltenweise normalisiert und
+    # geprüft, die Vorlage wird nur einmal je Empfängergruppe aufgelöst
+    catalog = TemplateCatalog(ANTHRASEND_CATALOG)
+    df = normalize_addresses(df, invalid)
+    df = drop_suppressed(df, suppression, suppressed)
+    prepared = prepare_recipients(df, catalog)
+    # Für den BCC-Versand (bcc_fanout.py) gleiche Inhalte hintereinander
+    render = render_by_content if fanout_limit() else render_in_order
+    return [
+        {'to_email': to_email, 'subject': subject, 'body': body}
+        for to_email, subject, body in render(prepared, catalog)
+    ]
 
 
 def print_email_addresses(emails):
@@ -178,34 +101,48 @@ def prompt_user_confirmation(count):
     msgBox.exec_()
 
 
-def send_emails(emails, outlook):
+def send_emails(emails, transport, journal, metrics=None, dead_letters=None,
+                total=None):
+    if total is None:
+        total = len(emails) - journal.count_skipped(
+            email['to_email'] for email in emails)
     progress_bar = QProgressBar()
-    progress_bar.setMaximum(len(emails))
+    # Vom Journal übersprungene Empfänger kommen nicht in der Schleife an
+    progress_bar.setMaximum(max(total, 1))
+    progress_bar.setMinimumWidth(520)
     progress_bar.show()
 
     success_count = 0
     error_count = []
-    mail_send_delay = 5
-
-    for i, email in enumerate(emails):
-        try:
-            mail = outlook.CreateItem(0)
-            mail.To = email['to_email']
-            mail.Subject = email['subject']
-            mail.Body = email['body']
-
-            mail.Send()
-
-            print(f"E-Mail an {email['to_email']} gesendet")
-            time.sleep(mail_send_delay)
-
-            progress_bar.setValue(i + 1)
+    failures = []
+
+    # Versandrate wird vom Dispatcher (Token-Bucket) bestimmt,
+    # nicht mehr durch eine feste Pause nach jeder Mail
+    dispatcher = create_dispatcher(transport, metrics, dead_letters)
+    pending = journal.track(emails, key=lambda email: email['to_email'])
+    results = dispatcher.dispatch(
+        pending, as_job=lambda email: (
+            email['to_email'], email['subject'], email['body']))
+
+    for i, (email, e) in enumerate(results):
+        to_email = email['to_email']
+        journal.record(to_email, e)
+        if e is None:
+            print(f"E-Mail an {to_email} gesendet")
             success_count += 1
-        except Exception as e:
+        else:
             # Don't interrupt script execution, just log and continue
-            display_error_message(email['to_email'], e)
-            print(error_message(email['to_email'], e))
-            error_count.append(email['to_email'])
+            print(error_message(to_email, e))
+            error_count.append(to_email)
+            failures.append((to_email, e))
+        progress_bar.setValue(i + 1)
+        if metrics is not None:
+            # Durchsatz und Restzeit im Fortschrittsbalken
+            progress_bar.setFormat(metrics.progress_text())
+        QApplication.processEvents()
+    # Ein Dialog für alle Fehler, der Versand wartet nicht auf Klicks
+    if failures:
+        display_error_summary(failures)
     return success_count, error_count
 
 
@@ -213,10 +150,13 @@ def error_message(to_email, e):
     return f"Fehler beim Versand an {to_email}: {e}"
 
 
-def display_error_message(to_email, e):
+def display_error_summary(failures):
     msgBox = QMessageBox()
     msgBox.setIcon(QMessageBox.Warning)
-    msgBox.setText(error_message(to_email, e))
+    msgBox.setText(
+        f"{len(failures)} E-Mails konnten nicht versendet werden.")
+    msgBox.setDetailedText("\n".join(
+        error_message(to_email, e) for to_email, e in failures))
     msgBox.setWindowTitle("Fehler")
     msgBox.exec_()
 
@@ -239,14 +179,55 @@ def display_success_message(success_count, total_count, error_count):
 
 
 def main():
-    outlook = win32com.client.Dispatch("Outlook.Application")
-    df = read_email_data('Mappe2.xlsx')
-    emails = generate_emails(df)
+    excel_file = 'Mappe2.xlsx'
+    transport = create_transport()
+    df = read_email_data(excel_file)
+    suppressed = []
+    invalid = []
+    suppression = create_suppression_list()
+    try:
+        emails = generate_emails(df, suppression, suppressed, invalid)
+    finally:
+        if suppression is not None:
+            suppression.close()
+    if suppressed:
+        print(f"{len(suppressed)} gesperrte Adressen übersprungen.")
+    if invalid:
+        write_rejection_report('rejected_recipients.csv', invalid)
+        print(f"{len(invalid)} ungültige oder doppelte Adressen, "
+              f"siehe rejected_recipients.csv")
 
     print_email_addresses(emails)
     prompt_user_confirmation(len(emails))
 
-    success_count, error_count = send_emails(emails, outlook)
+    # Versandjournal: ein erneuter Start überspringt bereits versendete Mails
+    journal = create_send_journal(
+        'send_journal.sqlite',
+        campaign_id(excel_file,
+                    TemplateCatalog(ANTHRASEND_CATALOG).fingerprint))
+    total = len(emails) - journal.count_skipped(
+        email['to_email'] for email in emails)
+    metrics = create_send_metrics(journal.campaign, total)
+    # Vorübergehende Fehler wiederholt der Dispatcher, endgültige landen hier
+    dead_letters = DeadLetterQueue()
+    try:
+        success_count, error_count = send_emails(
+            emails, transport, journal, metrics, dead_letters, total)
+    finally:
+        journal.close()
+        transport.close()
+        metrics.close()
+    if journal.skipped_sent:
+        print(f"{journal.skipped_sent} bereits versendet, übersprungen.")
+    if journal.skipped_in_doubt:
+        print(f"Unklarer Status, nicht erneut gesendet: "
+              f"{journal.skipped_in_doubt}")
+    if dead_letters:
+        dead_letters.write_csv('dead_letters.csv')
+        print(f"{len(dead_letters)} endgültig fehlgeschlagen, "
+              f"siehe dead_letters.csv")
+    print(f"Durchsatz: {transport.stats}")
+    print(metrics.summary())
     sys.exit(display_success_message(success_count, len(emails), error_count))
 
 
@@ -1,23 +1,33 @@
 import os
 import sys
+import time
 import sqlite3
-import win32com.client
+from collections import OrderedDict
+from image_optimizer import create_image_optimizer
+from mail_attachments import load_attachments
+from mail_transport import create_transport
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QWidget,
     QHBoxLayout, QPushButton, QLineEdit,
-    QTextEdit, QLabel, QTableWidget,
+    QTextEdit, QLabel, QTableView, QHeaderView,
     QAction, QSizePolicy, QCheckBox,
-    QVBoxLayout, QGroupBox
+    QVBoxLayout, QGroupBox, QFileDialog
 )
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex
 
 
 class Email:
-    def __init__(self, sender, recipient, content):
-        self.id = os.urandom(16).hex()
+    def __init__(self, sender, recipient, content, subject="",
+                 status="draft", timestamp=None, email_id=None,
+                 attachments=()):
+        self.id = email_id or os.urandom(16).hex()
         self.sender = sender
         self.recipient = recipient
         self.content = content
+        self.subject = subject
+        self.status = status
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.attachments = tuple(attachments)
         
         # Erstellen einer E-Mail mit den Daten aus dem Konstruktor
         self.create_email()
@@ -27,15 +37,37 @@ class Email:
 
 
 class EmailClient:
-    def __init__(self):
+    def __init__(self, database=None, transport=None):
         self.emails = []
-
-    def send_email(self):
-        sender = self.sender_group_box.lineEdit().text()
-        recipient = self.recipient_group_box.lineEdit().text()
-        content = self.email_text_edit.toPlainText()
-
-        mail_to_send = Email(sender, recipient, content)
+        self.database = database
+        # Einmal kodiert, von allen Mails gemeinsam genutzt
+        self.attachments = ()
+        self.image_optimizer = create_image_optimizer()
+        # Outlook oder SMTP (mail_transport.py), erst beim ersten Versand
+        self.transport = transport
+
+    def send_email(self, sender, recipient, content, subject=""):
+        """
+        Send ``content`` to ``recipient`` through the configured
+        transport, with the chosen attachments as shared parts, and store
+        the sent mail. The attachments are used for this mail only.
+        """
+        mail_to_send = Email(sender, recipient, content, subject=subject,
+                             attachments=self.attachments)
+        if self.transport is None:
+            self.transport = create_transport()
+        self.transport.attachments = mail_to_send.attachments
+        self.transport.send(recipient, subject, content)
+        mail_to_send.status = "sent"
+        self.emails.append(mail_to_send)
+        self.attachments = ()
+        if self.database is not None:
+            self.database.save_email(mail_to_send)
+        return mail_to_send
+
+    def add_attachments(self, paths):
+        self.attachments += load_attachments(paths, self.image_optimizer)
+        return self.attachments
 
     def receive_emails(self):
         # Code zum Empfangen von E-Mails
@@ -44,6 +76,15 @@ class EmailClient:
     def save_email(self, email):
         ...
 
+    def search(self, text, limit=200, **filters):
+        """
+        Full-text search over subject, body and recipient of the stored
+        mails, best matches first. Returns (email, snippet) pairs.
+        """
+        if self.database is None or not text.strip():
+            return []
+        return self.database.search(text, limit=limit, **filters)
+
     def copy_text(self):
         ...
 
@@ -52,16 +93,337 @@ class EmailClient:
 
 
 class EmailDatabase:
+    """
+    SQLite storage for sent and received e-mails.
+
+    The database runs in WAL mode over one long-lived connection, so the
+    prepared statements of the constant queries below are compiled once
+    and reused from the connection's statement cache. Lists are paged
+    with keyset cursors ``(timestamp, row_id)`` instead of OFFSET, which
+    keeps every page equally fast no matter how deep one scrolls.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS emails (
+            row_id INTEGER PRIMARY KEY,
+            email_id TEXT NOT NULL UNIQUE,
+            sender TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            subject TEXT NOT NULL DEFAULT '',
+            body TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL,
+            timestamp REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_emails_recipient
+            ON emails (recipient, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_emails_sender
+            ON emails (sender, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_emails_status
+            ON emails (status, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_emails_timestamp
+            ON emails (timestamp, row_id);
+    """
+
+    # Volltextindex über Betreff, Text und Empfänger. Die Trigger halten
+    # ihn bei jedem Speichern inkrementell aktuell.
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE emails_fts USING fts5 (
+            subject, body, recipient,
+            content='emails', content_rowid='row_id'
+        );
+        CREATE TRIGGER emails_fts_insert AFTER INSERT ON emails BEGIN
+            INSERT INTO emails_fts (rowid, subject, body, recipient)
+            VALUES (new.row_id, new.subject, new.body, new.recipient);
+        END;
+        CREATE TRIGGER emails_fts_delete AFTER DELETE ON emails BEGIN
+            INSERT INTO emails_fts (emails_fts, rowid, subject, body, recipient)
+            VALUES ('delete', old.row_id, old.subject, old.body, old.recipient);
+        END;
+        CREATE TRIGGER emails_fts_update AFTER UPDATE ON emails BEGIN
+            INSERT INTO emails_fts (emails_fts, rowid, subject, body, recipient)
+            VALUES ('delete', old.row_id, old.subject, old.body, old.recipient);
+            INSERT INTO emails_fts (rowid, subject, body, recipient)
+            VALUES (new.row_id, new.subject, new.body, new.recipient);
+        END;
+        INSERT INTO emails_fts (emails_fts) VALUES ('rebuild');
+    """
+
+    # Upsert statt INSERT OR REPLACE, damit die FTS-Trigger greifen
+    INSERT = (
+        "INSERT INTO emails "
+        "(email_id, sender, recipient, subject, body, status, timestamp) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (email_id) DO UPDATE SET "
+        "sender = excluded.sender, recipient = excluded.recipient, "
+        "subject = excluded.subject, body = excluded.body, "
+        "status = excluded.status, timestamp = excluded.timestamp"
+    )
+
+    COLUMNS = "row_id, email_id, sender, recipient, subject, body, status, timestamp"
+
+    # Spalten, nach denen gefiltert werden darf (alle indiziert)
+    FILTERS = ("recipient", "sender", "status")
+
+    # Sortierbare Spalten und ihre Position in COLUMNS
+    ORDER_COLUMNS = {
+        "row_id": 0, "sender": 2, "recipient": 3, "status": 6, "timestamp": 7,
+    }
+
     def __init__(self, db_path):
         self.db_path = db_path
+        self.connection = sqlite3.connect(db_path, cached_statements=256)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(self.SCHEMA)
+        has_fts = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'emails_fts'").fetchone()
+        if not has_fts:
+            # Bestehende Datenbanken werden beim ersten Öffnen indiziert
+            self.connection.executescript(self.FTS_SCHEMA)
+
+    @staticmethod
+    def _row(email):
+        return (email.id, email.sender, email.recipient, email.subject,
+                email.content, email.status, email.timestamp)
 
     def save_email(self, email):
-        # Code zum Speichern der E-Mail in der SQLite-Datenbank
-        ...
+        self.save_emails([email])
+
+    def save_emails(self, emails):
+        # Eine Transaktion für alle Mails statt eines Commits pro Mail
+        with self.connection:
+            self.connection.executemany(
+                self.INSERT, (self._row(email) for email in emails))
+
+    @staticmethod
+    def _email(row):
+        _, email_id, sender, recipient, subject, body, status, timestamp = row
+        return Email(sender, recipient, body, subject=subject, status=status,
+                     timestamp=timestamp, email_id=email_id)
+
+    @staticmethod
+    def _sort_key(order_by):
+        # Entspricht den Indizes (Spalte, timestamp) + implizite row_id
+        if order_by == "timestamp":
+            return ("timestamp", "row_id")
+        return (order_by, "timestamp", "row_id")
+
+    def _where(self, filters, cursor, descending, order_by="timestamp"):
+        clauses = []
+        parameters = []
+        for column, value in filters.items():
+            if column not in self.FILTERS:
+                raise ValueError(f"Cannot filter by {column}")
+            clauses.append(f"{column} = ?")
+            parameters.append(value)
+        if cursor is not None:
+            key = ", ".join(self._sort_key(order_by))
+            placeholders = ", ".join("?" * len(cursor))
+            operator = "<" if descending else ">"
+            clauses.append(f"({key}) {operator} ({placeholders})")
+            parameters.extend(cursor)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, parameters
+
+    def load_emails(self, limit=100, cursor=None, descending=True,
+                    order_by="timestamp", **filters):
+        """
+        Load one page of e-mails ordered by ``order_by`` (timestamp,
+        recipient, sender or status), then timestamp and row id.
 
-    def load_emails(self):
-        # Code zum Laden von E-Mails aus der SQLite-Datenbank
-        ...
+        Returns ``(emails, next_cursor)``. Pass ``next_cursor`` back in to
+        get the following page; it is None on the last page. Keyword
+        filters (recipient, sender, status) use the matching index.
+        """
+        if order_by not in self.ORDER_COLUMNS or order_by == "row_id":
+            raise ValueError(f"Cannot order by {order_by}")
+        where, parameters = self._where(filters, cursor, descending, order_by)
+        direction = "DESC" if descending else "ASC"
+        sort_key = self._sort_key(order_by)
+        order = ", ".join(f"{column} {direction}" for column in sort_key)
+        rows = self.connection.execute(
+            f"SELECT {self.COLUMNS} FROM emails {where} "
+            f"ORDER BY {order} LIMIT ?",
+            (*parameters, limit)).fetchall()
+        next_cursor = None
+        if len(rows) == limit:
+            last = rows[-1]
+            next_cursor = tuple(
+                last[self.ORDER_COLUMNS[column]] for column in sort_key)
+        return [self._email(row) for row in rows], next_cursor
+
+    @staticmethod
+    def fts_query(text):
+        """
+        Turn free text from the search box into an FTS5 query: every word
+        is quoted as a phrase (so e.g. 'application.takko.com' works) and
+        all words must match.
+        """
+        words = text.split()
+        return " ".join('"' + word.replace('"', '""') + '"' for word in words)
+
+    def search(self, text, limit=200, raw=False, **filters):
+        """
+        Ranked full-text search (BM25). Returns ``(email, snippet)`` pairs;
+        matches in the snippet are wrapped in [ ]. With ``raw`` the text
+        is passed to FTS5 unchanged (AND/OR/NEAR, column filters...).
+        """
+        query = text if raw else self.fts_query(text)
+        clauses = ["emails_fts MATCH ?"]
+        parameters = [query]
+        for column, value in filters.items():
+            if column not in self.FILTERS:
+                raise ValueError(f"Cannot filter by {column}")
+            clauses.append(f"e.{column} = ?")
+            parameters.append(value)
+        columns = ", ".join(f"e.{column}" for column in self.COLUMNS.split(", "))
+        rows = self.connection.execute(
+            f"SELECT {columns}, "
+            "snippet(emails_fts, -1, '[', ']', '…', 12) "
+            "FROM emails_fts JOIN emails AS e ON e.row_id = emails_fts.rowid "
+            f"WHERE {' AND '.join(clauses)} "
+            "ORDER BY bm25(emails_fts, 3.0, 1.0, 2.0) LIMIT ?",
+            (*parameters, limit)).fetchall()
+        return [(self._email(row[:-1]), row[-1]) for row in rows]
+
+    def count_emails(self, **filters):
+        where, parameters = self._where(filters, None, True)
+        return self.connection.execute(
+            f"SELECT COUNT(*) FROM emails {where}", parameters).fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+class EmailTableModel(QAbstractTableModel):
+    """
+    Lazily loaded table model over EmailDatabase.
+
+    Rows are fetched page by page through canFetchMore/fetchMore while
+    the view scrolls. Only the keyset cursor at the start of every page
+    is kept permanently; the pages themselves live in a small LRU cache
+    and are re-read from the database when they are needed again, so
+    memory stays constant however many mails are stored. Sorting and
+    filtering are done by the database.
+    """
+
+    HEADERS = (
+        ("recipient", "Empfänger"),
+        ("sender", "Absender"),
+        ("subject", "Betreff"),
+        ("status", "Status"),
+        ("timestamp", "Zeit"),
+        ("snippet", "Treffer"),
+    )
+
+    def __init__(self, database, page_size=200, cached_pages=16, parent=None):
+        super().__init__(parent)
+        self.database = database
+        self.page_size = page_size
+        self.cached_pages = cached_pages
+        self.order_by = "timestamp"
+        self.descending = True
+        self.filters = {}
+        self.search_text = ""
+        self._clear()
+
+    def _clear(self):
+        self._page_starts = [None]
+        self._pages = OrderedDict()
+        self._row_count = 0
+        self._exhausted = False
+
+    def reload(self):
+        self.beginResetModel()
+        self._clear()
+        self.endResetModel()
+
+    def set_filters(self, **filters):
+        self.filters = filters
+        self.reload()
+
+    def set_search(self, text):
+        self.search_text = text.strip()
+        self.reload()
+
+    def _query_page(self, page):
+        if self.search_text:
+            # Suchergebnisse sind nach Relevanz sortiert und begrenzt
+            results = self.database.search(
+                self.search_text, limit=self.page_size, **self.filters)
+            return results, None
+        emails, next_cursor = self.database.load_emails(
+            self.page_size, self._page_starts[page], self.descending,
+            self.order_by, **self.filters)
+        return [(email, "") for email in emails], next_cursor
+
+    def _page(self, page):
+        rows = self._pages.get(page)
+        if rows is None:
+            rows, _ = self._query_page(page)
+            self._pages[page] = rows
+            if len(self._pages) > self.cached_pages:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(page)
+        return rows
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self._row_count
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self._exhausted
+
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or self._exhausted:
+            return
+        page = len(self._page_starts) - 1
+        rows, next_cursor = self._query_page(page)
+        if next_cursor is None:
+            self._exhausted = True
+        else:
+            self._page_starts.append(next_cursor)
+        if not rows:
+            return
+        self.beginInsertRows(
+            QModelIndex(), self._row_count, self._row_count + len(rows) - 1)
+        self._pages[page] = rows
+        if len(self._pages) > self.cached_pages:
+            self._pages.popitem(last=False)
+        self._row_count += len(rows)
+        self.endInsertRows()
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        page, offset = divmod(index.row(), self.page_size)
+        rows = self._page(page)
+        if offset >= len(rows):
+            return None
+        email, snippet = rows[offset]
+        column = self.HEADERS[index.column()][0]
+        if column == "snippet":
+            return snippet
+        if column == "timestamp":
+            return time.strftime(
+                "%d.%m.%Y %H:%M", time.localtime(email.timestamp))
+        return getattr(email, column)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section][1]
+        return None
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        order_by = self.HEADERS[column][0]
+        if order_by not in self.database.ORDER_COLUMNS:
+            return
+        self.order_by = order_by
+        self.descending = order == Qt.DescendingOrder
+        self.reload()
 
 
 class EmailUI:
@@ -73,9 +435,10 @@ class EmailUI:
         self.sender_group_box = self.create_group_box("Sender")
         self.recipient_group_box = self.create_group_box("Recipient")
         self.time_label = QLabel()
-        self.email_table = QTableWidget()
+        self.search_edit = self.create_search_edit()
+        self.email_model = EmailTableModel(parent.email_database)
+        self.email_table = self.create_email_table()
         self.language_label = QLabel("Language Options")
-        self.attachment_button = QPushButton("Attachment")
         self.send_button = QPushButton("Send Email")
         self.send_button.setSizePolicy(
             QSizePolicy.Minimum, QSizePolicy.Minimum)
@@ -93,6 +456,33 @@ class EmailUI:
     def create_email_text_edit(self):
         return QTextEdit()
 
+    def create_search_edit(self):
+        search_edit = QLineEdit()
+        search_edit.setPlaceholderText("Mails durchsuchen (Betreff, Text, Empfänger)")
+        search_edit.setClearButtonEnabled(True)
+        return search_edit
+
+    def create_email_table(self):
+        email_table = QTableView()
+        email_table.setModel(self.email_model)
+        email_table.setSortingEnabled(True)
+        email_table.sortByColumn(4, Qt.DescendingOrder)
+        email_table.setSelectionBehavior(QTableView.SelectRows)
+        # Feste Zeilenhöhe: die View muss keine Zeilen vermessen
+        email_table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        email_table.verticalHeader().setDefaultSectionSize(22)
+        email_table.horizontalHeader().setStretchLastSection(True)
+        return email_table
+
+    def show_search_results(self, text):
+        self.email_model.set_search(text)
+        if text.strip():
+            self.email_model.fetchMore()
+            message = f"{self.email_model.rowCount()} Treffer"
+        else:
+            message = "Ready"
+        self.parent.statusBar().showMessage(message)
+
     def create_labeled_line_edit(self, label_text):
         label = QLabel(label_text)
         line_edit = QLineEdit()
@@ -115,11 +505,48 @@ class EmailUI:
     def create_additional_group_box(self):
         group_box = QGroupBox("Additional Options")
         layout = QVBoxLayout()
-        attach_button = self.create_attach_button()
-        layout.addWidget(attach_button)
+        self.attach_button = self.create_attach_button()
+        layout.addWidget(self.attach_button)
         group_box.setLayout(layout)
         return group_box
 
+    def send_email(self):
+        sender = self.sender_group_box.findChild(QLineEdit).text()
+        recipient = self.recipient_group_box.findChild(QLineEdit).text()
+        if not recipient.strip():
+            self.parent.statusBar().showMessage("Kein Empfänger angegeben")
+            return
+        try:
+            mail = self.mail_client.send_email(
+                sender, recipient.strip(), self.email_text_edit.toPlainText())
+        except Exception as e:
+            # SMTP- und COM-Fehler haben keine gemeinsame Basisklasse
+            self.parent.statusBar().showMessage(
+                f"Fehler beim Versand an {recipient}: {e}")
+            return
+        self.email_model.reload()
+        attachments = (f" mit {len(mail.attachments)} Anhängen"
+                       if mail.attachments else "")
+        self.parent.statusBar().showMessage(
+            f"E-Mail an {mail.recipient} gesendet{attachments}")
+
+    def choose_attachments(self):
+        paths, _ = QFileDialog.getOpenFileNames(
+            self.parent, "Anhänge auswählen")
+        if not paths:
+            return
+        attachments = self.mail_client.add_attachments(paths)
+        size = sum(attachment.size for attachment in attachments)
+        original = sum(attachment.original_size for attachment in attachments)
+        if size < original:
+            size_text = (f"{size / 1e6:.1f} MB, verkleinert von "
+                         f"{original / 1e6:.1f} MB")
+        else:
+            size_text = f"{size / 1e6:.1f} MB"
+        self.parent.statusBar().showMessage(
+            f"{len(attachments)} Anhänge ({size_text}): "
+            + ", ".join(attachment.filename for attachment in attachments))
+
     def create_format_toolbar(self):
         bold_button = QPushButton('Bold')
         italic_button = QPushButton('Italic')
@@ -172,7 +599,7 @@ class EmailClientWindow(QMainWindow):
     def __init__(self):
         super().__init__()
         self.email_database = EmailDatabase("email_db.sqlite")
-        self.email_client = EmailClient()
+        self.email_client = EmailClient(self.email_database)
         self.email_ui = EmailUI(self)
         self.initUI()
 
@@ -209,11 +636,7 @@ class EmailClientWindow(QMainWindow):
         # Zusätzliche Optionen für die E-Mail-Client-GUI
         additional_options_layout = QVBoxLayout()
 
-        # Attachments Group Box and Attachment Button
-        attachment_layout = QHBoxLayout()
-        # Assuming the attachment button exists
-        attachment_layout.addWidget(self.email_ui.attachment_button)
-        self.email_ui.additional_options_group_box.setLayout(attachment_layout)
+        # Attachments Group Box mit dem Attach-File-Button
         additional_options_layout.addWidget(self.email_ui.additional_options_group_box)
 
         # Language Options
@@ -230,6 +653,7 @@ class EmailClientWindow(QMainWindow):
         # Time Label and Email Table
         bottom_layout = QVBoxLayout()
         bottom_layout.addWidget(self.email_ui.time_label)
+        bottom_layout.addWidget(self.email_ui.search_edit)
         bottom_layout.addWidget(self.email_ui.email_table)
 
         # Zusammenführen des Bottom Layouts mit dem Haupt Layout
@@ -251,12 +675,26 @@ class EmailClientWindow(QMainWindow):
         Handlers:
         --------------
                 send_email : method
+                search_emails : method
+                choose_attachments : method
 
         Parameters:
         --------------
                 None
         """
-        self.email_ui.send_button.clicked.connect(self.email_client.send_email)
+        self.email_ui.send_button.clicked.connect(self.email_ui.send_email)
+        self.email_ui.search_edit.returnPressed.connect(self.search_emails)
+        self.email_ui.attach_button.clicked.connect(
+            self.email_ui.choose_attachments)
+
+    def search_emails(self):
+        self.email_ui.show_search_results(self.email_ui.search_edit.text())
+
+    def closeEvent(self, event):
+        # Offene SMTP-Verbindungen ordentlich beenden
+        if self.email_client.transport is not None:
+            self.email_client.transport.close()
+        super().closeEvent(event)
 
     def closeApplicaton(self):
         QApplication.instance().quit()
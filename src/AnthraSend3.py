@@ -24,8 +24,10 @@ Description:
     Microsoft Outlook and dispatch e-mails using the account configured
     in the default Outlook profile.
 
-    It leverages 'pandas' to parse the Excel file and extract necessary
-    user information to produce accurate mail content. Each recipient's
+    It streams the Excel file with 'openpyxl' in read-only mode and
+    prepares the user information chunk-wise with 'pandas' to produce
+    accurate mail content, so sending starts before the whole file
+    has been read. Each recipient's
     e-mail is individually crafted according to their language preference
     indicated within the Excel data.
 
@@ -38,9 +40,9 @@ Description:
 
 Important:
     This script is tailored for execution on a Windows operating system with
-    Microsoft Outlook installed and correctly set up. Execution within
-    other environments or with different e-mail clients is not supported
-    by the current implementation.
+    Microsoft Outlook installed and correctly set up. On other systems
+    the SMTP transport can be selected with ANTHRASEND_TRANSPORT=smtp
+    (see mail_transport.py).
 
 Usage:
     Ensure that the Outlook application is installed and the user has an
@@ -52,8 +54,17 @@ Usage:
     The script will prompt the user for confirmation before dispatching
     e-mails.
 
-    Progress feedback is provided during the sending process, and any
-    errors encountered will be reported to the user.
+    Sending runs on a worker thread. Progress feedback is provided during
+    the sending process; errors are collected in a filterable panel
+    without interrupting the run, followed by a summary at the end.
+
+    With ANTHRASEND_BCC_MAX set, recipients that get identical mails
+    (e.g. the FR store managers) are sent as one mail with the
+    recipients in BCC (see bcc_fanout.py).
+
+    With ANTHRASEND_ACCOUNTS pointing to an accounts file, the mails are
+    spread over several sender accounts, each with its own connection
+    pool, rate limit and daily quota (see sharded_transport.py).
 
 Functions:
     main() - The primary function invoked when the script is run; responsible
@@ -61,7 +72,8 @@ Functions:
     generate_emails() - Reads user data from the Excel file, generates e-mail
                 content, and constructs e-mail objects.
     _get_localized_content() - Produces subject and body text for an e-mail in
-                the intended recipient's language.
+                the intended recipient's language from the precompiled
+                template catalog (see template_catalog.py).
 
 Classes:
     User - A data structure holding details about a user such as:
@@ -75,18 +87,41 @@ Classes:
                 - body.
     EmailContentGenerator - Encapsulates the logic for creating
                 personalized, localized content for the e-mails.
-    MailSender - Handles the sending of e-mail objects via the
-                Outlook application.
-    ErrorHandler - Manages error reporting by displaying messages
-                to the user when an exception occurs.
-    UIHandler - Manages user interaction elements, including
-                confirmation prompts and progress bars.
+    MailSender - Handles the sending of e-mail objects via a mail
+                transport (Outlook or SMTP, see mail_transport.py).
+    SendWorker - Runs reading, rendering and sending on a QThread and
+                reports progress and errors through signals.
+    ErrorPanel - Non-modal, filterable list of the send errors.
+    SendWindow - Progress bar, error panel and final summary.
+    UIHandler - Manages the confirmation prompt.
 """
 
-import win32com.client
-import pandas as pd
+import os
+import smtplib
 import sys
-from PyQt5.QtWidgets import QApplication, QMessageBox, QProgressBar
+import time
+from bcc_fanout import fanout_limit
+from mail_transport import create_transport
+from recipient_prep import (
+    UnsupportedLanguageError, drop_suppressed, normalize_addresses,
+    prepare_recipients, render_by_content, render_in_order,
+    validate_languages, write_rejection_report
+)
+from recipient_source import RecipientSnapshotCache
+from retry_scheduler import DeadLetterQueue
+from send_dispatcher import create_dispatcher
+from send_journal import campaign_id, create_send_journal
+from send_metrics import create_send_metrics
+from suppression_list import create_suppression_list
+from template_catalog import TemplateCatalog
+from PyQt5.QtCore import (
+    QAbstractTableModel, QModelIndex, QObject, QSortFilterProxyModel, Qt,
+    QThread, pyqtSignal
+)
+from PyQt5.QtWidgets import (
+    QApplication, QComboBox, QHBoxLayout, QHeaderView, QLabel, QLineEdit,
+    QMessageBox, QProgressBar, QPushButton, QTableView, QVBoxLayout, QWidget
+)
 
 
 class Email:
@@ -105,122 +140,70 @@ class User:
 
 
 class EmailContentGenerator:
-    SALUTATIONS = {
-        'MR': {'DE': "Lieber", 'EN': "Dear", 'FR': "Cher", 'NL': "Beste"},
-        'MS': {'DE': "Liebe", 'EN': "Dear", 'FR': "Chère", 'NL': "Beste"},
-        'MX': {'DE': "Liebe(r)", 'EN': "Dear", 'FR': "Cher(e)", 'NL': "Beste"},
-    }
+    def __init__(self, catalog=None):
+        # Vorlagen werden einmal pro Kampagne kompiliert, siehe
+        # template_catalog.py; ANTHRASEND_TEMPLATES verweist optional auf
+        # eine eigene JSON-Datei
+        if catalog is None:
+            catalog_path = os.environ.get("ANTHRASEND_TEMPLATES")
+            catalog = (TemplateCatalog.load(catalog_path) if catalog_path
+                       else TemplateCatalog.default())
+        self.catalog = catalog
 
     def create_email_content(self, user: User):
-        anrede_text = self.SALUTATIONS.get(
-            user.salutation, self.SALUTATIONS['MX'])
         subject, body = self._get_localized_content(
-            user.language, anrede_text[user.language], user.firstname)
+            user.language, user.salutation, user.firstname)
         return Email(user.username, subject, body)
 
-    def _get_localized_content(self, language, salutation_text, vorname):
-        # Gemeinsame URL für alle Sprachen in einer Variablen halten
-        current_url = ">>> job.takko.com <<<"
-        planned_change_date = "08.03.2024"
-        common_info = (
-            f"die für den {planned_change_date} angesetzt war, vorerst aufgeschoben wird. Es wird keine Änderung geben, "
-            "bis weitere Informationen bereitgestellt werden.\n\n"
-            f"Bitte verwendet weiterhin die aktuelle URL {current_url} für den Zugriff auf d.vinci."
-        )
-
-        body_texts = {
-            'DE': (
-                f"{salutation_text} {vorname},\n\n"
-                f"ich möchte euch darüber informieren, dass {common_info} Ich entschuldige mich "
-                "für die Unannehmlichkeiten und danke euch für euer Verständnis und eure Flexibilität.\n\n"
-                "Für Rückfragen stehe ich euch gerne zur Verfügung.\n\n"
-                "Mit freundlichen Grüßen,\nHendrik Siemens"
-            ),
-            'EN': (
-                f"{salutation_text} {vorname},\n\n"
-                "I wish to inform you that the planned change of the URL from [job.takko.com] to [application.takko.com], which was "
-                f"scheduled for {planned_change_date}, has been postponed until further notice. "
-                f"Please continue to use the current URL {current_url} to access d.vinci. I apologize for any inconvenience and "
-                "thank you for your understanding and flexibility.\n\n"
-                "Should you have any questions, please do not hesitate to contact me.\n\n"
-                "Kind regards,\nHendrik Siemens"
-            ),
-            'FR': (
-                f"{salutation_text} {vorname},\n\n"
-                "je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour "
-                f"le {planned_change_date}, est reportée jusqu'à nouvel ordre. "
-                f"Veuillez donc continuer à utiliser l'URL actuelle {current_url} pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
-                "vous remercie de votre compréhension et de votre flexibilité.\n\n"
-                "En cas de questions, n'hésitez pas à me contacter.\n\n"
-                "Cordialement,\nHendrik Siemens"
-            ),
-            'NL': (
-                f"{salutation_text} {vorname},\n\n"
-                "Ik wil jullie informeren dat de geplande wijziging van de URL van [job.takko.com] naar [application.takko.com], die gepland stond voor "
-                f"{planned_change_date}, voorlopig is uitgesteld. Er worden geen wijzigingen aangebracht tot nadere informatie beschikbaar is.\n\n"
-                f"Gelieve de huidige URL {current_url} te blijven gebruiken om toegang te krijgen tot d.vinci. Mijn excuses voor eventuele overlast en "
-                "dank voor uw begrip en flexibilitet.\n\n"
-                "Als u vragen heeft, neem dan gerust contact met mij op.\n\n"
-                "Met vriendelijke groet,\nHendrik Siemens"
-            )
-        }
-
-        subject_texts = {
-            'DE': "Dringend: Aufschub der geplanten Änderung der URL für d.vinci",
-            'EN': "Urgent: Postponement of the Planned URL Change for d.vinci",
-            'FR': "Urgent: Report de la modification prévue de l'URL pour d.vinci",
-            'NL': "Dringend: Uitstel van de geplande URL-wijziging voor d.vinci"
-        }
-
-        if language not in subject_texts or language not in body_texts:
-            raise ValueError("Unsupported language")
-
-        if language == 'FR' and "Responsable de magasin" in vorname:
-            body_texts['FR'] = (
-                "Bonjour à tous,\n\n"
-                "Je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], "
-                f"prévue pour le {planned_change_date}, est reportée jusqu'à nouvel ordre. {common_info} "
-                "Je m'excuse pour les désagréments causés et vous remercie de votre compréhension et de votre flexibilité.\n\n"
-                "En cas de questions, n'hésitez pas à me contacter.\n\n"
-                "Cordialement,\nHendrik Siemens"
-            )
-
-        subject = subject_texts[language]
-        body = body_texts[language]
-
-        return subject, body
+    def _get_localized_content(self, language, salutation, vorname):
+        return self.catalog.render(language, salutation, vorname)
 
 
 class MailSender:
-    def __init__(self):
-        self.outlook = win32com.client.Dispatch("Outlook.Application")
+    def __init__(self, transport=None):
+        # Standard ist weiterhin Outlook, siehe mail_transport.create_transport
+        self.transport = transport or create_transport()
+        self.dispatcher = None
 
     def send_email(self, email):
-        try:
-            mail = self.outlook.CreateItem(0)
-            mail.To = email.to_email
-            mail.Subject = email.subject
-            mail.Body = email.body
-            mail.Send()
-            print(f"E-Mail an {email.to_email} gesendet.")
-        except Exception as e:
-            raise e
-
-
-class ErrorHandler:
-    @staticmethod
-    def display_error_message(to_email, e):
-        msgBox = QMessageBox()
-        msgBox.setIcon(QMessageBox.Warning)
-        msgBox.setText(f"Fehler beim Versand an {to_email}: {e}")
-        msgBox.setWindowTitle("Fehler")
-        msgBox.exec_()
+        self.transport.send(email.to_email, email.subject, email.body)
+        print(f"E-Mail an {email.to_email} gesendet.")
+
+    def send_emails(self, emails, metrics=None, dead_letters=None):
+        """
+        Send all e-mails concurrently, limited by the dispatcher's rate
+        limits; transient failures are retried later. Yields (email,
+        error) pairs in completion order; timings and outcomes are
+        recorded in ``metrics`` (send_metrics.py), final failures in
+        ``dead_letters`` (retry_scheduler.py).
+        """
+        self.dispatcher = create_dispatcher(
+            self.transport, metrics, dead_letters)
+        results = self.dispatcher.dispatch(
+            emails, as_job=lambda email: (
+                email.to_email, email.subject, email.body))
+        for email, e in results:
+            if e is None:
+                print(f"E-Mail an {email.to_email} gesendet.")
+            yield email, e
+
+    def give_up_retries(self):
+        # Darf aus einem anderen Thread aufgerufen werden
+        if self.dispatcher is not None:
+            self.dispatcher.give_up_retries()
+
+    def close(self):
+        self.transport.close()
 
 
 class UIHandler:
+    # Muss leben, solange Fenster angezeigt werden
+    app = None
+
     @staticmethod
     def prompt_user_confirmation(count):
-        app = QApplication(sys.argv)
+        app = QApplication.instance() or QApplication(sys.argv)
+        UIHandler.app = app
         msgBox = QMessageBox()
         msgBox.setIcon(QMessageBox.Warning)
         msgBox.setText(f"{count} E-Mails werden versendet. Sind Sie sicher?")
@@ -232,62 +215,461 @@ class UIHandler:
         app.exit()
 
     @staticmethod
-    def show_progress(emails, success_count, error_count):
-        progress_bar = QProgressBar()
-        progress_bar.setMaximum(len(emails))
-        progress_bar.show()
-
-        for i, email in enumerate(emails):
-            progress_bar.setValue(i + 1)
-            QApplication.processEvents()
-
-        # waits for the user to close the progress bar
-        progress_bar.close()
-
-
-def generate_emails(df):
-    content_generator = EmailContentGenerator()
-    emails = []
-    for index, row in df.iterrows():
-        user = User(
-            row['Benutzername'],
-            row['Vorname'],
-            row['Sprache'].upper(),
-            row['Anrede']
-        )
-        email = content_generator.create_email_content(user)
-        emails.append(email)
-    return emails
+    def show_unsupported_languages(error):
+        app = QApplication.instance() or QApplication(sys.argv)
+        UIHandler.app = app
+        msgBox = QMessageBox()
+        msgBox.setIcon(QMessageBox.Critical)
+        msgBox.setText(
+            f"{len(error.rows)} Zeile(n) mit nicht unterstützter Sprache. "
+            f"Es wurde nichts versendet.")
+        msgBox.setDetailedText(str(error))
+        msgBox.setWindowTitle("Fehler")
+        msgBox.exec_()
 
 
-def main():
-    try:
-        df = pd.read_excel('Mappe2.xlsx')
-        emails = generate_emails(df)
+def error_kind(e):
+    """
+    Short error category for the error panel's filter: the SMTP reply
+    code if there is one, otherwise the exception type.
+    """
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in e.recipients.values()]
+        if codes:
+            return f"SMTP {codes[0]}"
+    code = getattr(e, "smtp_code", None)
+    if isinstance(code, int):
+        return f"SMTP {code}"
+    return type(e).__name__
+
+
+class SendWorker(QObject):
+    """
+    Runs the campaign on a QThread. Reading, rendering and the journal
+    live on that thread (SQLite connections belong to the thread that
+    created them). The transport is created there too: Outlook is
+    initialized for COM on the QThread and, with one send at a time,
+    called only from it; SMTP sends run on the dispatcher's workers.
+    The window only receives signals, so the send loop never waits for
+    user interaction.
+    """
+
+    # erledigt, Fortschrittstext
+    progress = pyqtSignal(int, str)
+    # [(Empfänger, Fehlerart, Meldung)] seit der letzten Aktualisierung
+    errors = pyqtSignal(list)
+    # Zusammenfassung (Zeilen), Rückgabewert
+    finished = pyqtSignal(list, int)
+
+    # Höchstens zehn Aktualisierungen pro Sekunde
+    update_interval = 0.1
+
+    def __init__(self, excel_file, total, catalog, recipient_cache):
+        super().__init__()
+        self.excel_file = excel_file
+        self.total = total
+        self.catalog = catalog
+        self.recipient_cache = recipient_cache
+        self.exit_code = None
+        self.cancelled = False
+        self.mail_sender = None
+
+    def cancel(self):
+        """
+        Called directly from the UI thread (the worker thread is busy).
+        """
+        self.cancelled = True
+        self.thread().requestInterruption()
+        if self.mail_sender is not None:
+            self.mail_sender.give_up_retries()
+
+    def _until_cancelled(self, emails):
+        thread = QThread.currentThread()
+        for email in emails:
+            if thread.isInterruptionRequested():
+                return
+            yield email
 
-        mail_sender = MailSender()
+    def run(self):
+        try:
+            summary = self._run_campaign()
+            self.exit_code = 0
+        except Exception as e:
+            summary = [f"Error: {e}"]
+            self.exit_code = 1
+        for line in summary:
+            print(line)
+        self.finished.emit(summary, self.exit_code)
+
+    def _report(self, metrics, errors):
+        if errors:
+            self.errors.emit(errors)
+        self.progress.emit(metrics.done, metrics.progress_text())
+
+    def _run_campaign(self):
+        rejected = []
+        suppressed = []
+        invalid = []
+        suppression = create_suppression_list()
+        emails = stream_emails(self.excel_file, rejected, self.recipient_cache,
+                               self.catalog, suppression, suppressed, invalid)
+        # Vor dem Journal anhalten: bereits als 'queued' markierte
+        # Empfänger werden noch versendet und ihr Ergebnis festgehalten
+        emails = self._until_cancelled(emails)
+
+        # Bereits versendete Empfänger werden beim erneuten Start übersprungen
+        journal = create_send_journal(
+            'send_journal.sqlite',
+            campaign_id(self.excel_file, self.catalog.fingerprint))
+        emails = journal.track(emails, key=lambda email: email.to_email)
+
+        # Auf diesem Thread erzeugen: hier wird Outlook (COM) initialisiert
+        mail_sender = self.mail_sender = MailSender()
+        metrics = create_send_metrics(journal.campaign, self.total)
+        dead_letters = DeadLetterQueue()
         success_count = 0
-        error_count = []
+        failed_count = 0
+        pending_errors = []
+        last_update = 0.0
+
+        try:
+            for email, e in mail_sender.send_emails(
+                    emails, metrics, dead_letters):
+                journal.record(email.to_email, e)
+                if e is None:
+                    success_count += 1
+                else:
+                    failed_count += 1
+                    pending_errors.append(
+                        (email.to_email, error_kind(e), str(e)))
+                if time.monotonic() - last_update >= self.update_interval:
+                    self._report(metrics, pending_errors)
+                    pending_errors = []
+                    last_update = time.monotonic()
+                if self.cancelled:
+                    # Falls cancel() vor dem Start des Dispatchers kam
+                    mail_sender.give_up_retries()
+        finally:
+            journal.close()
+            mail_sender.close()
+            metrics.close()
+            if suppression is not None:
+                suppression.close()
+        self._report(metrics, pending_errors)
+
+        summary = [
+            f"{success_count} Mails sent successfully.",
+            f"{failed_count} failed to send.",
+        ]
+        if self.cancelled:
+            summary.append("Versand abgebrochen, restliche Empfänger beim "
+                           "nächsten Start.")
+        if journal.skipped_sent:
+            summary.append(
+                f"{journal.skipped_sent} bereits versendet, übersprungen.")
+        if journal.skipped_in_doubt:
+            summary.append(
+                f"{len(journal.skipped_in_doubt)} Empfänger mit unklarem Status "
+                f"(Abbruch während des Versands), nicht erneut gesendet: "
+                f"{journal.skipped_in_doubt}")
+        if suppressed:
+            summary.append(f"{len(suppressed)} gesperrte Adressen übersprungen "
+                           f"(Rückläufer, Abmeldungen, ungültig).")
+        if rejected:
+            summary.append(str(UnsupportedLanguageError(rejected)))
+        if invalid or rejected:
+            report_path = os.environ.get(
+                "ANTHRASEND_REJECTION_REPORT", "rejected_recipients.csv")
+            write_rejection_report(report_path, invalid + [
+                (excel_row, address, f"Sprache {language!r} nicht unterstützt")
+                for excel_row, address, language in rejected])
+            summary.append(f"{len(invalid)} ungültige oder doppelte Adressen, "
+                           f"Bericht: {report_path}")
+        if dead_letters:
+            dead_letter_path = os.environ.get(
+                "ANTHRASEND_DEAD_LETTERS", "dead_letters.csv")
+            dead_letters.write_csv(dead_letter_path)
+            summary.append(
+                f"{len(dead_letters)} endgültig fehlgeschlagen "
+                f"({dead_letters.counts()}), Bericht: {dead_letter_path}")
+        summary.append(f"Durchsatz: {mail_sender.transport.stats}")
+        summary.append(metrics.summary())
+        return summary
+
+
+class ErrorTableModel(QAbstractTableModel):
+    HEADERS = ("Zeit", "Empfänger", "Fehlerart", "Meldung")
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+
+    def add_errors(self, errors):
+        stamp = time.strftime("%H:%M:%S")
+        self.beginInsertRows(
+            QModelIndex(), len(self.rows), len(self.rows) + len(errors) - 1)
+        self.rows.extend((stamp, *error) for error in errors)
+        self.endInsertRows()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid() or role not in (Qt.DisplayRole, Qt.ToolTipRole):
+            return None
+        return self.rows[index.row()][index.column()]
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+
+class ErrorFilterModel(QSortFilterProxyModel):
+    """
+    Filters the errors by category and by text in recipient or message.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.kind = None
+        self.text = ""
+
+    def set_filter(self, kind=None, text=""):
+        self.kind = kind
+        self.text = text.strip().lower()
+        self.invalidateFilter()
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        _, recipient, kind, message = self.sourceModel().rows[source_row]
+        if self.kind is not None and kind != self.kind:
+            return False
+        return not self.text or self.text in f"{recipient} {message}".lower()
+
+
+class ErrorPanel(QWidget):
+    """
+    Non-modal list of all send errors of the run, filterable by error
+    category and text. Errors are appended while sending continues.
+    """
+
+    ALL_KINDS = "Alle Fehlerarten"
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.model = ErrorTableModel(self)
+        self.proxy = ErrorFilterModel(self)
+        self.proxy.setSourceModel(self.model)
+        self.kind_counts = {}
+
+        self.kind_combo = QComboBox()
+        self.kind_combo.addItem(self.ALL_KINDS)
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText(
+            "Fehler filtern (Empfänger, Meldung)")
+        self.filter_edit.setClearButtonEnabled(True)
+        self.count_label = QLabel("Keine Fehler")
+
+        self.table = QTableView()
+        self.table.setModel(self.proxy)
+        self.table.setSortingEnabled(True)
+        self.table.setSelectionBehavior(QTableView.SelectRows)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(22)
+        self.table.horizontalHeader().setStretchLastSection(True)
+
+        filters = QHBoxLayout()
+        filters.addWidget(self.kind_combo)
+        filters.addWidget(self.filter_edit)
+        filters.addWidget(self.count_label)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(filters)
+        layout.addWidget(self.table)
+
+        self.kind_combo.currentTextChanged.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(self.apply_filter)
+
+    def add_errors(self, errors):
+        for _, kind, _ in errors:
+            if kind not in self.kind_counts:
+                self.kind_counts[kind] = 0
+                self.kind_combo.addItem(kind)
+            self.kind_counts[kind] += 1
+        self.model.add_errors(errors)
+        self.update_count()
+
+    def apply_filter(self, _=None):
+        kind = self.kind_combo.currentText()
+        self.proxy.set_filter(
+            None if kind == self.ALL_KINDS else kind, self.filter_edit.text())
+        self.update_count()
+
+    def update_count(self):
+        total = self.model.rowCount()
+        shown = self.proxy.rowCount()
+        if not total:
+            self.count_label.setText("Keine Fehler")
+        elif shown == total:
+            self.count_label.setText(f"{total} Fehler")
+        else:
+            self.count_label.setText(f"{shown} von {total} Fehlern")
+
+    def kind_summary(self):
+        return ", ".join(f"{kind}: {count}" for kind, count in sorted(
+            self.kind_counts.items(), key=lambda item: -item[1]))
+
+
+class SendWindow(QWidget):
+    """
+    Progress, error panel and final summary of a running campaign.
+    """
+
+    cancel_requested = pyqtSignal()
+
+    def __init__(self, total, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Versand")
+        self.resize(760, 420)
+        self.running = True
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximum(max(total, 1))
+        self.progress_bar.setValue(0)
+        self.progress_bar.setFormat("Versand wird vorbereitet …")
+        self.error_panel = ErrorPanel()
+        self.summary_label = QLabel()
+        self.summary_label.setTextInteractionFlags(Qt.TextSelectableByMouse)
+        self.summary_label.setWordWrap(True)
+        self.summary_label.hide()
+        self.cancel_button = QPushButton("Abbrechen")
+        self.close_button = QPushButton("Schließen")
+        self.close_button.setEnabled(False)
+
+        buttons = QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.cancel_button)
+        buttons.addWidget(self.close_button)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.progress_bar)
+        layout.addWidget(self.error_panel)
+        layout.addWidget(self.summary_label)
+        layout.addLayout(buttons)
+
+        self.cancel_button.clicked.connect(self.cancel)
+        self.close_button.clicked.connect(self.close)
+
+    def show_progress(self, done, text):
+        self.progress_bar.setValue(min(done, self.progress_bar.maximum()))
+        self.progress_bar.setFormat(text)
+
+    def show_summary(self, summary, exit_code):
+        self.running = False
+        if exit_code == 0:
+            self.progress_bar.setValue(self.progress_bar.maximum())
+        kinds = self.error_panel.kind_summary()
+        if kinds:
+            summary = summary + [f"Fehlerarten: {kinds}"]
+        self.summary_label.setText("\n".join(summary))
+        self.summary_label.show()
+        self.cancel_button.setEnabled(False)
+        self.close_button.setEnabled(True)
+
+    def cancel(self):
+        # Laufende Sendungen werden noch abgeschlossen
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.setText("Wird abgebrochen …")
+        self.cancel_requested.emit()
+
+    def closeEvent(self, event):
+        if self.running:
+            # Erst abbrechen, geschlossen wird nach der Zusammenfassung
+            self.cancel()
+            event.ignore()
+        else:
+            event.accept()
+
+
+def generate_emails(df, suppression=None, suppressed=None, invalid=None):
+    # Adressen werden normalisiert, ungültige und doppelte sowie gesperrte
+    # (Rückläufer, Abmeldungen) fallen vor dem Rendern heraus; alle Zeilen
+    # mit nicht unterstützter Sprache werden gesammelt gemeldet, bevor
+    # etwas versendet wird
+    catalog = EmailContentGenerator().catalog
+    df = normalize_addresses(df, invalid)
+    df = drop_suppressed(df, suppression, suppressed)
+    prepared = prepare_recipients(df, catalog)
+    return [
+        Email(to_email, subject, body)
+        for to_email, subject, body in render_in_order(prepared, catalog)
+    ]
+
+
+def stream_emails(excel_file, rejected, recipient_cache, catalog,
+                  suppression=None, suppressed=None, invalid=None):
+    """
+    Generate the e-mails chunk by chunk while the workbook is still being
+    read (or from its cached snapshot). main() has checked the languages
+    of all rows before the send was confirmed; rows with an unsupported
+    language that still turn up are collected in ``rejected``, suppressed
+    addresses in ``suppressed`` and invalid or repeated addresses in
+    ``invalid``.
+    """
+    # Über alle Chunks hinweg: Adresse -> erste Excel-Zeile
+    seen = {}
+    # Für den BCC-Versand gleiche Inhalte je Chunk hintereinander
+    render = render_by_content if fanout_limit() else render_in_order
+    for chunk in recipient_cache.read_chunks(excel_file):
+        chunk = normalize_addresses(chunk, invalid, seen)
+        chunk = drop_suppressed(chunk, suppression, suppressed)
+        prepared = prepare_recipients(chunk, catalog, rejected)
+        for to_email, subject, body in render(prepared, catalog):
+            yield Email(to_email, subject, body)
 
-        UIHandler.prompt_user_confirmation(len(emails))
 
-        for email in emails:
-            try:
-                mail_sender.send_email(email)
-                success_count += 1
-            except Exception as e:
-                ErrorHandler.display_error_message(email.to_email, e)
-                error_count.append(email.to_email)
-
-        UIHandler.show_progress(emails, success_count, error_count)
-        print(
-            f"{success_count} Mails sent successfully.\n{len(error_count)} failed to send."
-        )
-        return 0
+def main():
+    excel_file = 'Mappe2.xlsx'
+    try:
+        recipient_cache = RecipientSnapshotCache()
+        catalog = EmailContentGenerator().catalog
+        # Alle Zeilen mit nicht unterstützter Sprache vor der Bestätigung
+        # melden; der erste Durchlauf legt dabei den Snapshot an, aus dem
+        # der Versand dann liest
+        total = validate_languages(
+            recipient_cache.read_chunks(excel_file), catalog)
+    except UnsupportedLanguageError as e:
+        print(f"Error: {e}")
+        UIHandler.show_unsupported_languages(e)
+        return 1
     except Exception as e:
         print(f"Error: {e}")
         return 1
 
+    UIHandler.prompt_user_confirmation(total)
+
+    # Versand im Hintergrund; das Fenster bleibt bedienbar und Fehler
+    # werden gesammelt statt einzeln bestätigt
+    window = SendWindow(total)
+    thread = QThread()
+    worker = SendWorker(excel_file, total, catalog, recipient_cache)
+    worker.moveToThread(thread)
+    thread.started.connect(worker.run)
+    worker.progress.connect(window.show_progress)
+    worker.errors.connect(window.error_panel.add_errors)
+    worker.finished.connect(window.show_summary)
+    worker.finished.connect(thread.quit)
+    window.cancel_requested.connect(worker.cancel, Qt.DirectConnection)
+
+    window.show()
+    thread.start()
+    UIHandler.app.exec_()
+    thread.requestInterruption()
+    thread.wait()
+    return worker.exit_code
+
 
 if __name__ == "__main__":
     val = main()
@@ -0,0 +1,116 @@
+"""
+BCC fan-out for recipients that get exactly the same message.
+
+Some recipients receive identical mails: the FR store manager variant
+has no personalization at all ("Bonjour à tous"), and group mailboxes
+often share a first name like "Team". With fan-out enabled, the
+dispatcher (send_dispatcher.py) sends such recipients as one message
+with the recipients in BCC, at most ``max_recipients`` per message, so a
+group of a hundred store managers costs one transport operation instead
+of a hundred.
+
+Groups are detected on the rendered content: consecutive jobs with the
+same subject and body are combined into a FanOut. Within each chunk of
+the workbook recipient_prep.render_by_content puts identical messages
+next to each other. At most ``max_recipients`` items are held back at a
+time, so the in-doubt window of the send journal hardly grows.
+
+Everything downstream stays per recipient:
+    - the dispatcher yields one ``(item, error)`` per item of a FanOut,
+      so the journal, metrics and dead letters see single recipients,
+    - recipients refused by the server while others were accepted get
+      their own error, and transient refusals are retried one by one,
+    - a message rejected as a whole for good (e.g. at DATA) is sent
+      again to each recipient on its own, since one recipient may be
+      the cause,
+    - bounces name the failed recipient (bounce_parser.py), whether it
+      was addressed in To or in BCC.
+
+ANTHRASEND_BCC_MAX sets the maximum number of recipients per message;
+unset, 0 or 1 disables fan-out. SMTP servers must accept at least 100
+recipients per message (RFC 5321), many do not accept more.
+"""
+
+import os
+
+
+class FanOut:
+    """
+    Items with identical subject and body, sent as one message.
+    """
+
+    __slots__ = ("items", "recipients", "subject", "body")
+
+    def __init__(self, items, jobs):
+        self.items = list(items)
+        self.recipients = [job[0] for job in jobs]
+        _, self.subject, self.body = jobs[0]
+
+    def __len__(self):
+        return len(self.items)
+
+    @property
+    def job(self):
+        """
+        Arguments of ``transport.send_bcc``.
+        """
+        return tuple(self.recipients), self.subject, self.body
+
+    def remove(self, recipients):
+        """
+        Take ``recipients`` out of the group and return their
+        ``(item, recipient)`` pairs.
+        """
+        removed = []
+        kept_items = []
+        kept_recipients = []
+        for item, recipient in zip(self.items, self.recipients):
+            if recipient in recipients:
+                removed.append((item, recipient))
+            else:
+                kept_items.append(item)
+                kept_recipients.append(recipient)
+        self.items = kept_items
+        self.recipients = kept_recipients
+        return removed
+
+
+def fan_out(items, as_job, max_recipients):
+    """
+    Yield ``(item, job)`` for every item, with runs of consecutive items
+    whose subject and body are identical combined into
+    ``(FanOut, job)`` of at most ``max_recipients`` items each.
+    """
+    run_items = []
+    run_jobs = []
+    for item in items:
+        job = as_job(item)
+        if run_jobs and (job[1] != run_jobs[0][1]
+                         or job[2] != run_jobs[0][2]):
+            yield _group(run_items, run_jobs)
+            run_items = []
+            run_jobs = []
+        run_items.append(item)
+        run_jobs.append(job)
+        if len(run_items) >= max_recipients:
+            yield _group(run_items, run_jobs)
+            run_items = []
+            run_jobs = []
+    if run_items:
+        yield _group(run_items, run_jobs)
+
+
+def _group(items, jobs):
+    if len(items) == 1:
+        return items[0], jobs[0]
+    group = FanOut(items, jobs)
+    return group, group.job
+
+
+def fanout_limit():
+    """
+    Maximum number of recipients per message from ANTHRASEND_BCC_MAX,
+    or None if fan-out is disabled.
+    """
+    limit = int(os.environ.get("ANTHRASEND_BCC_MAX", "0") or 0)
+    return limit if limit > 1 else None
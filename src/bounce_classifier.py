@@ -0,0 +1,182 @@
+"""
+Single-pass classification of incoming mails into bounces and replies.
+
+All known markers of DE/EN/FR/NL mail servers (subjects like
+"Unzustellbar:", "Undeliverable:", "Non remis :", "Onbestelbaar:",
+diagnostic headings, typical error phrases, auto-reply subjects) and the
+SMTP enhanced status codes (5.x.x permanent, 4.x.x transient) are
+compiled into one regular expression. The literal markers are merged
+into a trie first, so the expression branches on one character at a
+time and its matching cost hardly grows with the number of markers.
+
+A message is scanned once and classified as
+
+    HARD_BOUNCE - permanent failure, address should be suppressed,
+    SOFT_BOUNCE - transient failure (mailbox full, delayed, ...),
+    AUTO_REPLY  - out-of-office and other automatic replies,
+    NOT_BOUNCE  - everything else.
+"""
+
+import re
+from collections import namedtuple
+from email import message_from_bytes
+from email.policy import compat32
+
+from bounce_parser import header_text, text_body
+
+
+HARD_BOUNCE = "hard_bounce"
+SOFT_BOUNCE = "soft_bounce"
+AUTO_REPLY = "auto_reply"
+NOT_BOUNCE = "not_bounce"
+
+# Kategorien der Marker
+BOUNCE = "bounce"
+HARD = "hard"
+SOFT = "soft"
+AUTO = "auto"
+
+MARKERS = {
+    BOUNCE: [
+        "unzustellbar", "nicht zustellbar", "diagnoseinformationen für administratoren",
+        "undeliverable", "undelivered mail", "delivery status notification (failure)",
+        "mail delivery failed", "mail delivery subsystem", "returned mail",
+        "delivery has failed", "diagnostic information for administrators",
+        "non remis", "non distribuable", "échec de la remise",
+        "informations de diagnostic pour les administrateurs",
+        "onbestelbaar", "niet bezorgd", "bezorging mislukt",
+        "diagnostische informatie voor beheerders",
+    ],
+    HARD: [
+        "user unknown", "unknown user", "no such user", "recipient not found",
+        "recipientnotfound", "address rejected", "does not exist",
+        "mailbox unavailable", "invalid recipient",
+        "empfänger nicht gefunden", "existiert nicht", "unbekannter empfänger",
+        "adresse introuvable", "destinataire inconnu", "n'existe pas",
+        "onbekende ontvanger", "bestaat niet", "adres niet gevonden",
+    ],
+    SOFT: [
+        "mailbox full", "mailbox is full", "quota exceeded", "over quota",
+        "delivery delayed", "delivery status notification (delay)",
+        "try again later", "temporarily deferred", "temporary failure",
+        "postfach ist voll", "postfach voll", "zustellung verzögert",
+        "vorübergehend",
+        "boîte aux lettres pleine", "boîte pleine", "remise différée",
+        "temporairement",
+        "postvak is vol", "mailbox is vol", "vertraagd", "tijdelijk",
+    ],
+    AUTO: [
+        "automatische antwort", "abwesenheitsnotiz", "abwesend",
+        "automatic reply", "auto-reply", "autoreply", "out of office",
+        "auto-submitted: auto-replied",
+        "réponse automatique", "absence du bureau", "absent du bureau",
+        "automatisch antwoord", "afwezig", "niet aanwezig",
+    ],
+}
+
+STATUS_CODE = r"(?<![\d.])(?P<code>[45]\.\d{1,3}\.\d{1,3})(?![\d.])"
+
+
+Classification = namedtuple(
+    "Classification", ["kind", "status", "markers"])
+
+
+def _trie_pattern(words):
+    """
+    Regular expression matching any of ``words``, built from a trie so
+    that common prefixes are only tested once.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = True
+
+    def build(node):
+        terminal = "" in node
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        if len(branches) == 1 and not terminal:
+            return branches[0]
+        pattern = "(?:" + "|".join(branches) + ")"
+        return pattern + "?" if terminal else pattern
+
+    return build(trie)
+
+
+class BounceClassifier:
+    """
+    Classifies messages with one compiled pattern and one scan.
+    """
+
+    def __init__(self, markers=None):
+        markers = markers or MARKERS
+        self.categories = {}
+        for category, words in markers.items():
+            for word in words:
+                self.categories[word.casefold()] = category
+        literals = _trie_pattern(self.categories)
+        self.pattern = re.compile(f"(?P<marker>{literals})|{STATUS_CODE}")
+
+    def scan(self, text, header_end):
+        """
+        Scan ``text`` once. Returns the set of marker categories and the
+        enhanced status codes found. Auto-reply markers only count in the
+        first ``header_end`` characters (subject and headers), so a
+        normal mail mentioning an absence is not taken for one.
+        """
+        found = set()
+        codes = []
+        for match in self.pattern.finditer(text):
+            marker = match.group("marker")
+            if marker is not None:
+                category = self.categories[marker]
+                if category != AUTO or match.start() < header_end:
+                    found.add(category)
+            else:
+                codes.append(match.group("code"))
+        return found, codes
+
+    def classify(self, subject, body, headers=""):
+        prefix = f"{subject}\n{headers}\n".casefold()
+        found, codes = self.scan(f"{prefix}\n{body.casefold()}", len(prefix))
+
+        permanent = [code for code in codes if code.startswith("5")]
+        transient = [code for code in codes if code.startswith("4")]
+        if BOUNCE in found or (codes and (HARD in found or SOFT in found)):
+            if permanent or HARD in found:
+                kind = HARD_BOUNCE
+            elif transient or SOFT in found:
+                kind = SOFT_BOUNCE
+            else:
+                # Unzustellbar ohne Details: als endgültig werten
+                kind = HARD_BOUNCE
+        elif AUTO in found:
+            kind = AUTO_REPLY
+        else:
+            kind = NOT_BOUNCE
+
+        status = (permanent or transient or [""])[0]
+        return Classification(kind, status, frozenset(found))
+
+    def classify_message(self, raw):
+        """
+        Classify a raw RFC 5322 message (bytes).
+        """
+        message = message_from_bytes(raw, policy=compat32)
+        headers = ""
+        if message.get("Auto-Submitted"):
+            headers = f"auto-submitted: {message['Auto-Submitted']}"
+        # DSN-Angaben (Status: 5.1.1) stehen in message/delivery-status
+        body = text_body(message)
+        for part in message.walk():
+            blocks = part.get_payload()
+            if (part.get_content_type() == "message/delivery-status"
+                    and isinstance(blocks, list)):
+                body += "\n" + "\n".join(
+                    f"Status: {block.get('Status', '')}" for block in blocks)
+        return self.classify(
+            header_text(message.get("Subject", "")), body, headers)
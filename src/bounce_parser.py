@@ -0,0 +1,231 @@
+"""
+Parsing of bounce messages (non-delivery reports).
+
+Two kinds of bounces are understood:
+
+    - RFC 3464 delivery status notifications (multipart/report with a
+      message/delivery-status part), as sent by most mail servers,
+    - the plain-text NDR bodies of Exchange/Outlook ("Unzustellbar:",
+      "Diagnoseinformationen für Administratoren:", "Remote Server
+      returned '550 5.1.1 ...'").
+
+For every failed recipient a BounceRecord with address, enhanced status
+code and diagnostic text is produced.
+
+Mailboxes (Maildir directory or mbox file) are processed as a stream:
+messages are read lazily and parsed in batches on a process pool, with
+only a bounded number of batches in flight.
+"""
+
+import mailbox
+import os
+import re
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from email import message_from_bytes
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+from email.policy import compat32
+
+
+BounceRecord = namedtuple(
+    "BounceRecord",
+    ["recipient", "status", "action", "diagnostic", "message_id", "subject"])
+
+
+ADDRESS_PATTERN = re.compile(
+    r"[A-Za-z0-9.!#$%&'*+/=?^_`{|}~-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)+")
+STATUS_PATTERN = re.compile(r"\b([245]\.\d{1,3}\.\d{1,3})\b")
+
+# Überschriften, unter denen Exchange/Outlook die Diagnose ausgibt
+DIAGNOSTIC_HEADINGS = (
+    "Diagnoseinformationen für Administratoren:",
+    "Diagnostic information for administrators:",
+    "Informations de diagnostic pour les administrateurs :",
+    "Diagnostische informatie voor beheerders:",
+)
+
+
+def _address(value):
+    """
+    Extract the address from fields like 'rfc822; user@example.com'.
+    """
+    if not value:
+        return None
+    match = ADDRESS_PATTERN.search(str(value))
+    return match.group(0).lower() if match else None
+
+
+def _single_line(value):
+    return " ".join(str(value).split()) if value else ""
+
+
+def header_text(value):
+    """
+    Decode RFC 2047 encoded words ('=?utf-8?q?R=C3=A9ponse?=') in a header
+    read with compat32 and fold it onto a single line.
+    """
+    if not value:
+        return ""
+    try:
+        value = str(make_header(decode_header(str(value))))
+    except (HeaderParseError, LookupError, UnicodeError):
+        # Kaputte Kodierung: Rohtext ist besser als gar kein Betreff
+        pass
+    return _single_line(value)
+
+
+def parse_dsn(message):
+    """
+    Records of an RFC 3464 delivery status notification, or an empty
+    list if ``message`` is no such report.
+    """
+    if message.get_content_type() != "multipart/report":
+        return []
+    records = []
+    for part in message.walk():
+        if part.get_content_type() != "message/delivery-status":
+            continue
+        # Erster Block: Angaben zur Nachricht, danach je Empfänger einer
+        blocks = part.get_payload()
+        if not isinstance(blocks, list):
+            continue
+        for block in blocks[1:]:
+            recipient = _address(
+                block.get("Final-Recipient") or block.get("Original-Recipient"))
+            if recipient is None:
+                continue
+            action = (block.get("Action") or "").strip().lower()
+            if action and action not in ("failed", "delayed"):
+                continue
+            status = (block.get("Status") or "").strip()
+            diagnostic = _single_line(block.get("Diagnostic-Code"))
+            records.append((recipient, status, action or "failed", diagnostic))
+    return records
+
+
+def text_body(message):
+    """
+    Decoded text of the first text/plain part of ``message``.
+    """
+    for part in message.walk():
+        if part.get_content_type() == "text/plain":
+            payload = part.get_payload(decode=True)
+            if payload is not None:
+                charset = part.get_content_charset() or "utf-8"
+                return payload.decode(charset, errors="replace")
+    return ""
+
+
+def parse_ndr_text(body):
+    """
+    Records from the text of an Exchange/Outlook NDR. The section after
+    the diagnostic heading lists the failed addresses, each followed by
+    the remote server's reply.
+    """
+    start = -1
+    for heading in DIAGNOSTIC_HEADINGS:
+        start = body.find(heading)
+        if start >= 0:
+            start += len(heading)
+            break
+    if start < 0:
+        return []
+
+    records = []
+    section = body[start:]
+    # Bis zu den Kopfzeilen der Originalnachricht
+    for marker in ("Original message headers:", "Kopfzeilen der Originalnachricht:"):
+        end = section.find(marker)
+        if end >= 0:
+            section = section[:end]
+
+    current = None
+    for line in section.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        # Adresszeilen bestehen nur aus der Adresse (ggf. in < >)
+        address = _address(line)
+        if address and line.strip("<>").lower() == address:
+            if current is not None:
+                records.append(current)
+            current = [address, "", "failed", ""]
+            continue
+        if current is None:
+            continue
+        status = STATUS_PATTERN.search(line)
+        if status and not current[1]:
+            current[1] = status.group(1)
+            current[3] = line.strip("#' ")
+    if current is not None:
+        records.append(current)
+    return [tuple(record) for record in records]
+
+
+def parse_bounce(raw):
+    """
+    Parse one raw message (bytes). Returns a list of BounceRecord, empty
+    if the message is not a bounce.
+    """
+    message = message_from_bytes(raw, policy=compat32)
+    records = parse_dsn(message)
+    if not records:
+        records = parse_ndr_text(text_body(message))
+    message_id = message.get("Message-ID", "")
+    subject = header_text(message.get("Subject", ""))
+    return [BounceRecord(*record, message_id, subject) for record in records]
+
+
+def _parse_batch(batch):
+    records = []
+    for raw in batch:
+        records.extend(parse_bounce(raw))
+    return records
+
+
+def iter_raw_messages(path):
+    """
+    Yield the raw bytes of every message in a Maildir directory or an
+    mbox file, one at a time.
+    """
+    if os.path.isdir(path):
+        box = mailbox.Maildir(path, factory=None, create=False)
+    else:
+        box = mailbox.mbox(path, factory=None, create=False)
+    try:
+        for key in box.iterkeys():
+            yield box.get_bytes(key)
+    finally:
+        box.close()
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def process_mailbox(path, workers=None, batch_size=500, max_pending=None):
+    """
+    Stream all bounce records of a mailbox. Parsing runs in a process
+    pool; at most ``max_pending`` batches (default: twice the number of
+    workers) are in flight, so memory stays bounded.
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for batch in _batches(iter_raw_messages(path), batch_size):
+            pending.add(executor.submit(_parse_batch, batch))
+            if len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+        for future in pending:
+            yield from future.result()
@@ -0,0 +1,165 @@
+"""
+Downscaling of image attachments before sending.
+
+Full-resolution photos attached to a campaign are sent to every
+recipient, so each megabyte saved here is saved thousands of times in
+transport volume and mailbox quota. ImageOptimizer passes JPEG and PNG
+attachments through AnthraScale's ImageProcessor:
+
+    - images with a longer edge than ``max_edge`` are scaled down,
+    - images still larger than ``max_bytes`` are re-encoded with lower
+      JPEG quality and, if that is not enough, scaled down further
+      (PNGs without transparency may become JPEGs),
+    - images that already fit both limits are sent unchanged, and a
+      result that is not smaller than the original is discarded.
+
+Results are cached by the SHA-256 of the file content and the limits,
+in memory and as files in a cache directory, so each distinct image is
+optimized only once, even if it is attached again or the campaign is
+restarted. The cached file is also what Outlook attaches, since
+Attachments.Add only takes a path.
+
+ANTHRASEND_IMAGE_MAX_EDGE (default 2048 pixels) and
+ANTHRASEND_IMAGE_MAX_BYTES (default 1000000) set the limits; 0 disables
+a limit. ANTHRASEND_IMAGE_CACHE sets the cache directory.
+"""
+
+import hashlib
+import mimetypes
+import os
+import tempfile
+from collections import namedtuple
+
+
+OptimizedImage = namedtuple(
+    "OptimizedImage", ["path", "filename", "content_type", "content"])
+
+
+class ImageOptimizer:
+    """
+    Scales image attachments down to ``max_edge`` pixels and
+    ``max_bytes``; None disables a limit.
+    """
+
+    # GIFs (Animationen) und alle anderen Formate bleiben unverändert
+    FORMATS = {"image/jpeg": "JPEG", "image/png": "PNG"}
+    QUALITIES = (85, 75, 65, 55)
+    # Kleiner wird für das Byte-Budget nicht skaliert
+    MIN_EDGE = 640
+
+    def __init__(self, max_edge=2048, max_bytes=1_000_000, cache_dir=None):
+        self.max_edge = max_edge
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir or os.path.join(
+            tempfile.gettempdir(), "anthrasend_images")
+        self._cache = {}
+
+    def optimize(self, filename, content_type, content):
+        """
+        OptimizedImage for an attachment, or None if it is sent
+        unchanged.
+        """
+        if content_type not in self.FORMATS:
+            return None
+        key = (f"{hashlib.sha256(content).hexdigest()}"
+               f"-{self.max_edge or 0}-{self.max_bytes or 0}")
+        if key in self._cache:
+            result = self._cache[key]
+        else:
+            result = (self._cached_file(key)
+                      or self._optimize(key, filename, content_type, content))
+            self._cache[key] = result
+        if result is None:
+            return None
+        # Gleicher Inhalt kann unter verschiedenen Namen angehängt werden
+        return result._replace(filename=os.path.splitext(filename)[0]
+                               + os.path.splitext(result.filename)[1])
+
+    def _cached_file(self, key):
+        directory = os.path.join(self.cache_dir, key)
+        try:
+            names = [name for name in os.listdir(directory)
+                     if not name.endswith(".tmp")]
+        except FileNotFoundError:
+            return None
+        if not names:
+            return None
+        path = os.path.join(directory, names[0])
+        with open(path, "rb") as file:
+            content = file.read()
+        return OptimizedImage(path, names[0], mimetypes.guess_type(path)[0],
+                              content)
+
+    def _optimize(self, key, filename, content_type, content):
+        # Erst hier importieren, damit Kampagnen ohne Bilder kein Qt laden
+        from AnthraScale import ImageProcessor
+
+        image = ImageProcessor.load_image_data(content)
+        if image.isNull():
+            return None
+        too_large = (self.max_edge
+                     and max(image.width(), image.height()) > self.max_edge)
+        over_budget = self.max_bytes and len(content) > self.max_bytes
+        if not too_large and not over_budget:
+            return None
+
+        if self.max_edge:
+            image = ImageProcessor.fit_image(image, self.max_edge)
+        image_format, data = self._encode(image, self.FORMATS[content_type])
+        if len(data) >= len(content):
+            return None
+
+        extension = ".jpg" if image_format == "JPEG" else ".png"
+        if image_format == self.FORMATS[content_type]:
+            # Endung des Originals behalten (.jpeg, .JPG)
+            extension = os.path.splitext(filename)[1] or extension
+        filename = os.path.splitext(filename)[0] + extension
+        directory = os.path.join(self.cache_dir, key)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, filename)
+        with open(path + ".tmp", "wb") as file:
+            file.write(data)
+        os.replace(path + ".tmp", path)
+        return OptimizedImage(path, filename, mimetypes.guess_type(path)[0],
+                              data)
+
+    def _encode(self, image, image_format):
+        """
+        Smallest acceptable encoding: the first one within the byte
+        budget, scaling down by a quarter per round until MIN_EDGE.
+        """
+        from AnthraScale import ImageProcessor
+
+        while True:
+            for candidate in self._candidates(image, image_format):
+                if not self.max_bytes or len(candidate[1]) <= self.max_bytes:
+                    return candidate
+            edge = max(image.width(), image.height())
+            if edge <= self.MIN_EDGE:
+                return candidate
+            image = ImageProcessor.fit_image(
+                image, max(self.MIN_EDGE, edge * 3 // 4))
+
+    def _candidates(self, image, image_format):
+        from AnthraScale import ImageProcessor
+
+        if image_format == "PNG":
+            yield "PNG", ImageProcessor.encode_image(image, "PNG")
+            if image.hasAlphaChannel():
+                return
+            # Fotos als PNG: als JPEG ein Bruchteil der Größe
+        for quality in self.QUALITIES:
+            yield "JPEG", ImageProcessor.encode_image(image, "JPEG", quality)
+
+
+def create_image_optimizer():
+    """
+    ImageOptimizer configured from the environment, or None if both
+    limits are disabled.
+    """
+    max_edge = int(os.environ.get("ANTHRASEND_IMAGE_MAX_EDGE", "2048"))
+    max_bytes = int(os.environ.get("ANTHRASEND_IMAGE_MAX_BYTES", "1000000"))
+    if not max_edge and not max_bytes:
+        return None
+    return ImageOptimizer(max_edge or None, max_bytes or None,
+                          os.environ.get("ANTHRASEND_IMAGE_CACHE"))
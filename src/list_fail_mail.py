@@ -1,10 +1,21 @@
-import win32com.client
+import os
+import sys
 
-# Definieren des Strings, nach dem im Body der E-Mails gesucht werden soll
-search_string = "Unzustellbar:"
+from bounce_classifier import (
+    AUTO_REPLY, HARD_BOUNCE, NOT_BOUNCE, SOFT_BOUNCE, BounceClassifier
+)
+from bounce_parser import parse_ndr_text, process_mailbox
+from mailbox_source import MaildirSource, create_imap_source
+from message_index import MessageIndex
+from suppression_list import create_suppression_list
+
+# Erkennt Rückläufer in DE/EN/FR/NL ("Unzustellbar:", "Undeliverable:", ...)
+classifier = BounceClassifier()
 
 
 def list_undeliverable_emails():
+    import win32com.client
+
     # Verbindung zu Outlook herstellen
     outlook = win32com.client.Dispatch(
         "Outlook.Application").GetNamespace("MAPI")
@@ -16,21 +27,61 @@ def list_undeliverable_emails():
     # Alle Nachrichten im Posteingang durchsuchen
     messages = inbox.Items
     for message in messages:
-        if search_string in message.Subject:
-            print(message)
+        # Erst nur den Betreff prüfen, den Body nur bei Rückläufern laden
+        if classifier.classify(message.Subject, "").kind in (
+                NOT_BOUNCE, AUTO_REPLY):
+            continue
+        body = message.Body
+        if classifier.classify(message.Subject, body).kind == SOFT_BOUNCE:
+            continue
+        for recipient, status, _, _ in parse_ndr_text(body):
+            undeliverable_emails.append((recipient, status))
 
     return undeliverable_emails
 
 
-# Ausführung der Funktion und Ausgabe der Liste
-undelivered_list = list_undeliverable_emails()
+def list_undeliverable_emails_from_mailbox(path):
+    # Maildir-Verzeichnis oder mbox-Datei, z.B. ein Export des Postfachs
+    return [(record.recipient, record.status)
+            for record in process_mailbox(path)]
+
+
+def list_undeliverable_emails_from_index(source, since=None):
+    # IMAP-Postfach oder Maildir: nur neue Nachrichten in den Index
+    # übernehmen, die Abfrage läuft dann lokal
+    index_path = os.environ.get("ANTHRASEND_MAIL_INDEX", "mail_index.sqlite")
+    with source, MessageIndex(index_path) as index:
+        added, removed = index.sync(source)
+        print(f"Index aktualisiert: {added} neu, {removed} entfernt")
+        return index.bounces_since(since, folder=source.folder)
+
+
+if __name__ == "__main__":
+    # Ausführung der Funktion und Ausgabe der Liste
+    source = create_imap_source()
+    if source is None and len(sys.argv) > 1 and os.path.isdir(sys.argv[1]):
+        source = MaildirSource(sys.argv[1])
+    if source is not None:
+        undelivered_list = list_undeliverable_emails_from_index(source)
+    elif len(sys.argv) > 1:
+        undelivered_list = list_undeliverable_emails_from_mailbox(sys.argv[1])
+    else:
+        undelivered_list = list_undeliverable_emails()
 
-# Ausgabe der Anzahl der Rückläufer
-print(f"Anzahl der Rückläufer: {len(undelivered_list)}")
+    # Ausgabe der Anzahl der Rückläufer
+    print(f"Anzahl der Rückläufer: {len(undelivered_list)}")
 
-# Ausgabe der gesammelten E-Mail-Adressen
-print("Liste der E-Mail-Adressen mit Zustellungsfehlern:")
-for email in undelivered_list:
-    print(email)
+    # Endgültige Rückläufer für künftige Kampagnen sperren
+    suppression = create_suppression_list()
+    if suppression is not None:
+        with suppression:
+            added = suppression.add_many(
+                (email, HARD_BOUNCE, f"Rückläufer {status}")
+                for email, status in undelivered_list
+                if not status.startswith("4"))
+        print(f"{added} Adressen neu gesperrt.")
 
-# Denken Sie daran, dass dieses Skript Anpassungen benötigen könnte, abhängig von der genauen Struktur der Rückläufer-Nachrichten in Ihrem Outlook Postfach.
+    # Ausgabe der gesammelten E-Mail-Adressen
+    print("Liste der E-Mail-Adressen mit Zustellungsfehlern:")
+    for email, status in undelivered_list:
+        print(f"{email} ({status})")
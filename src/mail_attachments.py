@@ -0,0 +1,145 @@
+"""
+Attachments shared by all messages of a campaign.
+
+Every recipient of a campaign gets the same files. SharedAttachment
+reads, base64-encodes and line-wraps a file once and keeps the finished
+MIME part (headers and body, CRLF line ends) as one bytes object.
+SharedPartsMessage combines the personalized text part of a recipient
+with references to these parts, so building a message costs the same
+with a 10 MB attachment as without one:
+
+    - ``chunks()`` yields the message piece by piece; the shared parts
+      are yielded as the same bytes objects for every message and sent
+      with ``socket.sendall`` without being copied or joined
+      (SmtpTransport streams them in the SMTP DATA phase),
+    - ``as_bytes()`` joins the pieces, e.g. for the spool.
+
+ANTHRASEND_ATTACHMENTS lists the files of a campaign, separated by
+os.pathsep (';' on Windows); see create_attachments. Image attachments
+are downscaled first (image_optimizer.py).
+"""
+
+import base64
+import mimetypes
+import os
+import re
+from email.policy import compat32
+from email.utils import encode_rfc2231
+
+from image_optimizer import create_image_optimizer
+
+
+# RFC 2045: höchstens 76 Zeichen je Base64-Zeile
+_LINE_LENGTH = 76
+_CRLF_POLICY = compat32.clone(linesep="\r\n")
+
+
+def _parameter(name, value):
+    if value.isascii() and '"' not in value and "\\" not in value:
+        return f'{name}="{value}"'
+    # Nicht-ASCII-Dateinamen nach RFC 2231
+    return f"{name}*={encode_rfc2231(value, 'utf-8')}"
+
+
+class SharedAttachment:
+    """
+    A file encoded once as a complete MIME part. With an ``optimizer``
+    (image_optimizer.ImageOptimizer) images are downscaled before
+    encoding; ``path`` then refers to the downscaled copy.
+    """
+
+    def __init__(self, path, content_type=None, filename=None,
+                 optimizer=None):
+        self.path = os.path.abspath(path)
+        self.filename = filename or os.path.basename(path)
+        self.content_type = (content_type
+                             or mimetypes.guess_type(self.filename)[0]
+                             or "application/octet-stream")
+        with open(path, "rb") as file:
+            content = file.read()
+        self.original_size = len(content)
+        if optimizer is not None:
+            optimized = optimizer.optimize(
+                self.filename, self.content_type, content)
+            if optimized is not None:
+                self.path, self.filename, self.content_type, content = (
+                    optimized)
+        self.size = len(content)
+
+        encoded = base64.b64encode(content)
+        lines = [encoded[start:start + _LINE_LENGTH]
+                 for start in range(0, len(encoded), _LINE_LENGTH)]
+        headers = (
+            f"Content-Type: {self.content_type}; "
+            f"{_parameter('name', self.filename)}\r\n"
+            f"Content-Transfer-Encoding: base64\r\n"
+            f"Content-Disposition: attachment; "
+            f"{_parameter('filename', self.filename)}\r\n\r\n"
+        ).encode("ascii")
+        # Base64-Zeilen beginnen nie mit '.', der Teil braucht für SMTP
+        # also kein Dot-Stuffing
+        self.data = headers + b"\r\n".join(lines)
+
+    def __repr__(self):
+        return f"SharedAttachment({self.filename!r}, {self.size} bytes)"
+
+
+class SharedPartsMessage:
+    """
+    multipart/mixed message of a personalized part and shared attachment
+    parts. ``message`` is the multipart container holding the text part
+    and all headers; the attachments are only referenced.
+    """
+
+    _DOT_LINES = re.compile(rb"(?m)^\.")
+
+    def __init__(self, message, attachments, subject, body):
+        self.message = message
+        self.attachments = tuple(attachments)
+        # Für Transporte ohne MIME-Unterstützung (Outlook)
+        self.subject = subject
+        self.body = body
+
+    def __getitem__(self, name):
+        return self.message[name]
+
+    def chunks(self, dot_stuffed=False):
+        """
+        Yield the message in wire format (CRLF line ends). With
+        ``dot_stuffed`` the personalized part is prepared for the SMTP
+        DATA phase.
+        """
+        boundary = self.message.get_boundary().encode("ascii")
+        close = b"--" + boundary + b"--\r\n"
+        head = self.message.as_bytes(policy=_CRLF_POLICY)
+        if not head.endswith(close):
+            raise ValueError("Unexpected end of multipart message")
+        head = head[:-len(close)]
+        if dot_stuffed:
+            head = self._DOT_LINES.sub(b"..", head)
+        yield head
+        for attachment in self.attachments:
+            yield b"--" + boundary + b"\r\n"
+            yield attachment.data
+            yield b"\r\n"
+        yield close
+
+    def as_bytes(self):
+        return b"".join(self.chunks())
+
+
+def load_attachments(paths, optimizer=None):
+    return tuple(SharedAttachment(path, optimizer=optimizer)
+                 for path in paths if path)
+
+
+def create_attachments():
+    """
+    SharedAttachments for the files listed in ANTHRASEND_ATTACHMENTS,
+    read, downscaled and encoded once; empty if the variable is not set.
+    """
+    paths = [path for path in os.environ.get(
+        "ANTHRASEND_ATTACHMENTS", "").split(os.pathsep) if path]
+    if not paths:
+        return ()
+    return load_attachments(paths, create_image_optimizer())
@@ -0,0 +1,1070 @@
+"""
+Benchmarks for the AnthraSend mail pipeline.
+
+Usage:
+    python mail_benchmark.py prep --rows 100000
+    python mail_benchmark.py workbook --rows 100000 --output Mappe_100k.xlsx
+    python mail_benchmark.py e2e --rows 10000 --transport outlook \
+        --latency 0.005 --failure-rate 0.01
+    python mail_benchmark.py e2e --rows 10000 --transport smtp
+    python mail_benchmark.py e2e --rows 10000 --transport smtp --bcc-max 100
+    python mail_benchmark.py e2e --rows 10000 --transport smtp \
+        --accounts 4 --sink-latency 0.05
+    python mail_benchmark.py inbox --messages 10000 --latency 0.02
+
+'prep' compares the original generate_emails of AnthraSend3.py
+(``iterrows`` with one language/salutation lookup per row, kept here
+unchanged) with the columnar preparation from recipient_prep.py on a
+synthetic recipient table. 'workbook' writes such a table as Excel file (1k to 1M rows,
+streamed, so memory stays flat).
+
+'e2e' runs the complete pipelines from workbook to transport:
+
+    batch   AnthraSend.py: read the whole workbook, render everything,
+            then send with its send_emails,
+    stream  AnthraSend3.py: read, render and send chunk by chunk with its
+            stream_emails and MailSender,
+    spool   render into an offline spool, then drain it (mail_spool.py).
+
+The transport is either FakeOutlook, a stand-in for the
+``Outlook.Application`` COM object with configurable latency and failure
+injection, or SMTP against a local sink (aiosmtpd, started in-process).
+Each pipeline runs in its own process; the report lists messages/s,
+render and send time, transport calls, p50/p95/p99 send latency and
+peak memory. With
+``--bcc-max`` identical mails are combined (bcc_fanout.py); 'gesendet'
+and messages/s then count recipients, the latencies transport calls.
+With ``--accounts N`` the SMTP run starts N sinks and spreads the mails
+over N sender accounts (sharded_transport.py), each with its own pool of
+``--concurrency`` connections; ``--sink-latency`` makes the sinks answer
+as slowly as a real server, so the scaling with the number of accounts
+becomes visible.
+
+'inbox' writes a synthetic Maildir with bounces and auto-replies, serves
+it with ImapStandIn (a minimal local IMAP server) and scans it with
+ImapSource twice: downloading every message as the old inbox scripts
+did, and header-first with server-side SEARCH (find_bounces), each
+without and with pipelined FETCH batches. The report lists the bounces
+found, commands, KiB sent by the server and time.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import email.utils
+import mailbox
+import multiprocessing
+import os
+import queue
+import random
+import re
+import shutil
+import socketserver
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from email import message_from_bytes
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+
+import pandas as pd
+
+from bounce_parser import header_text, parse_bounce
+from mail_spool import drain_spool, render_to_spool
+from mail_transport import (
+    OutlookTransport, SmtpConnectionPool, SmtpTransport
+)
+from mailbox_source import ImapSource, find_bounces
+from recipient_prep import prepare_recipients, render_in_order
+from recipient_source import RecipientSnapshotCache
+from send_journal import create_send_journal
+from sharded_transport import Account, ShardedTransport
+from template_catalog import STORE_MANAGER_MARKER, TemplateCatalog
+
+try:
+    import resource
+except ImportError:
+    # Windows: kein Spitzenspeicher verfügbar
+    resource = None
+
+
+FIRST_NAMES = ["Anna", "Lukas", "Marie", "Jan", "Sophie", "Thomas",
+               "Claire", "Pierre", "Emma", "Daan", "Lotte", "Noah"]
+LANGUAGES = ["DE", "DE", "DE", "EN", "FR", "NL", "de", " fr "]
+SALUTATIONS = ["MR", "MS", "MX", "", "mr"]
+COLUMNS = ["Benutzername", "Anrede", "Nachname", "Vorname", "Sprache"]
+
+
+def iter_recipient_rows(rows, seed=0, dirty=0.0):
+    """
+    Rows of a synthetic recipient table with the columns of Mappe2.xlsx
+    and a mix of languages, salutations and French store managers. A
+    ``dirty`` fraction of the addresses is repeated in other case or
+    malformed, as in real exports.
+    """
+    rng = random.Random(seed)
+    for i in range(rows):
+        language = rng.choice(LANGUAGES)
+        if language.strip().upper() == "FR" and rng.random() < 0.1:
+            first_name = f"{STORE_MANAGER_MARKER} {i}"
+        else:
+            first_name = rng.choice(FIRST_NAMES)
+        address = f"user{i}@example.com"
+        if dirty and rng.random() < dirty:
+            address = (f" User{rng.randrange(i)}@Example.COM " if i
+                       and rng.random() < 0.8 else f"user{i}@@example")
+        yield (address, rng.choice(SALUTATIONS), f"Nachname{i}",
+               first_name, language)
+
+
+def make_recipient_frame(rows, seed=0, dirty=0.0):
+    return pd.DataFrame.from_records(
+        list(iter_recipient_rows(rows, seed, dirty)), columns=COLUMNS)
+
+
+def write_workbook(path, rows, seed=0, dirty=0.0):
+    """
+    Write a synthetic recipient workbook row by row (openpyxl write-only
+    mode), so even 1M rows need little memory.
+    """
+    import openpyxl
+
+    workbook = openpyxl.Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    worksheet.append(COLUMNS)
+    for row in iter_recipient_rows(rows, seed, dirty):
+        worksheet.append(row)
+    workbook.save(path)
+
+
+# Bis "rowwise_generate": Klassen aus AnthraSend3.py vor der spaltenweisen
+# Aufbereitung, unverändert übernommen
+class Email:
+    def __init__(self, to_email, subject, body):
+        self.to_email = to_email
+        self.subject = subject
+        self.body = body
+
+
+class User:
+    def __init__(self, username, firstname, language, salutation):
+        self.username = username
+        self.firstname = firstname
+        self.language = language
+        self.salutation = salutation
+
+
+class BaselineContentGenerator:
+    """
+    EmailContentGenerator of AnthraSend3.py before the columnar
+    preparation, unchanged: the reference for 'prep'.
+    """
+
+    SALUTATIONS = {
+        'MR': {'DE': "Lieber", 'EN': "Dear", 'FR': "Cher", 'NL': "Beste"},
+        'MS': {'DE': "Liebe", 'EN': "Dear", 'FR': "Chère", 'NL': "Beste"},
+        'MX': {'DE': "Liebe(r)", 'EN': "Dear", 'FR': "Cher(e)", 'NL': "Beste"},
+    }
+
+    def create_email_content(self, user: User):
+        anrede_text = self.SALUTATIONS.get(
+            user.salutation, self.SALUTATIONS['MX'])
+        subject, body = self._get_localized_content(
+            user.language, anrede_text[user.language], user.firstname)
+        return Email(user.username, subject, body)
+
+    def _get_localized_content(self, language, salutation_text, vorname):
+        # Gemeinsame URL für alle Sprachen in einer Variablen halten
+        current_url = ">>> job.takko.com <<<"
+        planned_change_date = "08.03.2024"
+        common_info = (
+            f"die für den {planned_change_date} angesetzt war, vorerst aufgeschoben wird. Es wird keine Änderung geben, "
+            "bis weitere Informationen bereitgestellt werden.\n\n"
+            f"Bitte verwendet weiterhin die aktuelle URL {current_url} für den Zugriff auf d.vinci."
+        )
+
+        body_texts = {
+            'DE': (
+                f"{salutation_text} {vorname},\n\n"
+                f"ich möchte euch darüber informieren, dass {common_info} Ich entschuldige mich "
+                "für die Unannehmlichkeiten und danke euch für euer Verständnis und eure Flexibilität.\n\n"
+                "Für Rückfragen stehe ich euch gerne zur Verfügung.\n\n"
+                "Mit freundlichen Grüßen,\nHendrik Siemens"
+            ),
+            'EN': (
+                f"{salutation_text} {vorname},\n\n"
+                "I wish to inform you that the planned change of the URL from [job.takko.com] to [application.takko.com], which was "
+                f"scheduled for {planned_change_date}, has been postponed until further notice. "
+                f"Please continue to use the current URL {current_url} to access d.vinci. I apologize for any inconvenience and "
+                "thank you for your understanding and flexibility.\n\n"
+                "Should you have any questions, please do not hesitate to contact me.\n\n"
+                "Kind regards,\nHendrik Siemens"
+            ),
+            'FR': (
+                f"{salutation_text} {vorname},\n\n"
+                "je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour "
+                f"le {planned_change_date}, est reportée jusqu'à nouvel ordre. "
+                f"Veuillez donc continuer à utiliser l'URL actuelle {current_url} pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
+                "vous remercie de votre compréhension et de votre flexibilité.\n\n"
+                "En cas de questions, n'hésitez pas à me contacter.\n\n"
+                "Cordialement,\nHendrik Siemens"
+            ),
+            'NL': (
+                f"{salutation_text} {vorname},\n\n"
+                "Ik wil jullie informeren dat de geplande wijziging van de URL van [job.takko.com] naar [application.takko.com], die gepland stond voor "
+                f"{planned_change_date}, voorlopig is uitgesteld. Er worden geen wijzigingen aangebracht tot nadere informatie beschikbaar is.\n\n"
+                f"Gelieve de huidige URL {current_url} te blijven gebruiken om toegang te krijgen tot d.vinci. Mijn excuses voor eventuele overlast en "
+                "dank voor uw begrip en flexibilitet.\n\n"
+                "Als u vragen heeft, neem dan gerust contact met mij op.\n\n"
+                "Met vriendelijke groet,\nHendrik Siemens"
+            )
+        }
+
+        subject_texts = {
+            'DE': "Dringend: Aufschub der geplanten Änderung der URL für d.vinci",
+            'EN': "Urgent: Postponement of the Planned URL Change for d.vinci",
+            'FR': "Urgent: Report de la modification prévue de l'URL pour d.vinci",
+            'NL': "Dringend: Uitstel van de geplande URL-wijziging voor d.vinci"
+        }
+
+        if language not in subject_texts or language not in body_texts:
+            raise ValueError("Unsupported language")
+
+        if language == 'FR' and "Responsable de magasin" in vorname:
+            body_texts['FR'] = (
+                "Bonjour à tous,\n\n"
+                "Je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], "
+                f"prévue pour le {planned_change_date}, est reportée jusqu'à nouvel ordre. {common_info} "
+                "Je m'excuse pour les désagréments causés et vous remercie de votre compréhension et de votre flexibilité.\n\n"
+                "En cas de questions, n'hésitez pas à me contacter.\n\n"
+                "Cordialement,\nHendrik Siemens"
+            )
+
+        subject = subject_texts[language]
+        body = body_texts[language]
+
+        return subject, body
+
+
+def rowwise_generate(df):
+    """
+    Reference implementation: generate_emails of AnthraSend3.py before
+    the columnar preparation, one row at a time via iterrows.
+    """
+    content_generator = BaselineContentGenerator()
+    emails = []
+    for _, row in df.iterrows():
+        user = User(
+            row['Benutzername'],
+            row['Vorname'],
+            row['Sprache'].upper(),
+            row['Anrede']
+        )
+        email = content_generator.create_email_content(user)
+        emails.append((email.to_email, email.subject, email.body))
+    return emails
+
+
+def columnar_generate(df, catalog):
+    prepared = prepare_recipients(df, catalog)
+    return render_in_order(prepared, catalog)
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_prep(rows, seed=0):
+    catalog = TemplateCatalog.default()
+    df = make_recipient_frame(rows, seed)
+    # Die alte Fassung bricht bei Leerzeichen um die Sprache ab (" fr ")
+    df["Sprache"] = df["Sprache"].str.strip()
+
+    rowwise, rowwise_time = _timed(rowwise_generate, df)
+    columnar, columnar_time = _timed(columnar_generate, df, catalog)
+
+    print(f"Zeilen:         {rows}")
+    print(f"iterrows:       {rowwise_time:8.3f} s "
+          f"({rows / rowwise_time:,.0f} Zeilen/s)")
+    print(f"spaltenweise:   {columnar_time:8.3f} s "
+          f"({rows / columnar_time:,.0f} Zeilen/s)")
+    print(f"Faktor:         {rowwise_time / columnar_time:8.1f}x")
+    # Unterschiede nur durch die normalisierte Anrede ('mr' -> 'MR')
+    changed = sum(a != b for a, b in zip(rowwise, columnar))
+    print(f"Abweichungen:   {changed} (normalisierte Anrede)")
+
+
+class FakeMailItem:
+    """
+    Stand-in for an Outlook MailItem: ``To``, ``Subject``, ``Body`` and
+    ``Send()``.
+    """
+
+    def __init__(self, application):
+        self._application = application
+        self.To = ""
+        self.Subject = ""
+        self.Body = ""
+
+    def Send(self):
+        self._application._send(self)
+
+
+class FakeOutlook:
+    """
+    Stand-in for the ``Outlook.Application`` COM object. Every Send()
+    blocks for about ``latency`` seconds (uniformly ±50%) and fails with
+    probability ``failure_rate``. Like a COM object without marshalling
+    it can only be used on the thread that created it.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = 0
+        self._rng = random.Random(seed)
+        self._thread = threading.get_ident()
+
+    def _check_thread(self):
+        if threading.get_ident() != self._thread:
+            # Wie pywintypes.com_error mit RPC_E_WRONG_THREAD
+            raise RuntimeError(
+                "(-2147417842, 'Die Anwendung hat eine Schnittstelle "
+                "aufgerufen, die für einen anderen Thread gemarshallt war.', "
+                "None, None)")
+
+    def CreateItem(self, item_type):
+        self._check_thread()
+        if item_type != 0:
+            raise ValueError("Only olMailItem (0) is supported")
+        return FakeMailItem(self)
+
+    def _send(self, item):
+        self._check_thread()
+        if self.latency:
+            time.sleep(self.latency * self._rng.uniform(0.5, 1.5))
+        if self._rng.random() < self.failure_rate:
+            # Wie pywintypes.com_error aus Outlook
+            raise RuntimeError(
+                f"(-2147467259, 'Unbekannter Fehler', {item.To!r})")
+        self.sent += 1
+
+
+class ImapStandIn:
+    """
+    Local IMAP4rev1 server over a Maildir with just what ImapSource uses:
+    LOGIN, EXAMINE/SELECT, UID SEARCH (ALL, SINCE, UID, SUBJECT, FROM, OR,
+    lists) and UID FETCH (UID, RFC822.SIZE, BODYSTRUCTURE, BODY[...]).
+    Every command is answered ``latency`` seconds after it arrived, as
+    over a slow network; pipelined commands wait concurrently. Counts
+    commands, bytes sent and the most commands seen in flight.
+    """
+
+    def __init__(self, path, host="127.0.0.1", port=8143, latency=0.0):
+        self.latency = latency
+        self.maildir = mailbox.Maildir(path, factory=None, create=False)
+        self.keys = sorted(self.maildir.keys())
+        self._search_fields = [
+            self._search_info(self.maildir.get_bytes(key))
+            for key in self.keys]
+        self._lock = threading.Lock()
+        self.reset()
+        stand_in = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                stand_in._serve(self.rfile, self.wfile)
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+        self.host, self.port = self.server.server_address
+
+    def reset(self):
+        self.commands = 0
+        self.bytes_sent = 0
+        self.max_in_flight = 0
+
+    @staticmethod
+    def _search_info(raw):
+        headers = BytesHeaderParser(policy=compat32).parsebytes(raw)
+        try:
+            date = email.utils.parsedate_to_datetime(headers["Date"]).date()
+        except (TypeError, ValueError):
+            date = datetime.date.min
+        return (header_text(headers.get("Subject", "")).lower(),
+                header_text(headers.get("From", "")).lower(), date)
+
+    def _serve(self, rfile, wfile):
+        lines = queue.Queue()
+
+        def receive():
+            for line in rfile:
+                lines.put((time.monotonic(), line))
+            lines.put((None, None))
+
+        threading.Thread(target=receive, daemon=True).start()
+        self._send(wfile, b"* OK [CAPABILITY IMAP4rev1] ImapStandIn bereit\r\n")
+        while True:
+            received, line = lines.get()
+            if line is None:
+                return
+            delay = received + self.latency - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                self.commands += 1
+                self.max_in_flight = max(self.max_in_flight, lines.qsize() + 1)
+            tag, _, command = line.decode("utf-8").strip().partition(" ")
+            name, _, arguments = command.partition(" ")
+            name = name.upper()
+            if name == "UID":
+                name, _, arguments = arguments.partition(" ")
+                name = "UID " + name.upper()
+            try:
+                reply = self._reply(name, arguments)
+            except (LookupError, ValueError) as error:
+                reply = [], f"BAD {error}"
+            untagged, result = reply
+            self._send(wfile, b"".join(untagged)
+                       + f"{tag} {result}\r\n".encode())
+            if name == "LOGOUT":
+                return
+
+    def _send(self, wfile, data):
+        wfile.write(data)
+        wfile.flush()
+        with self._lock:
+            self.bytes_sent += len(data)
+
+    def _reply(self, name, arguments):
+        if name == "CAPABILITY":
+            return [b"* CAPABILITY IMAP4rev1\r\n"], "OK CAPABILITY completed"
+        if name in ("LOGIN", "NOOP"):
+            return [], f"OK {name} completed"
+        if name in ("SELECT", "EXAMINE"):
+            count = len(self.keys)
+            mode = "READ-ONLY" if name == "EXAMINE" else "READ-WRITE"
+            return [f"* {count} EXISTS\r\n* 0 RECENT\r\n"
+                    f"* OK [UIDVALIDITY 1]\r\n"
+                    f"* OK [UIDNEXT {count + 1}]\r\n".encode()], \
+                f"OK [{mode}] {name} completed"
+        if name == "LOGOUT":
+            return [b"* BYE\r\n"], "OK LOGOUT completed"
+        if name == "UID SEARCH":
+            criteria = _imap_list(arguments)
+            uids = [str(uid) for uid in range(1, len(self.keys) + 1)
+                    if _imap_matches(criteria, uid, self._search_fields[uid - 1],
+                                     len(self.keys))]
+            return [f"* SEARCH {' '.join(uids)}\r\n".encode()], \
+                "OK SEARCH completed"
+        if name == "UID FETCH":
+            uid_set, _, items = arguments.partition(" ")
+            wanted = _imap_uid_set(uid_set, len(self.keys))
+            return [self._fetch_response(uid, items)
+                    for uid in range(1, len(self.keys) + 1)
+                    if uid in wanted], "OK FETCH completed"
+        raise ValueError(f"unsupported command {name}")
+
+    def _fetch_response(self, uid, items):
+        raw = self.maildir.get_bytes(self.keys[uid - 1])
+        items = items.upper()
+        fields = [f"UID {uid}"]
+        if "RFC822.SIZE" in items:
+            fields.append(f"RFC822.SIZE {len(raw)}")
+        if "BODYSTRUCTURE" in items:
+            fields.append("BODYSTRUCTURE " + _imap_bodystructure(
+                message_from_bytes(raw, policy=compat32)))
+        literal = b""
+        section = re.search(r"BODY(?:\.PEEK)?\[([^\]]*)\]", items)
+        if section is not None:
+            data = _imap_section(raw, section.group(1))
+            fields.append(f"BODY[{section.group(1)}] {{{len(data)}}}")
+            literal = b"\r\n" + data
+        return (f"* {uid} FETCH (" + " ".join(fields)).encode() \
+            + literal + b")\r\n"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+        self.maildir.close()
+
+
+_IMAP_TOKEN = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+
+
+def _imap_list(text):
+    """
+    Nested lists of atoms and (unquoted) strings from IMAP arguments.
+    """
+    stack = [[]]
+    for token in _IMAP_TOKEN.findall(text):
+        if token == "(":
+            stack.append([])
+        elif token == ")":
+            done = stack.pop()
+            stack[-1].append(done)
+        elif token.startswith('"'):
+            stack[-1].append(re.sub(r"\\(.)", r"\1", token[1:-1]))
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def _imap_uid_set(text, highest):
+    uids = set()
+    for part in text.split(","):
+        first, _, last = part.partition(":")
+        first = highest if first == "*" else int(first)
+        last = first if not last else highest if last == "*" else int(last)
+        uids.update(range(min(first, last), max(first, last) + 1))
+    return uids
+
+
+def _imap_matches(criteria, uid, fields, highest):
+    items = iter(criteria)
+    # Alle Kriterien auswerten, auch OR-Zweige verbrauchen ihre Argumente
+    results = [_imap_criterion(key, items, uid, fields, highest)
+               for key in items]
+    return all(results)
+
+
+def _imap_criterion(key, items, uid, fields, highest):
+    subject, sender, date = fields
+    if isinstance(key, list):
+        return _imap_matches(key, uid, fields, highest)
+    key = key.upper()
+    if key == "ALL":
+        return True
+    if key == "OR":
+        first = _imap_criterion(next(items), items, uid, fields, highest)
+        second = _imap_criterion(next(items), items, uid, fields, highest)
+        return first or second
+    if key == "SUBJECT":
+        return next(items).lower() in subject
+    if key == "FROM":
+        return next(items).lower() in sender
+    if key == "SINCE":
+        return date >= datetime.datetime.strptime(
+            next(items), "%d-%b-%Y").date()
+    if key == "UID":
+        return uid in _imap_uid_set(next(items), highest)
+    raise ValueError(f"unsupported search key {key}")
+
+
+def _imap_bodystructure(message):
+    if message.is_multipart():
+        parts = "".join(
+            _imap_bodystructure(part) for part in message.get_payload())
+        return f'({parts} "{message.get_content_subtype().upper()}")'
+    payload = message.get_payload()
+    return (f'("{message.get_content_maintype().upper()}" '
+            f'"{message.get_content_subtype().upper()}" NIL NIL NIL "7BIT" '
+            f'{len(payload) if isinstance(payload, str) else 0})')
+
+
+def _imap_section(raw, section):
+    if not section:
+        return raw
+    end = raw.find(b"\n\n")
+    crlf_end = raw.find(b"\r\n\r\n")
+    if crlf_end >= 0 and (end < 0 or crlf_end < end):
+        head = raw[:crlf_end + 2]
+    else:
+        head = raw[:end + 1] if end >= 0 else raw
+    if section == "HEADER":
+        return head + b"\r\n"
+    fields = re.match(r"HEADER\.FIELDS \(([^)]*)\)", section)
+    if fields is None:
+        raise ValueError(f"unsupported section {section}")
+    names = {name.encode() for name in fields.group(1).split()}
+    lines = []
+    keep = False
+    for line in head.splitlines(keepends=True):
+        if line[:1] not in (b" ", b"\t"):
+            keep = line.split(b":", 1)[0].strip().upper() in names
+        if keep:
+            lines.append(line)
+    return b"".join(lines) + b"\r\n"
+
+
+class SmtpSink:
+    """
+    Local SMTP server that accepts and counts all messages. Needs
+    aiosmtpd (``pip install aiosmtpd``), imported only when used.
+    """
+
+    def __init__(self, host="127.0.0.1", port=8025, latency=0.0):
+        from aiosmtpd.controller import Controller
+
+        self.received = 0
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.controller = Controller(self, hostname=host, port=port)
+        self.host = host
+        self.port = port
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        with self._lock:
+            self.received += len(envelope.rcpt_tos)
+        return "250 OK"
+
+    def __enter__(self):
+        self.controller.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.controller.stop()
+
+
+_DSN = """\
+From: Mail Delivery System <MAILER-DAEMON@mx.example.com>
+To: benchmark@localhost
+Subject: Undelivered Mail Returned to Sender
+Date: {date}
+Message-ID: <dsn{number}@mx.example.com>
+MIME-Version: 1.0
+Auto-Submitted: auto-replied
+Content-Type: multipart/report; report-type=delivery-status; boundary="b{number}"
+
+--b{number}
+Content-Type: text/plain; charset=us-ascii
+
+The mail could not be delivered to {recipient}.
+
+--b{number}
+Content-Type: message/delivery-status
+
+Reporting-MTA: dns; mx.example.com
+
+Final-Recipient: rfc822; {recipient}
+Action: failed
+Status: 5.1.1
+Diagnostic-Code: smtp; 550 5.1.1 user unknown
+
+--b{number}--
+"""
+
+_NDR = """\
+From: Microsoft Outlook <postmaster@example.com>
+To: benchmark@localhost
+Subject: =?utf-8?q?Unzustellbar=3A_Aufschub_der_=C3=84nderung?=
+Date: {date}
+Message-ID: <ndr{number}@example.com>
+MIME-Version: 1.0
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: 8bit
+
+Ihre Nachricht konnte nicht zugestellt werden.
+
+Diagnoseinformationen für Administratoren:
+
+Generierender Server: mail.example.com
+
+{recipient}
+Remote Server returned '550 5.1.1 RESOLVER.ADR.RecipNotFound; not found'
+
+Kopfzeilen der Originalnachricht:
+
+Subject: Aufschub
+"""
+
+_MAIL = """\
+From: {sender}
+To: benchmark@localhost
+Subject: {subject}
+Date: {date}
+Message-ID: <mail{number}@example.com>
+MIME-Version: 1.0
+Content-Type: text/plain; charset=utf-8
+Content-Transfer-Encoding: 8bit
+{extra}
+{body}
+"""
+
+
+def write_inbox(path, messages, bounce_rate=0.02, body_kib=20, seed=0):
+    """
+    Maildir with ``messages`` synthetic mails: ordinary mails of about
+    ``body_kib`` KiB, 1% RFC 2047 encoded auto-replies and bounces at
+    ``bounce_rate`` (half RFC 3464 reports, half Exchange NDRs). Returns
+    the number of bounced recipients.
+    """
+    rng = random.Random(seed)
+    maildir = mailbox.Maildir(path, create=True)
+    filler = "Vielen Dank für die Information zur Umstellung. " * 21 + "\n"
+    start = time.time() - messages * 60
+    bounced = 0
+    for number in range(messages):
+        values = {"number": number,
+                  "date": email.utils.formatdate(start + number * 60),
+                  "recipient": f"empfaenger{number}@example.com"}
+        roll = rng.random()
+        if roll < bounce_rate:
+            template = _DSN if roll < bounce_rate / 2 else _NDR
+            text = template.format(**values)
+            bounced += 1
+        elif roll < bounce_rate + 0.01:
+            text = _MAIL.format(
+                sender=f"Kollege {number} <kollege{number}@example.com>",
+                subject="=?utf-8?q?R=C3=A9ponse_automatique=3A?= Aufschub",
+                extra="Auto-Submitted: auto-replied\n",
+                body="Je suis absent jusqu'au lundi.", **values)
+        else:
+            kib = max(1, round(body_kib * rng.uniform(0.5, 1.5)))
+            text = _MAIL.format(
+                sender=f"Kollege {number} <kollege{number}@example.com>",
+                subject=f"Re: Aufschub der URL-Umstellung ({number})",
+                extra="", body=filler * kib, **values)
+        maildir.add(text.encode("utf-8"))
+    maildir.close()
+    return bounced
+
+
+def _full_scan(source):
+    # Wie die alten Posteingangs-Skripte: jede Nachricht komplett laden
+    records = []
+    for _, raw in source.fetch_messages(source.search()):
+        records.extend(parse_bounce(raw))
+    return records
+
+
+def benchmark_inbox(messages, bounce_rate=0.02, body_kib=20, latency=0.0,
+                    port=8143, seed=0):
+    directory = tempfile.mkdtemp(prefix="anthrasend_inbox_")
+    try:
+        path = os.path.join(directory, "INBOX")
+        start = time.perf_counter()
+        bounced = write_inbox(path, messages, bounce_rate, body_kib, seed)
+        print(f"Postfach mit {messages} Nachrichten, {bounced} Rückläufern "
+              f"erzeugt ({time.perf_counter() - start:.1f} s)")
+        # Gleicher Abruf ohne und mit Pipelining der FETCH-Stapel
+        runs = [(name, scan, depth)
+                for name, scan in (
+                    ("komplett", _full_scan),
+                    ("kopf", lambda source: list(find_bounces(source))))
+                for depth in (1, 4)]
+        print(f"{'Abruf':<9} {'Tiefe':>5} {'Rückläufer':>10} {'Befehle':>8} "
+              f"{'KiB':>10} {'max. parallel':>13} {'Zeit':>8}")
+        with ImapStandIn(path, port=port, latency=latency) as server:
+            for name, scan, depth in runs:
+                server.reset()
+                start = time.perf_counter()
+                with ImapSource(server.host, "benchmark", "geheim",
+                                port=server.port, use_ssl=False,
+                                pipeline_depth=depth) as source:
+                    records = scan(source)
+                elapsed = time.perf_counter() - start
+                print(f"{name:<9} {depth:>5} {len(records):>10} "
+                      f"{server.commands:>8} "
+                      f"{server.bytes_sent / 1024:>10.0f} "
+                      f"{server.max_in_flight:>13} {elapsed:>7.2f}s")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _create_transport(spec):
+    kind, options = spec
+    if kind == "outlook":
+        return OutlookTransport(outlook=FakeOutlook(**options))
+    if kind == "sharded":
+        accounts = [
+            Account(f"konto{number}", SmtpTransport(
+                f"benchmark{number}@localhost",
+                SmtpConnectionPool(host, port, size=options["pool_size"])))
+            for number, (host, port) in enumerate(options["sinks"], 1)]
+        return ShardedTransport(accounts, options["strategy"])
+    pool = SmtpConnectionPool(
+        options["host"], options["port"], size=options["pool_size"])
+    return SmtpTransport("benchmark@localhost", pool)
+
+
+def _timed_iter(items, timings):
+    """
+    Pass ``items`` through and add the time spent producing them (read
+    and render) to ``timings["render"]``.
+    """
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            timings["render"] += time.perf_counter() - start
+            return
+        timings["render"] += time.perf_counter() - start
+        yield item
+
+
+def _instrument(transport, latencies):
+    # Dauer jedes einzelnen Transportaufrufs (inkl. Wartezeit im Pool)
+    for name in ("send", "send_message", "send_bcc"):
+        method = getattr(transport, name)
+
+        def timed(*args, _method=method):
+            start = time.perf_counter()
+            try:
+                return _method(*args)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        setattr(transport, name, timed)
+
+
+def _send_batch(workbook, transport, journal, timings):
+    """
+    AnthraSend.py: read the whole workbook, render everything, then send
+    with its send_emails (progress bar on the offscreen Qt platform).
+    Returns ``(sent, failed)``.
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt5.QtWidgets import QApplication
+    import AnthraSend
+
+    # Der Fehlerdialog am Ende würde auf einen Klick warten
+    AnthraSend.display_error_summary = lambda failures: None
+    app = QApplication.instance() or QApplication([])
+    start = time.perf_counter()
+    emails = AnthraSend.generate_emails(AnthraSend.read_email_data(workbook))
+    timings["render"] = time.perf_counter() - start
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        sent, failed = AnthraSend.send_emails(emails, transport, journal)
+    del app
+    return sent, len(failed)
+
+
+def _send_stream(workbook, cache, transport, journal, timings):
+    """
+    AnthraSend3.py: read, render and send chunk by chunk with its
+    stream_emails and MailSender, as SendWorker does. The workbook is
+    read for the first time, so the recipient snapshot is written into
+    ``cache`` on the way. Returns ``(sent, failed)``.
+    """
+    import AnthraSend3
+
+    catalog = AnthraSend3.EmailContentGenerator().catalog
+    emails = _timed_iter(
+        AnthraSend3.stream_emails(workbook, [], cache, catalog), timings)
+    emails = journal.track(emails, key=lambda email: email.to_email)
+    sent = failed = 0
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for email, e in AnthraSend3.MailSender(transport).send_emails(emails):
+            journal.record(email.to_email, e)
+            sent += e is None
+            failed += e is not None
+    return sent, failed
+
+
+def _run_pipeline(pipeline, workbook, transport_spec, results):
+    """
+    Run one pipeline (in a child process) and put its measurements into
+    the ``results`` queue.
+    """
+    transport = _create_transport(transport_spec)
+    latencies = []
+    _instrument(transport, latencies)
+    timings = {"render": 0.0}
+    sent = failed = 0
+    directory = tempfile.mkdtemp(prefix="anthrasend_run_")
+
+    start = time.perf_counter()
+    try:
+        if pipeline == "spool":
+            spool_dir = os.path.join(directory, "spool")
+            render_to_spool(workbook, spool_dir,
+                            catalog=TemplateCatalog.default())
+            timings["render"] = time.perf_counter() - start
+            for _, e in drain_spool(spool_dir, transport):
+                sent += e is None
+                failed += e is not None
+        else:
+            journal = create_send_journal(
+                os.path.join(directory, "send_journal.sqlite"), pipeline)
+            try:
+                if pipeline == "batch":
+                    sent, failed = _send_batch(
+                        workbook, transport, journal, timings)
+                else:
+                    cache = RecipientSnapshotCache(
+                        os.path.join(directory, "cache"))
+                    sent, failed = _send_stream(
+                        workbook, cache, transport, journal, timings)
+            finally:
+                journal.close()
+        total = time.perf_counter() - start
+    finally:
+        transport.close()
+        shutil.rmtree(directory, ignore_errors=True)
+
+    peak = None
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results.put({
+        "pipeline": pipeline, "sent": sent, "failed": failed,
+        "total": total, "render": timings["render"],
+        "latencies": latencies, "peak_mib": peak,
+    })
+
+
+def _percentiles(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] if latencies else 0.0
+        return value, value, value
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def benchmark_e2e(rows, pipelines, transport_spec, seed=0, workbook=None):
+    directory = tempfile.mkdtemp(prefix="anthrasend_bench_")
+    try:
+        if workbook is None:
+            workbook = os.path.join(directory, "recipients.xlsx")
+            start = time.perf_counter()
+            write_workbook(workbook, rows, seed)
+            print(f"Arbeitsmappe mit {rows} Zeilen erzeugt "
+                  f"({time.perf_counter() - start:.1f} s)")
+
+        # Eigener Prozess je Pipeline: getrennter Spitzenspeicher
+        context = multiprocessing.get_context("spawn")
+        print(f"{'Pipeline':<8} {'gesendet':>9} {'Fehler':>7} {'Aufrufe':>8} "
+              f"{'Mails/s':>9} {'Rendern':>9} {'Senden':>9} {'p50 ms':>8} "
+              f"{'p95 ms':>8} {'p99 ms':>8} {'Peak MiB':>9}")
+        for pipeline in pipelines:
+            results = context.Queue()
+            process = context.Process(
+                target=_run_pipeline,
+                args=(pipeline, workbook, transport_spec, results))
+            process.start()
+            result = results.get()
+            process.join()
+
+            p50, p95, p99 = _percentiles(result["latencies"])
+            messages = result["sent"] + result["failed"]
+            peak = (f"{result['peak_mib']:9.0f}"
+                    if result["peak_mib"] is not None else f"{'-':>9}")
+            print(f"{pipeline:<8} {result['sent']:>9} {result['failed']:>7} "
+                  f"{len(result['latencies']):>8} "
+                  f"{messages / result['total']:>9.0f} "
+                  f"{result['render']:>8.2f}s "
+                  f"{result['total'] - result['render']:>8.2f}s "
+                  f"{p50 * 1000:>8.2f} {p95 * 1000:>8.2f} {p99 * 1000:>8.2f} "
+                  f"{peak}")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    prep = commands.add_parser("prep", help="benchmark recipient preparation")
+    prep.add_argument("--rows", type=int, default=100_000)
+    prep.add_argument("--seed", type=int, default=0)
+
+    workbook = commands.add_parser(
+        "workbook", help="write a synthetic recipient workbook")
+    workbook.add_argument("--rows", type=int, default=100_000)
+    workbook.add_argument("--seed", type=int, default=0)
+    workbook.add_argument("--output", default="Mappe_synthetic.xlsx")
+    workbook.add_argument("--dirty", type=float, default=0.0,
+                          help="fraction of repeated/malformed addresses")
+
+    e2e = commands.add_parser(
+        "e2e", help="benchmark complete pipelines against a fake transport")
+    e2e.add_argument("--rows", type=int, default=10_000)
+    e2e.add_argument("--seed", type=int, default=0)
+    e2e.add_argument("--workbook", help="existing workbook instead of "
+                                        "a synthetic one")
+    e2e.add_argument("--pipelines", default="batch,stream,spool")
+    e2e.add_argument("--transport", choices=("outlook", "smtp"),
+                     default="outlook")
+    e2e.add_argument("--latency", type=float, default=0.0,
+                     help="FakeOutlook: seconds per Send()")
+    e2e.add_argument("--failure-rate", type=float, default=0.0,
+                     help="FakeOutlook: fraction of failing Send() calls")
+    e2e.add_argument("--smtp-port", type=int, default=8025)
+    e2e.add_argument("--concurrency", type=int, default=4)
+    e2e.add_argument("--bcc-max", type=int, default=0,
+                     help="send identical mails in BCC, up to this many "
+                          "recipients per mail")
+    e2e.add_argument("--accounts", type=int, default=1,
+                     help="SMTP: number of sender accounts, one sink each")
+    e2e.add_argument("--strategy", choices=("hash", "quota"), default="hash",
+                     help="SMTP: how mails are spread over the accounts")
+    e2e.add_argument("--sink-latency", type=float, default=0.0,
+                     help="SMTP: seconds the sinks take per mail")
+
+    inbox = commands.add_parser(
+        "inbox", help="benchmark bounce scanning against an IMAP stand-in")
+    inbox.add_argument("--messages", type=int, default=10_000)
+    inbox.add_argument("--seed", type=int, default=0)
+    inbox.add_argument("--bounce-rate", type=float, default=0.02)
+    inbox.add_argument("--body-kib", type=int, default=20,
+                       help="average size of ordinary mails")
+    inbox.add_argument("--latency", type=float, default=0.0,
+                       help="seconds until the stand-in answers a command")
+    inbox.add_argument("--imap-port", type=int, default=8143)
+
+    args = parser.parse_args()
+    if args.command == "prep":
+        benchmark_prep(args.rows, args.seed)
+    elif args.command == "workbook":
+        write_workbook(args.output, args.rows, args.seed, args.dirty)
+        print(f"{args.rows} Zeilen nach {args.output} geschrieben")
+    elif args.command == "inbox":
+        benchmark_inbox(args.messages, args.bounce_rate, args.body_kib,
+                        args.latency, args.imap_port, args.seed)
+    elif args.command == "e2e":
+        # Wird von create_dispatcher in den Pipeline-Prozessen gelesen
+        os.environ["ANTHRASEND_CONCURRENCY"] = str(
+            args.concurrency * (args.accounts if args.transport == "smtp"
+                                else 1))
+        os.environ["ANTHRASEND_BCC_MAX"] = str(args.bcc_max)
+        pipelines = [name.strip() for name in args.pipelines.split(",")]
+        if args.transport == "outlook":
+            spec = ("outlook", {"latency": args.latency,
+                                "failure_rate": args.failure_rate,
+                                "seed": args.seed})
+            benchmark_e2e(args.rows, pipelines, spec, args.seed, args.workbook)
+        else:
+            try:
+                sinks = [SmtpSink(port=args.smtp_port + number,
+                                  latency=args.sink_latency)
+                         for number in range(args.accounts)]
+            except ImportError:
+                sys.exit("Der SMTP-Test braucht aiosmtpd: pip install aiosmtpd")
+            if args.accounts > 1:
+                spec = ("sharded", {
+                    "sinks": [(sink.host, sink.port) for sink in sinks],
+                    "pool_size": args.concurrency,
+                    "strategy": args.strategy})
+            else:
+                spec = ("smtp", {"host": sinks[0].host, "port": sinks[0].port,
+                                 "pool_size": args.concurrency})
+            with contextlib.ExitStack() as stack:
+                for sink in sinks:
+                    stack.enter_context(sink)
+                benchmark_e2e(
+                    args.rows, pipelines, spec, args.seed, args.workbook)
+            for sink in sinks:
+                print(f"SMTP-Senke {sink.port}: {sink.received} Mails "
+                      f"empfangen")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""
+Offline spool: render a campaign ahead of time, send it later.
+
+Rendering and sending are split into two independent stages:
+
+    render  The workbook is read chunk by chunk, addresses are checked
+            and the rows prepared as in AnthraSend3 (recipient_prep.py).
+            Rendering and building the MIME messages runs on a process
+            pool; every worker writes finished messages into the spool's
+            Maildir (``<spool>/mail``, written to tmp/ and renamed into
+            new/, so a message is either complete or absent). Unlike
+            mailbox.Maildir.add there is no fsync per message. The spool
+            index (``<spool>/index.sqlite``) lists Maildir key, Excel
+            row, recipient, subject, language and size of every message;
+            it is written per finished chunk. Rendering the same
+            workbook into a spool whose render crashed resumes it: the
+            indexed messages are kept, unfinished files and messages of
+            unindexed chunks are removed and the remaining rows are
+            rendered.
+
+    drain   Sends the spooled messages in Excel row order through the
+            configured transport and dispatcher, at whatever rate they
+            allow. The stored bytes are sent as they are, without parsing
+            and re-serializing the message. Progress is kept in a send
+            journal inside the spool (send_journal.py), so an interrupted
+            drain can be restarted.
+            Transient failures are retried later in the drain; permanent
+            ones are listed in ``<spool>/dead_letters.csv``.
+
+    inspect Shows what a drain would send, without sending (dry run).
+
+Usage:
+    python mail_spool.py render Mappe2.xlsx spool/ [--workers 4]
+    python mail_spool.py inspect spool/ [--show 3]
+    python mail_spool.py drain spool/
+"""
+
+import argparse
+import itertools
+import mailbox
+import os
+import socket
+import sqlite3
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from email import message_from_bytes
+from email.policy import compat32, default as default_policy
+
+from mail_attachments import create_attachments
+from mail_transport import build_message, create_transport
+from recipient_prep import (
+    drop_suppressed, excel_row_number, normalize_addresses,
+    prepare_recipients, render_groups
+)
+from recipient_source import RecipientSnapshotCache
+from retry_scheduler import DeadLetterQueue
+from send_dispatcher import create_dispatcher
+from send_journal import SendJournal, campaign_id, create_send_journal
+from send_metrics import create_send_metrics
+from suppression_list import create_suppression_list
+from template_catalog import TemplateCatalog
+
+
+SpoolEntry = namedtuple(
+    "SpoolEntry",
+    ["key", "excel_row", "recipient", "subject", "language", "size"])
+
+RenderResult = namedtuple(
+    "RenderResult", ["count", "invalid", "rejected", "suppressed"])
+
+# Gespoolt wird im Versandformat, beim Leeren wird nichts mehr umgewandelt
+_CRLF_POLICY = compat32.clone(linesep="\r\n")
+
+
+class MailSpool:
+    def __init__(self, spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+        self.spool_dir = spool_dir
+        self.maildir = mailbox.Maildir(
+            os.path.join(spool_dir, "mail"), factory=None, create=True)
+        self.connection = sqlite3.connect(
+            os.path.join(spool_dir, "index.sqlite"))
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS spool (
+                key TEXT PRIMARY KEY,
+                excel_row INTEGER NOT NULL,
+                recipient TEXT NOT NULL,
+                subject TEXT,
+                language TEXT,
+                size INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS spool_row ON spool (excel_row);
+            CREATE TABLE IF NOT EXISTS meta (
+                name TEXT PRIMARY KEY,
+                value TEXT
+            );
+            """
+        )
+        self.connection.commit()
+
+    def __len__(self):
+        count, = self.connection.execute(
+            "SELECT COUNT(*) FROM spool").fetchone()
+        return count
+
+    def add_entries(self, entries):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO spool VALUES (?, ?, ?, ?, ?, ?)", entries)
+
+    def set_meta(self, **values):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [(name, str(value)) for name, value in values.items()])
+
+    def meta(self):
+        return dict(self.connection.execute("SELECT name, value FROM meta"))
+
+    def entries(self):
+        rows = self.connection.execute(
+            "SELECT key, excel_row, recipient, subject, language, size "
+            "FROM spool ORDER BY excel_row")
+        for row in rows:
+            yield SpoolEntry(*row)
+
+    def rendered_rows(self):
+        """
+        Excel rows that already have a message in the spool.
+        """
+        return {row for row, in self.connection.execute(
+            "SELECT excel_row FROM spool")}
+
+    def discard_unindexed(self):
+        """
+        Remove what an interrupted render left outside the index:
+        unfinished files in tmp/ and messages in new/ whose chunk was not
+        indexed. Returns the number of files removed.
+        """
+        indexed = {key for key, in self.connection.execute(
+            "SELECT key FROM spool")}
+        tmp = os.path.join(self.spool_dir, "mail", "tmp")
+        removed = 0
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+            removed += 1
+        for key in self.maildir.keys():
+            if key not in indexed:
+                self.maildir.discard(key)
+                removed += 1
+        return removed
+
+    def raw(self, key):
+        return self.maildir.get_bytes(key)
+
+    def message(self, key):
+        return message_from_bytes(self.raw(key), policy=default_policy)
+
+    def summary(self):
+        """
+        ``{language: (count, total_size)}`` of the spooled messages.
+        """
+        rows = self.connection.execute(
+            "SELECT language, COUNT(*), SUM(size) FROM spool "
+            "GROUP BY language ORDER BY language")
+        return {language: (count, size) for language, count, size in rows}
+
+    def close(self):
+        self.connection.close()
+        self.maildir.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Zustand der Render-Prozesse, siehe _init_worker
+_worker = {}
+
+
+def _init_worker(spool_dir, catalog, sender, attachments):
+    _worker["path"] = os.path.join(spool_dir, "mail")
+    _worker["catalog"] = catalog
+    _worker["sender"] = sender
+    _worker["attachments"] = attachments
+    _worker["counter"] = itertools.count()
+    _worker["host"] = socket.gethostname().replace("/", "_").replace(":", "_")
+
+
+def _write_message(chunks):
+    # Eindeutiger Name nach Maildir-Konvention: Zeit.Prozess+Zähler.Host
+    name = (f"{int(time.time())}.P{os.getpid()}Q{next(_worker['counter'])}"
+            f".{_worker['host']}")
+    temporary = os.path.join(_worker["path"], "tmp", name)
+    with open(temporary, "wb") as file:
+        file.writelines(chunks)
+    os.rename(temporary, os.path.join(_worker["path"], "new", name))
+    return name
+
+
+def _render_chunk(prepared):
+    """
+    Render one prepared chunk, write the messages into the Maildir and
+    return their index entries.
+    """
+    languages = dict(zip(prepared.index, prepared["language"]))
+    entries = []
+    for index, to_email, subject, body in render_groups(
+            prepared, _worker["catalog"]):
+        message = build_message(
+            _worker["sender"], to_email, subject, body, _worker["attachments"])
+        # Geteilte Anhänge werden geschrieben, ohne sie zusammenzufügen
+        chunks = (list(message.chunks()) if _worker["attachments"]
+                  else [message.as_bytes(policy=_CRLF_POLICY)])
+        key = _write_message(chunks)
+        entries.append((key, excel_row_number(index), to_email, subject,
+                        languages[index], sum(map(len, chunks))))
+    return entries
+
+
+def render_to_spool(excel_file, spool_dir, workers=None, catalog=None,
+                    recipient_cache=None, suppression=None, sender=None,
+                    attachments=None):
+    """
+    Render all mails of ``excel_file`` into the spool at ``spool_dir``
+    using ``workers`` processes. ``attachments`` (default: the files in
+    ANTHRASEND_ATTACHMENTS) are encoded once and handed to every worker.
+    Returns a RenderResult with the number of spooled messages and the
+    rows that were left out.
+
+    If an earlier render of the same campaign into ``spool_dir`` did not
+    finish, it is resumed: only rows without a message in the index are
+    rendered. A finished spool or one of another campaign raises
+    ValueError.
+    """
+    catalog = catalog or TemplateCatalog.default()
+    recipient_cache = recipient_cache or RecipientSnapshotCache()
+    sender = sender or os.environ.get("ANTHRASEND_SENDER", "noreply@localhost")
+    workers = workers or os.cpu_count() or 1
+    if attachments is None:
+        attachments = create_attachments()
+
+    invalid, rejected, suppressed = [], [], []
+    seen = {}
+    campaign = campaign_id(excel_file, catalog.fingerprint)
+    with MailSpool(spool_dir) as spool:
+        meta = spool.meta()
+        if "rendered_at" in meta:
+            raise ValueError(f"Spool {spool_dir} is already rendered")
+        if meta.get("campaign", campaign) != campaign:
+            raise ValueError(
+                f"Spool {spool_dir} holds a render of another campaign")
+        # Nach einem Absturz: indizierte Chunks behalten, den Rest neu
+        spool.discard_unindexed()
+        done = spool.rendered_rows()
+        spool.set_meta(
+            excel_file=os.path.abspath(excel_file), campaign=campaign)
+        with ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker,
+                initargs=(spool_dir, catalog, sender,
+                          attachments)) as executor:
+            pending = set()
+            for chunk in recipient_cache.read_chunks(excel_file):
+                chunk = normalize_addresses(chunk, invalid, seen)
+                chunk = drop_suppressed(chunk, suppression, suppressed)
+                prepared = prepare_recipients(chunk, catalog, rejected)
+                if done:
+                    prepared = prepared[
+                        ~excel_row_number(prepared.index).isin(done)]
+                    if prepared.empty:
+                        continue
+                pending.add(executor.submit(_render_chunk, prepared[[
+                    "Benutzername", "Vorname", "language", "salutation",
+                    "variant"]]))
+                # Höchstens zwei Chunks je Prozess gleichzeitig im Speicher
+                if len(pending) >= 2 * workers:
+                    finished, pending = wait(
+                        pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        spool.add_entries(future.result())
+            for future in pending:
+                spool.add_entries(future.result())
+        count = len(spool)
+        spool.set_meta(
+            rendered_at=time.strftime("%Y-%m-%d %H:%M:%S"), count=count)
+    return RenderResult(count, invalid, rejected, suppressed)
+
+
+def drain_spool(spool_dir, transport, metrics=None, dead_letters=None,
+                resend_in_doubt=None):
+    """
+    Send all spooled messages that are not yet sent according to the
+    spool's journal. Yields ``(entry, error)`` in completion order;
+    timings go to ``metrics`` (send_metrics.py) and final failures to
+    ``dead_letters`` (retry_scheduler.py) if given. ``resend_in_doubt``
+    see send_journal.create_send_journal.
+    """
+    with MailSpool(spool_dir) as spool:
+        campaign = spool.meta().get("campaign", "spool")
+        with create_send_journal(
+                os.path.join(spool_dir, "journal.sqlite"), campaign,
+                resend_in_doubt) as journal:
+            entries = journal.track(
+                spool.entries(), key=lambda entry: entry.recipient)
+            results = create_dispatcher(
+                transport, metrics, dead_letters).dispatch(
+                entries, prebuilt=True,
+                as_job=lambda entry: (entry.recipient, spool.raw(entry.key)))
+            for entry, e in results:
+                journal.record(entry.recipient, e)
+                yield entry, e
+
+
+def inspect_spool(spool_dir, show=0):
+    with MailSpool(spool_dir) as spool:
+        meta = spool.meta()
+        print(f"Spool: {os.path.abspath(spool_dir)}")
+        for name in ("excel_file", "campaign", "rendered_at"):
+            print(f"  {name}: {meta.get(name, '-')}")
+        total = 0
+        for language, (count, size) in spool.summary().items():
+            print(f"  {language}: {count} Mails, {size / 1024:.0f} KiB")
+            total += count
+        print(f"  Gesamt: {total} Mails")
+
+        journal_path = os.path.join(spool_dir, "journal.sqlite")
+        if os.path.exists(journal_path):
+            with SendJournal(journal_path, meta.get("campaign", "spool")) as journal:
+                print(f"  Versandstatus: {journal.summary()}")
+
+        for entry in spool.entries():
+            if show <= 0:
+                break
+            show -= 1
+            print(f"\n--- Zeile {entry.excel_row}: {entry.recipient} ---")
+            print(spool.message(entry.key).as_string())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    render_parser = commands.add_parser("render")
+    render_parser.add_argument("excel_file")
+    render_parser.add_argument("spool_dir")
+    render_parser.add_argument("--workers", type=int)
+    inspect_parser = commands.add_parser("inspect")
+    inspect_parser.add_argument("spool_dir")
+    inspect_parser.add_argument("--show", type=int, default=0)
+    drain_parser = commands.add_parser("drain")
+    drain_parser.add_argument("spool_dir")
+    drain_parser.add_argument(
+        "--resend-in-doubt", action="store_true", default=None,
+        help="send recipients with unknown status (aborted run) again")
+    args = parser.parse_args(argv)
+
+    if args.command == "render":
+        catalog_path = os.environ.get("ANTHRASEND_TEMPLATES")
+        catalog = (TemplateCatalog.load(catalog_path) if catalog_path
+                   else TemplateCatalog.default())
+        suppression = create_suppression_list()
+        try:
+            result = render_to_spool(
+                args.excel_file, args.spool_dir, args.workers, catalog,
+                suppression=suppression)
+        finally:
+            if suppression is not None:
+                suppression.close()
+        print(f"{result.count} Mails in {args.spool_dir} abgelegt, "
+              f"{len(result.invalid)} ungültig/doppelt, "
+              f"{len(result.rejected)} mit nicht unterstützter Sprache, "
+              f"{len(result.suppressed)} gesperrt.")
+    elif args.command == "inspect":
+        inspect_spool(args.spool_dir, args.show)
+    else:
+        with MailSpool(args.spool_dir) as spool:
+            campaign = spool.meta().get("campaign", "spool")
+            total = len(spool)
+        with create_transport() as transport, \
+                create_send_metrics(campaign, total) as metrics:
+            failed = 0
+            last_report = time.monotonic()
+            dead_letters = DeadLetterQueue()
+            for entry, e in drain_spool(
+                    args.spool_dir, transport, metrics, dead_letters,
+                    args.resend_in_doubt):
+                if e is not None:
+                    failed += 1
+                    print(f"Fehler beim Versand an {entry.recipient}: {e}")
+                if time.monotonic() - last_report >= 5:
+                    print(metrics.progress_text())
+                    last_report = time.monotonic()
+            if dead_letters:
+                dead_letter_path = os.path.join(
+                    args.spool_dir, "dead_letters.csv")
+                dead_letters.write_csv(dead_letter_path)
+                print(f"{len(dead_letters)} endgültig fehlgeschlagen, "
+                      f"siehe {dead_letter_path}")
+            print(f"Durchsatz: {transport.stats}")
+            print(metrics.summary())
+        return 1 if failed else 0
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
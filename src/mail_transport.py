@@ -0,0 +1,626 @@
+"""
+Mail transports used by the AnthraSend scripts.
+
+A transport takes a finished e-mail (recipient, subject, body), or a
+fully built MIME message via ``send_message`` (also as raw bytes, as
+stored in the spool), and hands it to a delivery backend. Two backends are available:
+
+    - OutlookTransport: the original path via the local Outlook
+      installation (win32com, Windows only).
+    - SmtpTransport: sends over SMTP and keeps a pool of persistent,
+      authenticated connections so many messages share one session.
+      It runs on any platform and can be pointed at a local SMTP sink
+      (e.g. ``python -m aiosmtpd -n -l localhost:8025``) for testing.
+
+Every transport records its throughput in messages per second in
+``transport.stats``. Files in ``transport.attachments`` (see
+mail_attachments.py) are attached to every message sent with ``send``.
+``send_bcc`` sends one message to several recipients in BCC, for
+identical content (see bcc_fanout.py). Campaigns spread over several
+sender accounts use ShardedTransport (sharded_transport.py).
+"""
+
+import hashlib
+import os
+import queue
+import re
+import shutil
+import smtplib
+import socket
+import tempfile
+import threading
+import time
+from functools import lru_cache
+from email import message_from_bytes
+from email.charset import QP, Charset
+from email.header import Header
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.policy import default as default_policy
+from email.utils import formatdate, make_msgid
+
+from mail_attachments import (
+    SharedAttachment, SharedPartsMessage, create_attachments
+)
+
+
+# To-Kopf von BCC-Nachrichten (leere Gruppe nach RFC 5322)
+UNDISCLOSED_RECIPIENTS = "undisclosed-recipients:;"
+
+
+class DeliveryInDoubt(smtplib.SMTPException):
+    """
+    The connection broke after the DATA command was issued: the server
+    may have accepted the message, so it must not be sent again. The
+    send journal keeps such recipients in doubt.
+    """
+
+    in_doubt = True
+
+
+class TransportStats:
+    """
+    Counts sent and failed messages of a transport and derives the
+    throughput in messages per second.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+
+    def record(self, success):
+        now = time.perf_counter()
+        with self._lock:
+            if self.started_at is None:
+                self.started_at = now
+            self.finished_at = now
+            if success:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return self.finished_at - self.started_at
+
+    @property
+    def messages_per_second(self):
+        total = self.sent + self.failed
+        if total == 0:
+            return 0.0
+        if self.elapsed == 0:
+            return float(total)
+        return total / self.elapsed
+
+    def __str__(self):
+        return (
+            f"{self.sent} gesendet, {self.failed} fehlgeschlagen, "
+            f"{self.messages_per_second:.1f} Mails/s"
+        )
+
+
+class MailTransport:
+    """
+    Base class for all transports. Subclasses implement ``_deliver``.
+    """
+
+    name = "base"
+    # Höchstzahl gleichzeitiger Sendungen, None = unbegrenzt
+    max_concurrency = None
+
+    def __init__(self):
+        self.stats = TransportStats()
+        # SharedAttachments der Kampagne, einmal gelesen und kodiert
+        self.attachments = ()
+        # Aus fertigen Nachrichten ausgepackte Anhänge, siehe _file_attachments
+        self._extracted = {}
+        self._extract_dir = None
+
+    def send(self, to_email, subject, body):
+        self._record(
+            self._deliver, to_email, subject, body, self.attachments)
+
+    def send_message(self, to_email, message):
+        """
+        Send a fully built MIME message, e.g. the raw bytes of a spooled
+        one (see mail_spool.py), to ``to_email``.
+        """
+        self._record(self._deliver_message, to_email, message)
+
+    def send_bcc(self, recipients, subject, body):
+        """
+        Send one message to all ``recipients`` as blind copies. Returns
+        the refused recipients as ``{recipient: (code, message)}``; raises
+        if no recipient was accepted. Counts as one message in ``stats``.
+        """
+        return self._record(
+            self._deliver_bcc, recipients, subject, body, self.attachments)
+
+    def _record(self, deliver, *args):
+        try:
+            result = deliver(*args)
+        except Exception:
+            self.stats.record(False)
+            raise
+        self.stats.record(True)
+        return result
+
+    def _deliver(self, to_email, subject, body, attachments=()):
+        raise NotImplementedError
+
+    def _deliver_bcc(self, recipients, subject, body, attachments=()):
+        raise NotImplementedError
+
+    def _deliver_message(self, to_email, message):
+        # Ohne eigene MIME-Unterstützung: Betreff, Text und Anhänge übernehmen
+        if isinstance(message, SharedPartsMessage):
+            self._deliver(to_email, message.subject, message.body,
+                          message.attachments)
+            return
+        if isinstance(message, bytes):
+            message = message_from_bytes(message, policy=default_policy)
+        body = message.get_body(("plain",))
+        self._deliver(to_email, str(message["Subject"]),
+                      body.get_content() if body is not None else "",
+                      self._file_attachments(message))
+
+    def _file_attachments(self, message):
+        """
+        The attachments of ``message`` as SharedAttachments backed by
+        files. Spooled messages of a campaign carry the same files, so
+        each one is written and encoded only once per transport.
+        """
+        attachments = []
+        for part in message.iter_attachments():
+            content = part.get_payload(decode=True) or b""
+            filename = os.path.basename(part.get_filename() or "") or "Anhang"
+            key = (filename, hashlib.sha256(content).digest())
+            attachment = self._extracted.get(key)
+            if attachment is None:
+                if self._extract_dir is None:
+                    self._extract_dir = tempfile.mkdtemp(
+                        prefix="anthrasend_attachments_")
+                # Eigenes Verzeichnis je Datei: Namen bleiben erhalten
+                directory = os.path.join(
+                    self._extract_dir, str(len(self._extracted)))
+                os.mkdir(directory)
+                path = os.path.join(directory, filename)
+                with open(path, "wb") as file:
+                    file.write(content)
+                attachment = SharedAttachment(
+                    path, part.get_content_type(), filename)
+                self._extracted[key] = attachment
+            attachments.append(attachment)
+        return attachments
+
+    def close(self):
+        if self._extract_dir is not None:
+            shutil.rmtree(self._extract_dir, ignore_errors=True)
+            self._extract_dir = None
+            self._extracted.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class OutlookTransport(MailTransport):
+    """
+    Sends e-mails through the default Outlook profile via COM, from the
+    profile's ``account`` (SMTP address or display name) if given.
+
+    COM objects belong to the thread (apartment) that created them, so
+    every thread that sends gets its own Outlook object, created after
+    CoInitialize on that thread. An ``outlook`` object passed in is bound
+    to the thread that created the transport.
+    """
+
+    name = "outlook"
+    # Ein Outlook-Prozess: der Dispatcher sendet im eigenen Thread
+    max_concurrency = 1
+
+    def __init__(self, outlook=None, account=None):
+        super().__init__()
+        self._account_name = account
+        self._local = threading.local()
+        # Ein übergebenes Objekt gehört zum Thread, der es erzeugt hat
+        self._injected = outlook is not None
+        self._local.outlook = outlook if self._injected else self._dispatch()
+        if account is not None:
+            self._local.account = self._find_account(account)
+
+    @staticmethod
+    def _dispatch():
+        # Erst hier importieren, damit die SMTP-Variante auch ohne
+        # pywin32 (z.B. unter Linux) funktioniert
+        import pythoncom
+        import win32com.client
+        # Jeder Thread braucht sein eigenes COM-Apartment
+        pythoncom.CoInitialize()
+        return win32com.client.Dispatch("Outlook.Application")
+
+    @property
+    def outlook(self):
+        """
+        The Outlook application object of the calling thread.
+        """
+        outlook = getattr(self._local, "outlook", None)
+        if outlook is None:
+            if self._injected:
+                raise RuntimeError(
+                    "The Outlook object passed in can only be used on the "
+                    "thread that created the transport")
+            outlook = self._local.outlook = self._dispatch()
+        return outlook
+
+    @property
+    def account(self):
+        """
+        The sending account as seen from the calling thread, or None.
+        """
+        if self._account_name is None:
+            return None
+        account = getattr(self._local, "account", None)
+        if account is None:
+            account = self._local.account = self._find_account(
+                self._account_name)
+        return account
+
+    def _find_account(self, name):
+        for account in self.outlook.Session.Accounts:
+            if name.lower() in (account.SmtpAddress.lower(),
+                                account.DisplayName.lower()):
+                return account
+        raise ValueError(f"Outlook account not found: {name}")
+
+    def _create_mail(self, subject, body, attachments):
+        mail = self.outlook.CreateItem(0)
+        account = self.account
+        if account is not None:
+            mail.SendUsingAccount = account
+        mail.Subject = subject
+        mail.Body = body
+        for attachment in attachments:
+            # Outlook liest und kodiert die Datei selbst
+            mail.Attachments.Add(attachment.path)
+        return mail
+
+    def _deliver(self, to_email, subject, body, attachments=()):
+        mail = self._create_mail(subject, body, attachments)
+        mail.To = to_email
+        mail.Send()
+
+    def _deliver_bcc(self, recipients, subject, body, attachments=()):
+        mail = self._create_mail(subject, body, attachments)
+        mail.BCC = "; ".join(recipients)
+        mail.Send()
+        # Abgelehnte Empfänger meldet Outlook erst per Unzustellbarkeitsbericht
+        return {}
+
+
+class SmtpConnectionPool:
+    """
+    A thread-safe pool of persistent SMTP sessions.
+
+    Connections are created lazily up to ``size`` and handed back to the
+    pool after each message. A session is recycled after
+    ``messages_per_session`` messages, because most servers limit how
+    many messages a single session may carry.
+    """
+
+    def __init__(self, host, port=25, username=None, password=None,
+                 use_starttls=False, use_ssl=False, size=4,
+                 messages_per_session=100, timeout=30):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_starttls = use_starttls
+        self.use_ssl = use_ssl
+        self.size = size
+        self.messages_per_session = messages_per_session
+        self.timeout = timeout
+
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._usage = {}
+
+    def _connect(self):
+        if self.use_ssl:
+            connection = smtplib.SMTP_SSL(
+                self.host, self.port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(
+                self.host, self.port, timeout=self.timeout)
+        # Stückweise gesendete Nachrichten nicht auf ACKs warten lassen
+        connection.sock.setsockopt(
+            socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection.ehlo()
+        if self.use_starttls:
+            connection.starttls()
+            connection.ehlo()
+        if self.username:
+            connection.login(self.username, self.password)
+        return connection
+
+    def acquire(self):
+        while True:
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                pass
+
+            with self._lock:
+                may_create = self._created < self.size
+                if may_create:
+                    self._created += 1
+            if may_create:
+                break
+
+            # Pool ist voll: auf eine freiwerdende Verbindung warten
+            try:
+                return self._idle.get(timeout=0.05)
+            except queue.Empty:
+                continue
+
+        try:
+            connection = self._connect()
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._usage[id(connection)] = 0
+        return connection
+
+    def release(self, connection, broken=False):
+        with self._lock:
+            usage = self._usage.get(id(connection), 0) + 1
+            recycle = broken or usage >= self.messages_per_session
+            if not recycle:
+                self._usage[id(connection)] = usage
+        if recycle:
+            self._discard(connection, quit_session=not broken)
+            return
+        self._idle.put(connection)
+
+    def _discard(self, connection, quit_session=True):
+        with self._lock:
+            self._usage.pop(id(connection), None)
+        try:
+            if quit_session:
+                connection.quit()
+            else:
+                connection.close()
+        except smtplib.SMTPException:
+            connection.close()
+        except OSError:
+            pass
+        with self._lock:
+            self._created -= 1
+
+    def close(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+
+# Zeilen, die mit '.' beginnen, werden in der DATA-Phase verdoppelt
+_DOT_LINES = re.compile(rb"(?m)^\.")
+_BARE_LF = re.compile(rb"(?<!\r)\n")
+# Quoted-printable bleibt für deutsche/französische Texte lesbar
+_UTF8_QP = Charset("utf-8")
+_UTF8_QP.body_encoding = QP
+_msgid_domain = None
+
+
+@lru_cache(maxsize=1024)
+def _encoded_header(value):
+    # Betreffe wiederholen sich je Vorlage; das RFC-2047-Kodieren ist teuer
+    if value.isascii():
+        return value
+    return Header(value, "utf-8", header_name="Subject").encode()
+
+
+def build_message(sender, to_email, subject, body, attachments=()):
+    """
+    Plain text message. Built with the compat32 classes, which are about
+    three times faster than EmailMessage for this simple structure.
+
+    With ``attachments`` (SharedAttachment) a SharedPartsMessage is
+    returned: only the text part is built here, the attachment parts are
+    referenced as they are.
+    """
+    global _msgid_domain
+    if _msgid_domain is None:
+        # getfqdn kann eine DNS-Abfrage auslösen, daher nur einmal
+        _msgid_domain = socket.getfqdn()
+    message = MIMEText(body, "plain", _UTF8_QP)
+    if attachments:
+        # "=_" kommt weder in Quoted-printable noch in Base64 vor
+        message = MIMEMultipart(
+            "mixed", boundary=f"=_{os.urandom(12).hex()}", _subparts=[message])
+    message["From"] = sender
+    message["To"] = to_email
+    message["Subject"] = _encoded_header(subject)
+    message["Date"] = formatdate(localtime=True)
+    message["Message-ID"] = make_msgid(domain=_msgid_domain)
+    if attachments:
+        return SharedPartsMessage(message, attachments, subject, body)
+    return message
+
+
+class SmtpTransport(MailTransport):
+    """
+    Sends e-mails over SMTP using a pool of persistent connections.
+    """
+
+    name = "smtp"
+
+    def __init__(self, sender, pool):
+        super().__init__()
+        self.sender = sender
+        self.pool = pool
+        self.max_concurrency = pool.size
+
+    def build_message(self, to_email, subject, body, attachments=()):
+        return build_message(self.sender, to_email, subject, body, attachments)
+
+    def _deliver(self, to_email, subject, body, attachments=()):
+        self._deliver_message(
+            to_email, self.build_message(to_email, subject, body, attachments))
+
+    def _deliver_message(self, to_email, message):
+        self._send_reconnecting(message, [to_email])
+
+    def _deliver_bcc(self, recipients, subject, body, attachments=()):
+        message = self.build_message(
+            UNDISCLOSED_RECIPIENTS, subject, body, attachments)
+        return self._send_reconnecting(message, recipients)
+
+    def _send_reconnecting(self, message, recipients):
+        try:
+            return self._send_pooled(message, recipients)
+        except DeliveryInDoubt:
+            raise
+        except smtplib.SMTPServerDisconnected:
+            # Server hat die Session vor DATA beendet (z.B. Leerlauf):
+            # einmal neu verbinden
+            return self._send_pooled(message, recipients)
+
+    def _send_pooled(self, message, recipients):
+        """
+        Send ``message`` to ``recipients`` on a pooled connection and
+        return the refused recipients, as SMTP.sendmail does.
+        """
+        connection = self.pool.acquire()
+        try:
+            refused = self._transaction(connection, message, recipients)
+        except (smtplib.SMTPServerDisconnected, DeliveryInDoubt):
+            self.pool.release(connection, broken=True)
+            raise
+        except smtplib.SMTPException:
+            # Ablehnung einzelner Empfänger: Session bleibt benutzbar
+            try:
+                connection.rset()
+            except OSError:
+                self.pool.release(connection, broken=True)
+                raise
+            self.pool.release(connection)
+            raise
+        except OSError:
+            self.pool.release(connection, broken=True)
+            raise
+        self.pool.release(connection)
+        return refused
+
+    @staticmethod
+    def _data_chunks(message):
+        """
+        ``message`` in wire format with dot-stuffing, up to and including
+        the final ".". SharedPartsMessages are streamed chunk by chunk, so
+        the shared attachment parts are neither joined nor copied per
+        message.
+        """
+        if isinstance(message, SharedPartsMessage):
+            yield from message.chunks(dot_stuffed=True)
+            yield b".\r\n"
+            return
+        if isinstance(message, bytes):
+            # Rohe Nachricht unverändert senden, nur Zeilenenden nach RFC 5321
+            message = _BARE_LF.sub(b"\r\n", message)
+        else:
+            message = message.as_bytes(
+                policy=message.policy.clone(linesep="\r\n"))
+        if not message.endswith(b"\r\n"):
+            message += b"\r\n"
+        # In einem Stück: ein einzelnes "." hinterher bremst Nagle aus
+        yield _DOT_LINES.sub(b"..", message) + b".\r\n"
+
+    def _transaction(self, connection, message, recipients):
+        """
+        SMTP transaction as in SMTP.sendmail. A disconnect after the
+        DATA command raises DeliveryInDoubt instead of
+        SMTPServerDisconnected, so the message is not sent again.
+        """
+        connection.ehlo_or_helo_if_needed()
+        code, response = connection.mail(self.sender)
+        if code != 250:
+            raise smtplib.SMTPSenderRefused(code, response, self.sender)
+        refused = {}
+        for recipient in recipients:
+            code, response = connection.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if len(refused) == len(recipients):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        try:
+            code, response = connection.docmd("data")
+            if code != 354:
+                raise smtplib.SMTPDataError(code, response)
+            for chunk in self._data_chunks(message):
+                connection.send(chunk)
+            code, response = connection.getreply()
+        except smtplib.SMTPServerDisconnected as error:
+            raise DeliveryInDoubt(
+                f"Verbindung nach DATA abgebrochen, Zustellung ungewiss: "
+                f"{error}") from error
+        if code != 250:
+            raise smtplib.SMTPDataError(code, response)
+        return refused
+
+    def close(self):
+        self.pool.close()
+        super().close()
+
+
+def create_transport(kind=None):
+    """
+    Create the transport configured through environment variables.
+
+    ANTHRASEND_TRANSPORT selects the backend ('outlook' or 'smtp',
+    default 'outlook'). The SMTP backend reads ANTHRASEND_SMTP_HOST,
+    ANTHRASEND_SMTP_PORT, ANTHRASEND_SMTP_USER, ANTHRASEND_SMTP_PASSWORD,
+    ANTHRASEND_SMTP_STARTTLS, ANTHRASEND_SMTP_POOL_SIZE and
+    ANTHRASEND_SENDER. Both attach the files in ANTHRASEND_ATTACHMENTS.
+
+    If ANTHRASEND_ACCOUNTS names an accounts file and no ``kind`` is
+    given, a ShardedTransport over these accounts is created instead.
+    """
+    accounts = os.environ.get("ANTHRASEND_ACCOUNTS")
+    if kind is None and accounts:
+        # Erst hier importieren: sharded_transport baut auf diesem Modul auf
+        from sharded_transport import create_sharded_transport
+        transport = create_sharded_transport(accounts)
+        transport.attachments = create_attachments()
+        return transport
+    kind = (kind or os.environ.get("ANTHRASEND_TRANSPORT", "outlook")).lower()
+    if kind == "outlook":
+        transport = OutlookTransport()
+    elif kind == "smtp":
+        pool = SmtpConnectionPool(
+            os.environ.get("ANTHRASEND_SMTP_HOST", "localhost"),
+            int(os.environ.get("ANTHRASEND_SMTP_PORT", "25")),
+            username=os.environ.get("ANTHRASEND_SMTP_USER"),
+            password=os.environ.get("ANTHRASEND_SMTP_PASSWORD"),
+            use_starttls=os.environ.get(
+                "ANTHRASEND_SMTP_STARTTLS", "0") == "1",
+            size=int(os.environ.get("ANTHRASEND_SMTP_POOL_SIZE", "4")),
+        )
+        transport = SmtpTransport(
+            os.environ.get("ANTHRASEND_SENDER", "noreply@localhost"), pool)
+    else:
+        raise ValueError(f"Unknown transport: {kind}")
+    transport.attachments = create_attachments()
+    return transport
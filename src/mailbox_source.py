@@ -0,0 +1,401 @@
+"""
+Mailbox sources for the inbox scripts.
+
+A source lists message headers first and downloads full messages only
+on request, so scanning a mailbox for bounces does not transfer every
+body:
+
+    - ImapSource: one reused IMAP connection. Candidates are selected
+      on the server with SEARCH (subject, sender, date, flags), headers
+      and body structure are fetched in batched UID FETCH commands, with
+      several batches pipelined on the connection, and full bodies are
+      fetched the same way for the candidates only.
+    - MaildirSource: a local Maildir directory with the same interface,
+      e.g. as test stand-in or for exported mailboxes.
+
+find_bounces combines a source with BounceClassifier and bounce_parser.
+"""
+
+import collections
+import datetime
+import email.utils
+import imaplib
+import mailbox
+import os
+import re
+from collections import namedtuple
+from email.parser import BytesHeaderParser
+from email.policy import compat32
+
+from bounce_classifier import AUTO_REPLY, NOT_BOUNCE, BounceClassifier
+from bounce_parser import header_text, parse_bounce
+
+
+MessageHeader = namedtuple(
+    "MessageHeader",
+    ["uid", "message_id", "date", "sender", "subject", "size", "folder",
+     "auto_submitted", "is_report"])
+
+# Betreff-Anfänge von Rückläufern für die Suche auf dem Server (nur ASCII,
+# damit kein CHARSET-Literal nötig ist)
+BOUNCE_SUBJECTS = (
+    "Unzustellbar", "Nicht zustellbar", "Undeliverable", "Undelivered",
+    "Delivery Status Notification", "Mail delivery failed", "Returned mail",
+    "Non remis", "Onbestelbaar", "Zustellung verz",
+)
+BOUNCE_SENDERS = ("MAILER-DAEMON", "postmaster")
+
+HEADER_FIELDS = "MESSAGE-ID DATE FROM SUBJECT AUTO-SUBMITTED CONTENT-TYPE"
+
+_header_parser = BytesHeaderParser(policy=compat32)
+
+
+def _header(raw_headers, uid, size, folder, is_report=None):
+    headers = _header_parser.parsebytes(raw_headers)
+    if is_report is None:
+        is_report = headers.get_content_type() == "multipart/report"
+    date = headers.get("Date")
+    timestamp = None
+    if date:
+        try:
+            timestamp = email.utils.parsedate_to_datetime(date).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return MessageHeader(
+        uid, headers.get("Message-ID", ""), timestamp,
+        header_text(headers.get("From", "")),
+        header_text(headers.get("Subject", "")),
+        size, folder, headers.get("Auto-Submitted", ""), is_report)
+
+
+class MailboxSource:
+    """
+    Interface of all mailbox sources.
+    """
+
+    folder = None
+
+    def iter_headers(self, since=None, bounce_candidates=False, min_uid=None):
+        """
+        Yield MessageHeader for the messages of the folder. ``since`` is
+        a datetime.date; with ``bounce_candidates`` only messages that
+        look like bounces by subject or sender are returned (on IMAP the
+        server does this filtering). ``min_uid`` skips messages before
+        that UID.
+        """
+        raise NotImplementedError
+
+    def fetch_messages(self, uids):
+        """
+        Yield ``(uid, raw_bytes)`` of the full messages for ``uids``.
+        """
+        raise NotImplementedError
+
+    # Für den inkrementellen Abgleich (message_index.py)
+    generation = None
+
+    def state(self):
+        """
+        Cheap change marker of the folder: if it equals the marker of the
+        last sync, nothing was added or removed since. A changed
+        ``generation`` means all known UIDs are invalid.
+        """
+        raise NotImplementedError
+
+    def list_uids(self):
+        raise NotImplementedError
+
+    def headers(self, uids):
+        """
+        Yield MessageHeader for the given ``uids``.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class ImapSource(MailboxSource):
+    _FETCH_ITEM = re.compile(rb"UID (\d+)")
+    _SIZE_ITEM = re.compile(rb"RFC822\.SIZE (\d+)")
+
+    def __init__(self, host, username, password, folder="INBOX", port=993,
+                 use_ssl=True, batch_size=500, pipeline_depth=4):
+        if use_ssl:
+            self.connection = imaplib.IMAP4_SSL(host, port)
+        else:
+            self.connection = imaplib.IMAP4(host, port)
+        self.connection.login(username, password)
+        self.folder = folder
+        self.batch_size = batch_size
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.uidvalidity = None
+        self.uidnext = None
+        self.exists = 0
+        self._select()
+
+    def _select(self):
+        status, data = self.connection.select(self.folder, readonly=True)
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"Cannot select {self.folder}")
+        self.exists = int(data[0]) if data and data[0] else 0
+        for name in ("UIDVALIDITY", "UIDNEXT"):
+            _, values = self.connection.response(name)
+            if values and values[0]:
+                setattr(self, name.lower(), int(values[0]))
+
+    @property
+    def generation(self):
+        return self.uidvalidity
+
+    def state(self):
+        # Neu auswählen, damit UIDNEXT/EXISTS aktuell sind
+        self._select()
+        return f"{self.uidnext}:{self.exists}"
+
+    def list_uids(self):
+        return self.search()
+
+    @staticmethod
+    def _or(criteria):
+        # IMAP-OR ist binär: OR a (OR b c)
+        if len(criteria) == 1:
+            return criteria[0]
+        return f"(OR {criteria[0]} {ImapSource._or(criteria[1:])})"
+
+    def search(self, since=None, bounce_candidates=False, min_uid=None):
+        criteria = []
+        if since is not None:
+            criteria.append(f"SINCE {since.strftime('%d-%b-%Y')}")
+        if min_uid is not None:
+            criteria.append(f"UID {min_uid}:*")
+        if bounce_candidates:
+            criteria.append(self._or(
+                [f'SUBJECT "{subject}"' for subject in BOUNCE_SUBJECTS]
+                + [f'FROM "{sender}"' for sender in BOUNCE_SENDERS]))
+        status, data = self.connection.uid(
+            "SEARCH", None, " ".join(criteria) or "ALL")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+        uids = [int(uid) for uid in data[0].split()] if data[0] else []
+        if min_uid is not None:
+            # "n:*" liefert immer mindestens die höchste UID
+            uids = [uid for uid in uids if uid >= min_uid]
+        return uids
+
+    def _fetch(self, uids, items):
+        """
+        Run UID FETCH for ``uids`` in batches of ``batch_size`` and yield
+        ``[prefix, literal]`` per message, prefix being the non-literal
+        part of the response. Up to ``pipeline_depth`` tagged commands
+        are sent before the oldest reply is read, so the round trips of
+        the batches overlap.
+        """
+        # imaplib kennt kein Pipelining: Befehle mit _command absetzen und
+        # die Antworten der Reihe nach mit _command_complete abholen
+        pending = collections.deque()
+        try:
+            for start in range(0, len(uids), self.batch_size):
+                uid_set = ",".join(
+                    str(uid) for uid in uids[start:start + self.batch_size])
+                pending.append(
+                    self.connection._command("UID", "FETCH", uid_set, items))
+                if len(pending) >= self.pipeline_depth:
+                    yield from self._fetch_reply(pending.popleft())
+            while pending:
+                yield from self._fetch_reply(pending.popleft())
+        finally:
+            # Abgebrochener Durchlauf: offene Antworten abholen, sonst
+            # stehen sie vor der Antwort auf den nächsten Befehl
+            while pending:
+                try:
+                    self.connection._command_complete(
+                        "UID", pending.popleft())
+                except (imaplib.IMAP4.error, OSError):
+                    break
+            self.connection.untagged_responses.pop("FETCH", None)
+
+    def _fetch_reply(self, tag):
+        status, data = self.connection._command_complete("UID", tag)
+        status, data = self.connection._untagged_response(
+            status, data, "FETCH")
+        if status != "OK":
+            raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+        current = None
+        for part in data:
+            if isinstance(part, tuple):
+                if current is not None:
+                    yield current
+                current = [part[0], part[1]]
+            elif current is not None and part:
+                # Angaben nach dem Literal, z.B. BODYSTRUCTURE
+                current[0] += part
+        if current is not None:
+            yield current
+
+    def iter_headers(self, since=None, bounce_candidates=False, min_uid=None):
+        return self.headers(self.search(since, bounce_candidates, min_uid))
+
+    def headers(self, uids):
+        items = (f"(UID RFC822.SIZE BODYSTRUCTURE "
+                 f"BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])")
+        for prefix, literal in self._fetch(list(uids), items):
+            uid = self._FETCH_ITEM.search(prefix)
+            size = self._SIZE_ITEM.search(prefix)
+            if uid is None:
+                continue
+            is_report = b'"REPORT"' in prefix.upper()
+            yield _header(literal, int(uid.group(1)),
+                          int(size.group(1)) if size else None,
+                          self.folder, is_report)
+
+    def fetch_messages(self, uids):
+        for prefix, literal in self._fetch(list(uids), "(UID BODY.PEEK[])"):
+            uid = self._FETCH_ITEM.search(prefix)
+            if uid is not None:
+                yield int(uid.group(1)), literal
+
+    def close(self):
+        try:
+            self.connection.logout()
+        except (imaplib.IMAP4.error, OSError):
+            pass
+
+
+class MaildirSource(MailboxSource):
+    """
+    Local Maildir with the interface of ImapSource. The Maildir key
+    takes the place of the UID.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.folder = os.path.basename(os.path.normpath(path))
+        self.maildir = mailbox.Maildir(path, factory=None, create=False)
+
+    def state(self):
+        # Zustellen, Löschen und Umbenennen ändern die mtime von new/ bzw. cur/
+        return ":".join(
+            str(os.stat(os.path.join(self.path, name)).st_mtime_ns)
+            for name in ("new", "cur"))
+
+    def list_uids(self):
+        return self.maildir.keys()
+
+    def headers(self, uids):
+        for key in uids:
+            try:
+                file = self.maildir.get_file(key)
+            except KeyError:
+                # Inzwischen gelöscht
+                continue
+            with file:
+                lines = []
+                for line in file:
+                    # Leerzeile trennt Kopf und Rumpf, auch bei CRLF
+                    if line in (b"\n", b"\r\n"):
+                        break
+                    lines.append(line)
+                raw_headers = b"".join(lines)
+                file.seek(0, os.SEEK_END)
+                size = file.tell()
+            yield _header(raw_headers, key, size, self.folder)
+
+    def iter_headers(self, since=None, bounce_candidates=False, min_uid=None):
+        start = None
+        if since is not None:
+            start = datetime.datetime.combine(since, datetime.time()).timestamp()
+        keys = self.maildir.iterkeys()
+        if min_uid is not None:
+            first = _delivery_order(min_uid)
+            keys = (key for key in keys if _delivery_order(key) >= first)
+        for header in self.headers(keys):
+            if start is not None and header.date is not None and (
+                    header.date < start):
+                continue
+            if bounce_candidates and not _matches_search(header):
+                continue
+            yield header
+
+    def fetch_messages(self, uids):
+        for uid in uids:
+            yield uid, self.maildir.get_bytes(uid)
+
+    def close(self):
+        self.maildir.close()
+
+
+def _delivery_order(key):
+    """
+    Delivery time in seconds from a Maildir key ('1700000000.M12P34Q5.host'),
+    so keys compare like IMAP UIDs. Keys of the same second compare
+    equal, ``min_uid`` rather returns a message twice than skip one.
+    """
+    seconds = str(key).partition(".")[0]
+    return int(seconds) if seconds.isdigit() else 0
+
+
+def _matches_search(header):
+    """
+    Local equivalent of ImapSource's server-side bounce SEARCH
+    (case-insensitive substring match on subject and sender).
+    """
+    subject = header.subject.lower()
+    sender = header.sender.lower()
+    return (any(term.lower() in subject for term in BOUNCE_SUBJECTS)
+            or any(term.lower() in sender for term in BOUNCE_SENDERS))
+
+
+def _is_candidate(header, classifier):
+    """
+    Decide from the headers alone whether the full message is needed.
+    """
+    if header.is_report:
+        return True
+    sender = header.sender.lower()
+    if any(name.lower() in sender for name in BOUNCE_SENDERS):
+        return True
+    kind = classifier.classify(
+        header.subject, "", f"auto-submitted: {header.auto_submitted}").kind
+    return kind not in (NOT_BOUNCE, AUTO_REPLY)
+
+
+def find_bounces(source, since=None):
+    """
+    Yield BounceRecord for all bounces in ``source``. Only headers are
+    scanned first; full messages are downloaded for candidates only.
+    """
+    classifier = BounceClassifier()
+    candidates = [
+        header.uid
+        for header in source.iter_headers(since, bounce_candidates=True)
+        if _is_candidate(header, classifier)
+    ]
+    for _, raw in source.fetch_messages(candidates):
+        yield from parse_bounce(raw)
+
+
+def create_imap_source():
+    """
+    ImapSource from ANTHRASEND_IMAP_HOST, ANTHRASEND_IMAP_PORT,
+    ANTHRASEND_IMAP_USER, ANTHRASEND_IMAP_PASSWORD, ANTHRASEND_IMAP_FOLDER
+    and ANTHRASEND_IMAP_SSL, or None if no host is configured.
+    """
+    host = os.environ.get("ANTHRASEND_IMAP_HOST")
+    if host:
+        use_ssl = os.environ.get("ANTHRASEND_IMAP_SSL", "1") != "0"
+        return ImapSource(
+            host,
+            os.environ.get("ANTHRASEND_IMAP_USER", ""),
+            os.environ.get("ANTHRASEND_IMAP_PASSWORD", ""),
+            folder=os.environ.get("ANTHRASEND_IMAP_FOLDER", "INBOX"),
+            port=int(os.environ.get(
+                "ANTHRASEND_IMAP_PORT", 993 if use_ssl else 143)),
+            use_ssl=use_ssl)
+    return None
@@ -0,0 +1,192 @@
+"""
+Local SQLite index of mailbox headers and bounces.
+
+The inbox scripts used to rescan the whole mailbox on every run. The
+index keeps message-id, date, sender, subject, size and folder of every
+message, plus the bounce records of the messages that are bounces, and
+syncs incrementally with a mailbox source (mailbox_source.py):
+
+    - the folder's change marker (UIDNEXT/EXISTS on IMAP, the mtimes of
+      new/ and cur/ for a Maildir) is compared with the stored one; if it
+      is unchanged the sync ends without listing the folder,
+    - otherwise only the UID list is fetched and diffed against the index;
+      headers are fetched for new UIDs only and removed UIDs are deleted,
+    - a new UIDVALIDITY invalidates all UIDs of the folder, which is then
+      indexed from scratch.
+
+Queries like "hard bounces since the last campaign" are then answered
+from the index alone.
+"""
+
+import sqlite3
+import time
+
+from bounce_classifier import HARD_BOUNCE, SOFT_BOUNCE, BounceClassifier
+from bounce_parser import parse_bounce
+from mailbox_source import _is_candidate
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    folder TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    message_id TEXT,
+    date REAL,
+    sender TEXT,
+    subject TEXT,
+    size INTEGER,
+    kind TEXT,
+    PRIMARY KEY (folder, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (date);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id);
+
+CREATE TABLE IF NOT EXISTS bounces (
+    folder TEXT NOT NULL,
+    uid TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    status TEXT,
+    kind TEXT NOT NULL,
+    diagnostic TEXT,
+    date REAL
+);
+CREATE INDEX IF NOT EXISTS bounces_message ON bounces (folder, uid);
+CREATE INDEX IF NOT EXISTS bounces_date ON bounces (kind, date);
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    folder TEXT PRIMARY KEY,
+    generation TEXT,
+    marker TEXT,
+    synced_at REAL NOT NULL
+);
+"""
+
+
+class MessageIndex:
+    def __init__(self, db_path, batch_size=500):
+        self.batch_size = batch_size
+        self.classifier = BounceClassifier()
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+    def _state(self, folder):
+        return self.connection.execute(
+            "SELECT generation, marker FROM sync_state WHERE folder = ?",
+            (folder,)).fetchone()
+
+    def _delete(self, folder, uids):
+        rows = [(folder, str(uid)) for uid in uids]
+        self.connection.executemany(
+            "DELETE FROM messages WHERE folder = ? AND uid = ?", rows)
+        self.connection.executemany(
+            "DELETE FROM bounces WHERE folder = ? AND uid = ?", rows)
+
+    def _store(self, source, headers):
+        candidates = {}
+        rows = []
+        for header in headers:
+            if _is_candidate(header, self.classifier):
+                candidates[header.uid] = header
+            rows.append((header.folder, str(header.uid), header.message_id,
+                         header.date, header.sender, header.subject,
+                         header.size, None))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            rows)
+
+        # Bodies nur für Kandidaten laden, um Empfänger und Art zu bestimmen
+        bounces = []
+        kinds = []
+        for uid, raw in source.fetch_messages(list(candidates)):
+            header = candidates[uid]
+            kind = self.classifier.classify_message(raw).kind
+            kinds.append((kind, header.folder, str(uid)))
+            for record in parse_bounce(raw):
+                # Ein DSN kann endgültige und verzögerte Empfänger mischen
+                record_kind = {"5": HARD_BOUNCE, "4": SOFT_BOUNCE}.get(
+                    record.status[:1], kind)
+                bounces.append((header.folder, str(uid), record.recipient,
+                                record.status, record_kind, record.diagnostic,
+                                header.date))
+        self.connection.executemany(
+            "UPDATE messages SET kind = ? WHERE folder = ? AND uid = ?", kinds)
+        self.connection.executemany(
+            "INSERT INTO bounces VALUES (?, ?, ?, ?, ?, ?, ?)", bounces)
+
+    def sync(self, source):
+        """
+        Bring the index of ``source.folder`` up to date. Returns the
+        number of ``(added, removed)`` messages.
+        """
+        folder = source.folder
+        generation = None if source.generation is None else str(
+            source.generation)
+        marker = source.state()
+        stored = self._state(folder)
+        if stored is not None and stored == (generation, marker):
+            return 0, 0
+
+        with self.connection:
+            if stored is not None and stored[0] != generation:
+                # Neue UIDVALIDITY: alle bekannten UIDs sind ungültig
+                self.connection.execute(
+                    "DELETE FROM messages WHERE folder = ?", (folder,))
+                self.connection.execute(
+                    "DELETE FROM bounces WHERE folder = ?", (folder,))
+            known = {uid for uid, in self.connection.execute(
+                "SELECT uid FROM messages WHERE folder = ?", (folder,))}
+
+        uids = {str(uid): uid for uid in source.list_uids()}
+        removed = known - uids.keys()
+        added = [uid for key, uid in uids.items() if key not in known]
+        with self.connection:
+            self._delete(folder, removed)
+        # In Batches committen, damit ein Abbruch nicht alles verwirft
+        for start in range(0, len(added), self.batch_size):
+            with self.connection:
+                self._store(source, source.headers(
+                    added[start:start + self.batch_size]))
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)",
+                (folder, generation, marker, time.time()))
+        return len(added), len(removed)
+
+    def bounces_since(self, since=None, kind=HARD_BOUNCE, folder=None):
+        """
+        ``(recipient, status)`` of all bounces of ``kind`` received after
+        the timestamp ``since``, one row per recipient (latest status).
+        """
+        sql = ("SELECT recipient, status, MAX(date) FROM bounces "
+               "WHERE kind = ?")
+        params = [kind]
+        if since is not None:
+            sql += " AND date >= ?"
+            params.append(since)
+        if folder is not None:
+            sql += " AND folder = ?"
+            params.append(folder)
+        sql += " GROUP BY recipient ORDER BY recipient"
+        return [(recipient, status) for recipient, status, _ in
+                self.connection.execute(sql, params)]
+
+    def messages_since(self, since, folder=None):
+        sql = ("SELECT folder, uid, message_id, date, sender, subject, size, "
+               "kind FROM messages WHERE date >= ?")
+        params = [since]
+        if folder is not None:
+            sql += " AND folder = ?"
+            params.append(folder)
+        return self.connection.execute(sql + " ORDER BY date", params).fetchall()
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
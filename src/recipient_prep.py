@@ -0,0 +1,277 @@
+"""
+Column-wise preparation of the recipient table.
+
+Instead of walking the DataFrame with ``iterrows`` and resolving
+salutation and language for every row, the whole table is normalized
+in a few vectorized pandas operations:
+
+    - addresses are normalized (trimmed, domain case-folded and IDNA
+      encoded), validated against a compiled pattern and de-duplicated,
+      keeping the first row of every address,
+    - 'Sprache' and 'Anrede' are stripped and upper-cased,
+    - unknown salutations are mapped to the catalog's default salutation,
+    - unsupported languages are detected for all rows at once and
+      reported together before anything is sent; a streamed workbook is
+      checked chunk by chunk with validate_languages before the send
+      is confirmed,
+    - suppressed addresses (suppression_list.py) are dropped before any
+      content is rendered,
+    - rows are grouped by (language, salutation, variant) so that each
+      group's template is resolved once,
+    - for the BCC fan-out (bcc_fanout.py) rows with identical rendered
+      content can be put next to each other.
+"""
+
+import csv
+import re
+from functools import lru_cache
+
+import pandas as pd
+
+from template_catalog import STORE_MANAGER_MARKER
+
+
+# Lokaler Teil nach RFC 5322 (dot-atom), Domain aus LDH-Labels
+ADDRESS_PATTERN = re.compile(
+    r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+    r"@(?:[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+"
+    r"[A-Za-z](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?")
+
+INVALID_ADDRESS = "ungültige Adresse"
+
+
+class UnsupportedLanguageError(ValueError):
+    """
+    Raised when rows of the recipient table use a language that the
+    template catalog does not support. ``rows`` holds
+    ``(excel_row, address, language)`` for every offending row.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        details = "\n".join(
+            f"  Zeile {excel_row}: {address} ({language!r})"
+            for excel_row, address, language in rows)
+        super().__init__(
+            f"Unsupported language in {len(rows)} row(s):\n{details}")
+
+
+def excel_row_number(index):
+    # Zeile 1 ist die Kopfzeile in Excel
+    return index + 2
+
+
+@lru_cache(maxsize=None)
+def _idna(domain):
+    try:
+        return domain.encode("idna").decode("ascii")
+    except UnicodeError:
+        # Bleibt unverändert und fällt dann bei der Prüfung durch
+        return domain
+
+
+def normalize_address(address):
+    """
+    The canonical form of one address: trimmed, with the domain
+    case-folded and IDNA encoded; the local part keeps its case. Used
+    for the recipient table and the suppression list alike.
+    """
+    local, at, domain = str(address).strip().rpartition("@")
+    domain = domain.casefold()
+    if not domain.isascii():
+        domain = _idna(domain)
+    return local + at + domain
+
+
+def address_key(address):
+    """
+    Case-insensitive key of an address, for finding repeated and
+    suppressed addresses.
+    """
+    return normalize_address(address).casefold()
+
+
+def normalize_addresses(df, report=None, seen=None):
+    """
+    Return ``df`` with normalized addresses in 'Benutzername', without
+    invalid addresses and repeated addresses. Of several rows with the
+    same address (case-insensitive) the first is kept.
+
+    Dropped rows are appended to ``report`` as
+    ``(excel_row, address, reason)``. ``seen`` maps the addresses already
+    accepted to their Excel row; pass the same dict for all chunks of a
+    streamed workbook to de-duplicate across chunks.
+    """
+    if seen is None:
+        seen = {}
+    normalized = df["Benutzername"].fillna("").map(normalize_address)
+
+    valid = normalized.str.fullmatch(ADDRESS_PATTERN.pattern).fillna(False)
+    # Wie address_key
+    key = normalized.str.casefold()
+    duplicate = valid & (
+        key.duplicated(keep="first") | key.map(seen).notna())
+    keep = valid & ~duplicate
+
+    rows = excel_row_number(df.index.to_series())
+    seen.update(zip(key[keep].tolist(), rows[keep].tolist()))
+    if report is not None:
+        report.extend(
+            (row, original, INVALID_ADDRESS)
+            for row, original in zip(
+                rows[~valid], df.loc[~valid, "Benutzername"]))
+        report.extend(
+            (row, original, f"doppelt (erstmals Zeile {seen[k]})")
+            for row, original, k in zip(
+                rows[duplicate], df.loc[duplicate, "Benutzername"],
+                key[duplicate]))
+
+    result = df.loc[keep].copy()
+    result["Benutzername"] = normalized[keep]
+    return result
+
+
+def write_rejection_report(path, rows):
+    """
+    Write rejected rows ``(excel_row, address, reason)`` as CSV, sorted
+    by row.
+    """
+    with open(path, "w", newline="", encoding="utf-8-sig") as file:
+        writer = csv.writer(file, delimiter=";")
+        writer.writerow(["Zeile", "Benutzername", "Grund"])
+        writer.writerows(sorted(rows, key=lambda row: row[0]))
+
+
+def drop_suppressed(df, suppression, suppressed=None):
+    """
+    Return ``df`` without the rows whose 'Benutzername' is on the
+    ``suppression`` list; their addresses are appended to ``suppressed``
+    if given.
+    """
+    if suppression is None or not len(suppression):
+        return df
+    # Ein Set-/Bloom-Lookup je Adresse
+    mask = df["Benutzername"].map(suppression.__contains__).astype(bool)
+    if not mask.any():
+        return df
+    if suppressed is not None:
+        suppressed.extend(df.loc[mask, "Benutzername"])
+    return df.loc[~mask]
+
+
+def _languages(df):
+    return df["Sprache"].fillna("").astype(str).str.strip().str.upper()
+
+
+def _unsupported_rows(df, unsupported):
+    bad = df.loc[unsupported]
+    return [
+        (excel_row_number(index), address, language)
+        for index, address, language in zip(
+            bad.index, bad["Benutzername"], bad["Sprache"])
+    ]
+
+
+def validate_languages(chunks, catalog):
+    """
+    Check the languages of all rows of a streamed table (see
+    recipient_source.py) and return the number of rows. Raises
+    UnsupportedLanguageError listing the offending rows of all chunks.
+    """
+    count = 0
+    bad_rows = []
+    languages = list(catalog.languages)
+    for chunk in chunks:
+        count += len(chunk)
+        unsupported = ~_languages(chunk).isin(languages)
+        if unsupported.any():
+            bad_rows.extend(_unsupported_rows(chunk, unsupported))
+    if bad_rows:
+        raise UnsupportedLanguageError(bad_rows)
+    return count
+
+
+def prepare_recipients(df, catalog, rejected=None):
+    """
+    Return a copy of ``df`` with the normalized columns 'language',
+    'salutation' and 'variant'. Raises UnsupportedLanguageError listing
+    all rows with an unsupported language.
+
+    If a ``rejected`` list is given (streaming mode, see
+    recipient_source.py), those rows are appended to it as
+    ``(excel_row, address, language)`` and dropped instead; the stream
+    should have passed validate_languages before.
+    """
+    prepared = df.copy()
+    prepared["language"] = _languages(prepared)
+
+    salutation = (
+        prepared["Anrede"].fillna("").astype(str).str.strip().str.upper())
+    known = salutation.isin(list(catalog.salutations))
+    prepared["salutation"] = salutation.where(
+        known, catalog.default_salutation)
+
+    unsupported = ~prepared["language"].isin(list(catalog.languages))
+    if unsupported.any():
+        bad_rows = _unsupported_rows(prepared, unsupported)
+        if rejected is None:
+            raise UnsupportedLanguageError(bad_rows)
+        rejected.extend(bad_rows)
+        prepared = prepared.loc[~unsupported].copy()
+
+    store_manager = (
+        (prepared["language"] == "FR")
+        & prepared["Vorname"].astype(str).str.contains(
+            STORE_MANAGER_MARKER, regex=False))
+    prepared["variant"] = "default"
+    prepared.loc[store_manager, "variant"] = "store_manager"
+    return prepared
+
+
+def render_groups(prepared, catalog):
+    """
+    Render subject and body for all rows of a prepared table. Yields
+    ``(index, to_email, subject, body)`` group by group; the template of
+    each (language, salutation, variant) group is resolved once.
+    """
+    groups = prepared.groupby(
+        ["language", "salutation", "variant"], sort=False)
+    for (language, salutation, variant), group in groups:
+        template = catalog.bound(language, variant, salutation)
+        for index, to_email, vorname in zip(
+                group.index, group["Benutzername"], group["Vorname"]):
+            subject, body = template.render({"vorname": vorname})
+            yield index, to_email, subject, body
+
+
+def render_in_order(prepared, catalog):
+    """
+    Like render_groups, but returns a list of
+    ``(to_email, subject, body)`` in the row order of the table.
+    """
+    rendered = {
+        index: (to_email, subject, body)
+        for index, to_email, subject, body in render_groups(prepared, catalog)
+    }
+    return [rendered[index] for index in prepared.index]
+
+
+def render_by_content(prepared, catalog):
+    """
+    Like render_in_order, but rows whose subject and body are identical
+    are adjacent: groups of identical content in the order of their
+    first row, each group in row order.
+    """
+    contents = {}
+    for index, to_email, subject, body in render_groups(prepared, catalog):
+        rows = contents.get((subject, body))
+        if rows is None:
+            rows = contents[(subject, body)] = []
+        rows.append((index, to_email))
+    groups = sorted(
+        ((sorted(rows), subject, body)
+         for (subject, body), rows in contents.items()),
+        key=lambda group: group[0][0][0])
+    return [(to_email, subject, body)
+            for rows, subject, body in groups
+            for _, to_email in rows]
@@ -0,0 +1,242 @@
+"""
+Streaming access to recipient workbooks.
+
+``pd.read_excel`` parses the whole workbook before the first mail can be
+generated. read_recipient_chunks opens the workbook in openpyxl's
+read-only mode instead and yields the rows as small DataFrames, so
+rendering and sending start right away and memory use does not grow
+with the size of the workbook.
+
+The index of every chunk is the sheet row number minus two (header in
+row 1), so recipient_prep.excel_row_number still points at the right
+Excel row.
+
+RecipientSnapshotCache keeps a SQLite snapshot of each workbook, so
+repeated runs against the same file (dry runs, retries, follow-ups)
+skip the Excel parse.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+
+import openpyxl
+import pandas as pd
+
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+def _header(row):
+    return [
+        str(value).strip() if value is not None else f"Unnamed: {i}"
+        for i, value in enumerate(row)
+    ]
+
+
+def _iter_sheet(path, sheet):
+    """
+    Yield the column names first, then ``(index, row)`` for every
+    non-empty row, padded or cut to the width of the header.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.active
+        rows = worksheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = _header(header)
+        yield columns
+
+        width = len(columns)
+        for row_number, row in enumerate(rows, start=2):
+            if all(value is None for value in row):
+                continue
+            # Zeilen im Read-only-Modus können kürzer als die Kopfzeile sein
+            row = tuple(row[:width]) + (None,) * (width - len(row))
+            yield row_number - 2, row
+    finally:
+        workbook.close()
+
+
+def _batches(records, chunk_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= chunk_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _frame(columns, batch):
+    return pd.DataFrame.from_records(
+        [row for _, row in batch], columns=columns,
+        index=[index for index, _ in batch])
+
+
+def read_recipient_chunks(path, sheet=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the rows of ``sheet`` (default: the active sheet) as
+    DataFrames of at most ``chunk_size`` rows. The first row is used as
+    header, empty rows are skipped.
+    """
+    records = _iter_sheet(path, sheet)
+    columns = next(records, None)
+    if columns is None:
+        return
+    for batch in _batches(records, chunk_size):
+        yield _frame(columns, batch)
+
+
+def count_recipient_rows(path, sheet=None):
+    """
+    Number of data rows in ``sheet``. Uses the dimension stored in the
+    workbook (which may include trailing empty rows) and only counts the
+    rows if it is missing.
+    """
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet] if sheet else workbook.active
+        if worksheet.max_row is not None:
+            return max(0, worksheet.max_row - 1)
+        return sum(
+            1 for row in worksheet.iter_rows(min_row=2, values_only=True)
+            if any(value is not None for value in row))
+    finally:
+        workbook.close()
+
+
+def _sqlite_value(value):
+    # Datums-/Zeitwerte als ISO-Text ablegen, alles andere nimmt SQLite
+    # unverändert (int, float, str, None)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    return value
+
+
+class RecipientSnapshotCache:
+    """
+    Caches recipient workbooks as SQLite snapshots.
+
+    The first read streams the workbook as usual and writes every row
+    into a snapshot file as a side effect. Later reads of the same
+    workbook come from the snapshot (memory-mapped SQLite) and skip the
+    Excel parse completely.
+
+    A snapshot is keyed by the absolute path, size, modification time
+    and sheet of the workbook. When the workbook changes a new key
+    results, and outdated snapshots of the same workbook are removed.
+    The cache directory defaults to ``.anthrasend_cache`` next to the
+    workbook and can be set with ANTHRASEND_CACHE_DIR.
+    """
+
+    MMAP_SIZE = 256 * 1024 * 1024
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.environ.get("ANTHRASEND_CACHE_DIR")
+
+    def _directory(self, path):
+        if self.cache_dir:
+            return self.cache_dir
+        return os.path.join(
+            os.path.dirname(os.path.abspath(path)), ".anthrasend_cache")
+
+    @staticmethod
+    def _path_key(path, sheet):
+        source = f"{os.path.abspath(path)}\0{sheet or ''}"
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+    def snapshot_path(self, path, sheet=None):
+        stat = os.stat(path)
+        state = f"{stat.st_size}:{stat.st_mtime_ns}"
+        state_key = hashlib.sha1(state.encode("ascii")).hexdigest()[:16]
+        return os.path.join(
+            self._directory(path),
+            f"{self._path_key(path, sheet)}-{state_key}.sqlite")
+
+    def read_chunks(self, path, sheet=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        snapshot = self.snapshot_path(path, sheet)
+        if os.path.exists(snapshot):
+            yield from self._read_snapshot(snapshot, chunk_size)
+        else:
+            yield from self._build_snapshot(path, sheet, snapshot, chunk_size)
+
+    def count_rows(self, path, sheet=None):
+        snapshot = self.snapshot_path(path, sheet)
+        if not os.path.exists(snapshot):
+            return count_recipient_rows(path, sheet)
+        connection = sqlite3.connect(snapshot)
+        try:
+            return connection.execute(
+                "SELECT COUNT(*) FROM recipients").fetchone()[0]
+        finally:
+            connection.close()
+
+    def _read_snapshot(self, snapshot, chunk_size):
+        connection = sqlite3.connect(snapshot)
+        try:
+            connection.execute(f"PRAGMA mmap_size = {self.MMAP_SIZE}")
+            columns = json.loads(connection.execute(
+                "SELECT value FROM meta WHERE key = 'columns'").fetchone()[0])
+            cursor = connection.execute(
+                "SELECT * FROM recipients ORDER BY row_index")
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield _frame(columns, [(row[0], row[1:]) for row in rows])
+        finally:
+            connection.close()
+
+    def _remove_outdated(self, snapshot, path, sheet):
+        prefix = self._path_key(path, sheet) + "-"
+        directory = os.path.dirname(snapshot)
+        for name in os.listdir(directory):
+            candidate = os.path.join(directory, name)
+            if (name.startswith(prefix) and name.endswith(".sqlite")
+                    and candidate != snapshot):
+                os.remove(candidate)
+
+    def _build_snapshot(self, path, sheet, snapshot, chunk_size):
+        records = _iter_sheet(path, sheet)
+        columns = next(records, None)
+        if columns is None:
+            return
+
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        self._remove_outdated(snapshot, path, sheet)
+        temporary = f"{snapshot}.{os.getpid()}.tmp"
+        connection = sqlite3.connect(temporary)
+        completed = False
+        try:
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value)")
+            connection.execute(
+                "INSERT INTO meta VALUES ('columns', ?)", (json.dumps(columns),))
+            placeholders = ", ".join("?" * (len(columns) + 1))
+            value_columns = ", ".join(f"c{i}" for i in range(len(columns)))
+            connection.execute(
+                "CREATE TABLE recipients "
+                f"(row_index INTEGER PRIMARY KEY, {value_columns})")
+            insert = f"INSERT INTO recipients VALUES ({placeholders})"
+
+            for batch in _batches(records, chunk_size):
+                connection.executemany(insert, (
+                    (index, *map(_sqlite_value, row)) for index, row in batch))
+                yield _frame(columns, batch)
+
+            connection.commit()
+            completed = True
+        finally:
+            connection.close()
+            # Nur vollständig gelesene Arbeitsmappen werden zum Snapshot
+            if completed:
+                os.replace(temporary, snapshot)
+            elif os.path.exists(temporary):
+                os.remove(temporary)
@@ -0,0 +1,176 @@
+"""
+Retry scheduling for transient send failures.
+
+A failed send is classified by its error (classify_error) and the
+policy of that class decides whether and when it is tried again:
+
+    throttled   SMTP 421/452, the server wants fewer messages; the
+                dispatcher also lowers its send rate
+    deferred    other SMTP 4xx replies (greylisting, mailbox busy)
+    connection  dropped connections and timeouts
+    com_busy    Outlook rejected the COM call because it is busy
+    permanent   everything else (5xx, invalid data); never retried
+
+Retries wait for an exponentially growing delay with jitter, so many
+messages deferred at the same moment do not come back all at once. The
+scheduled retries are kept in a RetryQueue, a heap ordered by due time;
+the dispatcher (send_dispatcher.py) takes due retries before new items
+whenever a send slot becomes free, so waiting retries never hold up
+first attempts. Messages that fail permanently or run out of retries
+end up in a DeadLetterQueue, which is written as a CSV report after the
+run.
+"""
+
+import csv
+import heapq
+import itertools
+import random
+import smtplib
+import time
+from collections import Counter, namedtuple
+
+
+THROTTLED = "throttled"
+DEFERRED = "deferred"
+CONNECTION = "connection"
+COM_BUSY = "com_busy"
+PERMANENT = "permanent"
+
+# HRESULTs, mit denen Outlook einen Aufruf ablehnt, solange es beschäftigt
+# ist (RPC_E_CALL_REJECTED, RPC_E_SERVERCALL_RETRYLATER)
+COM_BUSY_HRESULTS = (-2147418111, -2147417846)
+
+# SMTP-Antworten, die sich auf die Senderate beziehen statt auf den
+# einzelnen Empfänger
+THROTTLE_CODES = (421, 452)
+
+RetryPolicy = namedtuple(
+    "RetryPolicy", ["max_retries", "base_delay", "max_delay", "slow_down"],
+    defaults=[False])
+
+DEFAULT_POLICIES = {
+    THROTTLED: RetryPolicy(6, 5.0, 300.0, slow_down=True),
+    DEFERRED: RetryPolicy(5, 30.0, 600.0),
+    CONNECTION: RetryPolicy(4, 1.0, 60.0),
+    COM_BUSY: RetryPolicy(5, 0.5, 10.0),
+}
+
+
+def smtp_code(error):
+    """
+    SMTP reply code of ``error``, or None. For refused recipients the
+    code counts only if all recipients got the same class of reply.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+        if codes and len({code // 100 for code in codes}) == 1:
+            return codes[0]
+        return None
+    code = getattr(error, "smtp_code", None)
+    return code if isinstance(code, int) else None
+
+
+def classify_error(error):
+    if isinstance(error, (smtplib.SMTPServerDisconnected, ConnectionError,
+                          TimeoutError)):
+        return CONNECTION
+    code = smtp_code(error)
+    if code is not None:
+        if code in THROTTLE_CODES:
+            return THROTTLED
+        if 400 <= code < 500:
+            return DEFERRED
+        return PERMANENT
+    # pywintypes.com_error, ohne pywin32 zu importieren
+    if type(error).__name__ == "com_error" and error.args and (
+            error.args[0] in COM_BUSY_HRESULTS):
+        return COM_BUSY
+    return PERMANENT
+
+
+def backoff_delay(policy, retry, rng=random):
+    """
+    Delay before retry number ``retry`` (1-based): half of the capped
+    exponential delay plus a random share of the other half.
+    """
+    delay = min(policy.max_delay, policy.base_delay * 2 ** (retry - 1))
+    return delay / 2 + rng.uniform(0, delay / 2)
+
+
+class RetryQueue:
+    """
+    Scheduled retries as a heap ordered by due time (``time.monotonic``);
+    entries due at the same time keep their order.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, due, entry):
+        heapq.heappush(self._heap, (due, next(self._sequence), entry))
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        """
+        Remove and return the earliest entry if it is due, else None.
+        """
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def drain(self):
+        """
+        Remove and return all entries in due order.
+        """
+        entries = [entry for _, _, entry in sorted(self._heap)]
+        self._heap = []
+        return entries
+
+
+DeadLetter = namedtuple(
+    "DeadLetter",
+    ["recipient", "error_class", "error", "attempts", "failed_at"])
+
+
+class DeadLetterQueue:
+    """
+    Messages that failed permanently or ran out of retries.
+    """
+
+    def __init__(self):
+        self.letters = []
+
+    def __len__(self):
+        return len(self.letters)
+
+    def __iter__(self):
+        return iter(self.letters)
+
+    def add(self, recipient, error_class, error, attempts):
+        self.letters.append(DeadLetter(
+            recipient, error_class, str(error), attempts, time.time()))
+
+    def counts(self):
+        """
+        ``{error_class: count}``, most frequent first.
+        """
+        return dict(Counter(
+            letter.error_class for letter in self.letters).most_common())
+
+    def write_csv(self, path):
+        with open(path, "w", newline="", encoding="utf-8-sig") as file:
+            writer = csv.writer(file, delimiter=";")
+            writer.writerow(
+                ["Empfänger", "Fehlerart", "Fehler", "Versuche", "Zeit"])
+            writer.writerows(
+                (letter.recipient, letter.error_class, letter.error,
+                 letter.attempts,
+                 time.strftime("%Y-%m-%d %H:%M:%S",
+                               time.localtime(letter.failed_at)))
+                for letter in self.letters)
@@ -0,0 +1,510 @@
+"""
+Concurrent dispatching of e-mails with token-bucket rate limiting.
+
+Instead of sleeping a fixed delay after every message, the dispatcher
+keeps up to ``max_in_flight`` sends running at the same time and lets
+token buckets decide when the next message may go out:
+
+    - one bucket for the whole transport (e.g. 30 messages/s),
+    - one bucket per recipient domain (e.g. 5 messages/s to takko.com).
+
+When the server answers with a throttling response (SMTP 421/452), the
+transport rate is halved and all workers pause for an exponentially
+growing back-off; without a configured rate the first throttle halves
+the rate measured over the last seconds. Every successful send raises
+the rate again step by step up to the configured maximum, so the
+campaign settles at whatever the provider actually accepts.
+
+Failed sends are not retried on the worker that made them: transient
+failures are scheduled for a later retry (retry_scheduler.py) and the
+worker moves on to the next message. Permanent failures and messages
+that run out of retries go to the dead-letter queue, if one is given.
+
+With ``max_bcc`` set, runs of items with identical content are sent as
+one message with the recipients in BCC (bcc_fanout.py); results are
+still yielded per item.
+
+With a single send in flight (e.g. Outlook, whose transport allows only
+one) there are no worker threads: every send runs on the thread that
+consumes ``dispatch``, the one that created the transport.
+"""
+
+import collections
+import os
+import smtplib
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+)
+
+from bcc_fanout import FanOut, fan_out, fanout_limit
+from retry_scheduler import (
+    DEFAULT_POLICIES, RetryQueue, backoff_delay, classify_error
+)
+
+
+# Markiert das Ende der Eingabe in dispatch
+_END = object()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    ``rate`` tokens are added per second up to ``capacity``. ``acquire``
+    blocks until a token is available. A rate of ``None`` disables the
+    limit.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate or 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rate is None:
+            self._tokens = self.capacity
+            return
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+
+    def acquire(self):
+        if self.rate is None:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+
+class AdaptiveRateLimiter:
+    """
+    Token bucket whose rate follows the server's throttling responses
+    (additive increase, multiplicative decrease). Without ``max_rate``
+    the first throttle halves the send rate measured over the last
+    ``WINDOW`` seconds.
+    """
+
+    # Sekunden, über die die Senderate gemessen wird
+    WINDOW = 5.0
+
+    def __init__(self, max_rate, min_rate=0.2, increase=0.5,
+                 base_backoff=1.0, max_backoff=300.0):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.increase = increase
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.bucket = TokenBucket(max_rate)
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self._successes = collections.deque()
+
+    @property
+    def paused(self):
+        with self._lock:
+            return self._paused_until > time.monotonic()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                pause = self._paused_until - time.monotonic()
+            if pause <= 0:
+                break
+            time.sleep(pause)
+        self.bucket.acquire()
+
+    def on_success(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            if self.bucket.rate is None:
+                # Unbegrenzt: Rate messen, für die erste Drosselung
+                now = time.monotonic()
+                self._successes.append(now)
+                while self._successes[0] < now - self.WINDOW:
+                    self._successes.popleft()
+            elif self.max_rate is None or self.bucket.rate < self.max_rate:
+                rate = self.bucket.rate + self.increase
+                if self.max_rate is not None:
+                    rate = min(self.max_rate, rate)
+                self.bucket.set_rate(rate)
+
+    def _measured_rate(self):
+        if len(self._successes) < 2:
+            return self.min_rate
+        span = time.monotonic() - self._successes[0]
+        return len(self._successes) / max(span, 1e-3)
+
+    def on_throttled(self):
+        with self._lock:
+            self._consecutive_throttles += 1
+            backoff = min(
+                self.max_backoff,
+                self.base_backoff * 2 ** (self._consecutive_throttles - 1))
+            self._paused_until = max(
+                self._paused_until, time.monotonic() + backoff)
+            rate = self.bucket.rate
+            if rate is None:
+                rate = self._measured_rate()
+                self._successes.clear()
+            self.bucket.set_rate(max(self.min_rate, rate / 2))
+        return backoff
+
+
+def recipient_domain(to_email):
+    return to_email.rsplit("@", 1)[-1].strip().lower()
+
+
+def _recipient_error(error, recipient):
+    # Von der Ablehnung einer BCC-Nachricht nur den eigenen Teil melden
+    if (isinstance(error, smtplib.SMTPRecipientsRefused)
+            and len(error.recipients) > 1 and recipient in error.recipients):
+        return smtplib.SMTPRecipientsRefused(
+            {recipient: error.recipients[recipient]})
+    return error
+
+
+class _InlineExecutor:
+    """
+    Executor that runs every call at once on the submitting thread.
+    """
+
+    def submit(self, function, *args):
+        future = Future()
+        try:
+            future.set_result(function(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _Attempt:
+    """
+    State of one item across its send attempts.
+    """
+
+    __slots__ = ("item", "job", "send", "render_time", "transport_time",
+                 "retries", "error")
+
+    def __init__(self, item, job, send, render_time):
+        self.item = item
+        self.job = job
+        self.send = send
+        self.render_time = render_time
+        self.transport_time = 0.0
+        self.retries = 0
+        self.error = None
+
+
+class SendDispatcher:
+    """
+    Sends items through a transport with several sends in flight and
+    yields ``(item, error)`` in completion order. ``error`` is None for a
+    successful send. ``as_job`` turns an item into the arguments
+    ``(to_email, subject, body)`` of ``transport.send``; by default the
+    items already are such tuples. With ``prebuilt`` the jobs are
+    ``(to_email, message)`` for ``transport.send_message`` instead.
+
+    Transient failures are retried according to ``retry_policies``
+    (default retry_scheduler.DEFAULT_POLICIES); an item is yielded once,
+    with the error of its last attempt. Permanent failures, exhausted
+    retries and retries given up (give_up_retries) are added to
+    ``dead_letters`` (retry_scheduler.DeadLetterQueue) if given.
+
+    With ``max_bcc``, runs of consecutive items with identical subject
+    and body are sent with ``transport.send_bcc``, up to ``max_bcc``
+    recipients per message (not for ``prebuilt`` jobs). Each of their
+    items is still yielded on its own; recipients refused by the server
+    get their own error and, if transient, their own retry. A BCC
+    message that fails permanently as a whole is sent again to each
+    recipient on its own.
+
+    Results are yielded on the calling thread, so UI updates (progress
+    bar, message boxes) can be done directly in the consuming loop. With
+    ``max_in_flight`` 1 the sends run on the calling thread as well.
+    If ``metrics`` (send_metrics.SendMetrics) is given, render time,
+    transport time and retries of every message are recorded there, on
+    the calling thread as well; a BCC message counts for each of its
+    recipients with an equal share of its times.
+    """
+
+    def __init__(self, transport, max_in_flight=4, rate=None,
+                 domain_rate=None, retry_policies=None, metrics=None,
+                 dead_letters=None, max_bcc=None):
+        # Outlook lässt nur eine Sendung zu, siehe max_concurrency
+        limit = getattr(transport, "max_concurrency", None)
+        if limit is not None:
+            max_in_flight = min(max_in_flight, limit)
+
+        self.transport = transport
+        self.max_in_flight = max(1, max_in_flight)
+        self.limiter = AdaptiveRateLimiter(rate)
+        self.domain_rate = domain_rate
+        self.retry_policies = (DEFAULT_POLICIES if retry_policies is None
+                               else retry_policies)
+        self.metrics = metrics
+        self.dead_letters = dead_letters
+        self.max_bcc = max_bcc
+
+        self._domain_buckets = {}
+        self._domain_lock = threading.Lock()
+        self._give_up = threading.Event()
+
+    def _domain_bucket(self, domain):
+        with self._domain_lock:
+            bucket = self._domain_buckets.get(domain)
+            if bucket is None:
+                bucket = TokenBucket(self.domain_rate)
+                self._domain_buckets[domain] = bucket
+        return bucket
+
+    def give_up_retries(self):
+        """
+        Yield scheduled retries with the error of their last attempt
+        instead of waiting for them, and schedule no new ones. Together
+        with ending the input this ends a run early; every item taken is
+        still yielded. Thread-safe.
+        """
+        self._give_up.set()
+
+    def _send(self, job, send):
+        """
+        One attempt. Returns ``(transport_time, error, error_class,
+        refused)``, with ``refused`` the recipients of a BCC message that
+        the server did not accept; the time spent waiting for the rate
+        limiters is not counted as transport time.
+        """
+        to = job[0]
+        recipients = (to,) if isinstance(to, str) else to
+        # Eine Nachricht je Domain, auch mit vielen Empfängern im BCC
+        for domain in dict.fromkeys(map(recipient_domain, recipients)):
+            self._domain_bucket(domain).acquire()
+        self.limiter.acquire()
+        start = time.perf_counter()
+        try:
+            refused = send(*job)
+        except Exception as e:
+            transport_time = time.perf_counter() - start
+            error_class = classify_error(e)
+            policy = self.retry_policies.get(error_class)
+            if policy is not None and policy.slow_down:
+                self.limiter.on_throttled()
+            return transport_time, e, error_class, None
+        transport_time = time.perf_counter() - start
+        self.limiter.on_success()
+        return transport_time, None, None, refused
+
+    def dispatch(self, items, as_job=tuple, prebuilt=False):
+        send = (self.transport.send_message if prebuilt
+                else self.transport.send)
+        if self.max_bcc and not prebuilt:
+            jobs = fan_out(items, as_job, self.max_bcc)
+        else:
+            jobs = ((item, as_job(item)) for item in items)
+        retries = RetryQueue()
+        exhausted = False
+        # Einzeln im eigenen Thread senden: COM-Objekte (Outlook) gehören
+        # zum Thread, der sie erzeugt hat
+        executor = (_InlineExecutor() if self.max_in_flight == 1
+                    else ThreadPoolExecutor(max_workers=self.max_in_flight))
+        with executor:
+            pending = {}
+            while True:
+                if self._give_up.is_set():
+                    # Mit dem Fehler des letzten Versuchs melden
+                    for attempt in retries.drain():
+                        self._dead_letter(
+                            attempt, classify_error(attempt.error))
+                        yield from self._finish(attempt)
+                # Freie Plätze: fällige Wiederholungen vor neuen Jobs
+                while len(pending) < self.max_in_flight:
+                    attempt = retries.pop_due(time.monotonic())
+                    if attempt is None:
+                        if exhausted:
+                            break
+                        # Zeit bis zum nächsten Job = Lesen und Rendern
+                        start = time.perf_counter()
+                        item, job = next(jobs, (_END, None))
+                        if item is _END:
+                            exhausted = True
+                            break
+                        attempt = _Attempt(
+                            item, job,
+                            (self.transport.send_bcc
+                             if isinstance(item, FanOut) else send),
+                            time.perf_counter() - start)
+                    else:
+                        attempt.retries += 1
+                    future = executor.submit(
+                        self._send, attempt.job, attempt.send)
+                    pending[future] = attempt
+                if not pending and not retries:
+                    break
+                timeout = None
+                if len(pending) < self.max_in_flight and retries:
+                    timeout = max(0.0, retries.next_due() - time.monotonic())
+                if not pending:
+                    # Nur noch geplante Wiederholungen; give_up_retries
+                    # weckt auf
+                    self._give_up.wait(timeout)
+                    continue
+                yield from self._collect(pending, retries, timeout)
+
+    def _collect(self, pending, retries, timeout=None):
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            attempt = pending.pop(future)
+            transport_time, error, error_class, refused = future.result()
+            attempt.transport_time += transport_time
+            attempt.error = error
+            if refused:
+                yield from self._split_refused(attempt, refused, retries)
+            if error is not None:
+                policy = self.retry_policies.get(error_class)
+                giving_up = self._give_up.is_set()
+                if (policy is not None and not giving_up
+                        and attempt.retries < policy.max_retries):
+                    retries.schedule(
+                        time.monotonic()
+                        + backoff_delay(policy, attempt.retries + 1),
+                        attempt)
+                    continue
+                if (policy is None and not giving_up
+                        and isinstance(attempt.item, FanOut)
+                        and not isinstance(
+                            error, smtplib.SMTPRecipientsRefused)
+                        and not getattr(error, "in_doubt", False)):
+                    # Die Ablehnung der ganzen BCC-Nachricht kann an einem
+                    # einzelnen Empfänger liegen: alle einzeln nachsenden
+                    now = time.monotonic()
+                    for item, recipient in attempt.item.remove(
+                            set(attempt.item.recipients)):
+                        retries.schedule(
+                            now, self._single(attempt, item, recipient))
+                    continue
+                # Endgültig, Wiederholungen erschöpft oder aufgegeben
+                self._dead_letter(attempt, error_class)
+            yield from self._finish(attempt)
+
+    def _split_refused(self, attempt, refused, retries):
+        """
+        Take the recipients the server refused out of a sent FanOut.
+        Transient refusals are scheduled as single sends, the others
+        are yielded with their own error.
+        """
+        for item, recipient in attempt.item.remove(refused):
+            error = _recipient_error(
+                smtplib.SMTPRecipientsRefused(refused), recipient)
+            error_class = classify_error(error)
+            single = self._single(attempt, item, recipient)
+            single.error = error
+            policy = self.retry_policies.get(error_class)
+            if (policy is not None and not self._give_up.is_set()
+                    and single.retries < policy.max_retries):
+                retries.schedule(
+                    time.monotonic()
+                    + backoff_delay(policy, single.retries + 1),
+                    single)
+                continue
+            self._dead_letter(single, error_class)
+            yield from self._finish(single)
+
+    def _single(self, attempt, item, recipient):
+        """
+        Attempt to send one recipient of a FanOut on its own, with its
+        share of the times spent so far.
+        """
+        group = attempt.item
+        share = len(attempt.job[0])
+        single = _Attempt(
+            item, (recipient, group.subject, group.body),
+            self.transport.send, attempt.render_time / share)
+        single.transport_time = attempt.transport_time / share
+        single.retries = attempt.retries
+        # Gilt, bis der eigene Versuch gelaufen ist (give_up_retries)
+        single.error = attempt.error
+        return single
+
+    def _dead_letter(self, attempt, error_class):
+        """
+        Add the recipients of a finally failed attempt to
+        ``dead_letters``, with the number of attempts made.
+        """
+        if self.dead_letters is None:
+            return
+        for _, recipient in self._results(attempt):
+            self.dead_letters.add(
+                recipient, error_class,
+                _recipient_error(attempt.error, recipient),
+                attempt.retries + 1)
+
+    @staticmethod
+    def _results(attempt):
+        if isinstance(attempt.item, FanOut):
+            return zip(attempt.item.items, attempt.item.recipients)
+        return ((attempt.item, attempt.job[0]),)
+
+    def _finish(self, attempt):
+        """
+        Yield ``(item, error)``, for a FanOut once per item.
+        """
+        # Anteil je Empfänger, auch wenn abgelehnte schon herausgenommen sind
+        share = (len(attempt.job[0]) if isinstance(attempt.item, FanOut)
+                 else 1)
+        for item, recipient in self._results(attempt):
+            error = _recipient_error(attempt.error, recipient)
+            if self.metrics is not None:
+                self.metrics.record(
+                    recipient, error, attempt.render_time / share,
+                    attempt.transport_time / share, attempt.retries)
+            yield item, error
+
+
+def create_dispatcher(transport, metrics=None, dead_letters=None):
+    """
+    Create a dispatcher configured through environment variables.
+
+    ANTHRASEND_CONCURRENCY sets the number of sends in flight (default:
+    the transport's max_concurrency, else 4), ANTHRASEND_RATE the
+    maximum messages per second of the transport and
+    ANTHRASEND_DOMAIN_RATE the maximum messages per second per recipient
+    domain. Unset rates are unlimited. ANTHRASEND_BCC_MAX enables the
+    BCC fan-out, see bcc_fanout.fanout_limit.
+    """
+    def optional_float(name):
+        value = os.environ.get(name)
+        return float(value) if value else None
+
+    return SendDispatcher(
+        transport,
+        max_in_flight=int(
+            os.environ.get("ANTHRASEND_CONCURRENCY")
+            or getattr(transport, "max_concurrency", None) or 4),
+        rate=optional_float("ANTHRASEND_RATE"),
+        domain_rate=optional_float("ANTHRASEND_DOMAIN_RATE"),
+        metrics=metrics,
+        dead_letters=dead_letters,
+        max_bcc=fanout_limit(),
+    )
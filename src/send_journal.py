@@ -0,0 +1,198 @@
+"""
+Write-ahead send journal for resumable campaigns.
+
+Every recipient of a campaign goes through the states
+
+    queued  ->  sent | failed
+
+and each transition is stored in a SQLite database in WAL mode.
+Each recipient is marked 'queued' and committed right before it is
+handed on to the dispatcher, which sends it as soon as a slot is free,
+so only recipients that actually reached the send window can be in
+doubt. Results are buffered and written in the same transaction as the
+next 'queued' mark (or in batches at the end), so the journal costs
+about one commit per message.
+
+When a run is restarted:
+    - 'sent' recipients are skipped,
+    - 'failed' recipients are sent again,
+    - 'queued' recipients are in doubt (the process died between handing
+      the message to the transport and committing the result, or the
+      SMTP connection broke after DATA). They are
+      skipped and reported, so a hard kill can never cause a duplicate;
+      set ``resend_in_doubt`` (ANTHRASEND_RESEND_IN_DOUBT=1) to send them
+      again instead.
+"""
+
+import hashlib
+import os
+import sqlite3
+import time
+
+
+QUEUED = "queued"
+SENT = "sent"
+FAILED = "failed"
+
+
+def campaign_id(excel_file, catalog_fingerprint):
+    """
+    Default campaign key: the same workbook sent with the same templates
+    is the same campaign. ANTHRASEND_CAMPAIGN overrides it.
+    """
+    override = os.environ.get("ANTHRASEND_CAMPAIGN")
+    if override:
+        return override
+    source = f"{os.path.abspath(excel_file)}\0{catalog_fingerprint}"
+    return hashlib.sha1(source.encode("utf-8")).hexdigest()[:16]
+
+
+class SendJournal:
+    def __init__(self, db_path, campaign, batch_size=50, flush_interval=1.0,
+                 resend_in_doubt=False):
+        self.campaign = campaign
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.resend_in_doubt = resend_in_doubt
+
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        # NORMAL reicht im WAL-Modus: Commits überleben einen Prozessabbruch
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS send_journal (
+                campaign TEXT NOT NULL,
+                recipient TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (campaign, recipient)
+            )
+            """
+        )
+        self.connection.commit()
+
+        self._results = []
+        self._last_flush = time.monotonic()
+        self.skipped_sent = 0
+        self.skipped_in_doubt = []
+
+    def _recipients_in(self, state):
+        rows = self.connection.execute(
+            "SELECT recipient FROM send_journal "
+            "WHERE campaign = ? AND state = ?", (self.campaign, state))
+        return {recipient for recipient, in rows}
+
+    def _mark_queued(self, recipient):
+        with self.connection:
+            # Gepufferte Ergebnisse im selben Commit mitschreiben
+            self._write_results()
+            self.connection.execute(
+                """
+                INSERT INTO send_journal
+                    (campaign, recipient, state, attempts, updated_at)
+                VALUES (?, ?, 'queued', 1, ?)
+                ON CONFLICT (campaign, recipient) DO UPDATE SET
+                    state = 'queued',
+                    attempts = attempts + 1,
+                    error = NULL,
+                    updated_at = excluded.updated_at
+                """,
+                (self.campaign, recipient, time.time()))
+
+    def count_skipped(self, recipients):
+        """
+        Number of ``recipients`` that ``track`` will skip because they
+        were already sent or are in doubt, e.g. to size a progress bar.
+        """
+        skipped = self._recipients_in(SENT)
+        if not self.resend_in_doubt:
+            skipped |= self._recipients_in(QUEUED)
+        return sum(recipient in skipped for recipient in recipients)
+
+    def track(self, items, key):
+        """
+        Filter ``items`` down to the recipients that still have to be
+        sent and journal each as 'queued' right before it is handed on.
+        ``key`` returns the recipient address of an item.
+        """
+        sent = self._recipients_in(SENT)
+        in_doubt = self._recipients_in(QUEUED)
+        if self.resend_in_doubt:
+            in_doubt = set()
+        seen = set()
+
+        for item in items:
+            recipient = key(item)
+            if recipient in sent:
+                self.skipped_sent += 1
+                continue
+            if recipient in in_doubt:
+                self.skipped_in_doubt.append(recipient)
+                continue
+            if recipient in seen:
+                continue
+            seen.add(recipient)
+            self._mark_queued(recipient)
+            yield item
+
+    def record(self, recipient, error=None):
+        """
+        Buffer the outcome of a send; committed with the next batch.
+        Errors marked ``in_doubt`` (mail_transport.DeliveryInDoubt) keep
+        the recipient 'queued', as if the process had died mid-send.
+        """
+        if error is None:
+            state = SENT
+        elif getattr(error, "in_doubt", False):
+            state = QUEUED
+        else:
+            state = FAILED
+        message = None if error is None else str(error)
+        self._results.append(
+            (state, message, time.time(), self.campaign, recipient))
+        if (len(self._results) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _write_results(self):
+        if self._results:
+            self.connection.executemany(
+                "UPDATE send_journal SET state = ?, error = ?, "
+                "updated_at = ? WHERE campaign = ? AND recipient = ?",
+                self._results)
+            self._results = []
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        with self.connection:
+            self._write_results()
+
+    def summary(self):
+        rows = self.connection.execute(
+            "SELECT state, COUNT(*) FROM send_journal "
+            "WHERE campaign = ? GROUP BY state", (self.campaign,))
+        return dict(rows)
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def create_send_journal(db_path, campaign, resend_in_doubt=None):
+    """
+    SendJournal at ``db_path``; ``resend_in_doubt`` defaults to
+    ANTHRASEND_RESEND_IN_DOUBT ('1' sends in-doubt recipients again).
+    """
+    if resend_in_doubt is None:
+        resend_in_doubt = os.environ.get(
+            "ANTHRASEND_RESEND_IN_DOUBT", "0") == "1"
+    return SendJournal(db_path, campaign, resend_in_doubt=resend_in_doubt)
@@ -0,0 +1,241 @@
+"""
+Per-message send metrics for campaigns.
+
+For every message the dispatcher (send_dispatcher.py) reports render
+time, transport time, number of retries and outcome. SendMetrics
+aggregates them into
+
+    - counters per outcome and a retry counter,
+    - histograms of render and transport time (fixed buckets, so
+      recording is a bisect and two additions),
+    - a rolling throughput over the last ``window`` seconds and the ETA
+      derived from it,
+
+and exports them, if a directory is configured, as
+
+    - ``<campaign>.prom``: Prometheus text format, rewritten atomically
+      every ``export_interval`` seconds (node_exporter textfile
+      collector or any scraper that reads files),
+    - ``<campaign>.jsonl``: one JSON line per message, appended, so runs
+      can be compared over time.
+
+All calls happen on the thread that consumes the dispatcher's results,
+so no locking is needed; the cost per message is a few microseconds.
+"""
+
+import bisect
+import json
+import os
+import time
+from collections import deque
+
+
+# Sekunden; die letzte Grenze ist +Inf
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+SENT = "sent"
+FAILED = "failed"
+
+
+class LatencyHistogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the ``q`` quantile.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def prometheus(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+def _format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes:02d}:{seconds:02d}"
+
+
+class SendMetrics:
+    def __init__(self, campaign, total=None, directory=None, window=30.0,
+                 export_interval=5.0):
+        self.campaign = campaign
+        self.total = total
+        self.window = window
+        self.export_interval = export_interval
+
+        self.outcomes = {SENT: 0, FAILED: 0}
+        self.retries = 0
+        self.render = LatencyHistogram()
+        self.transport = LatencyHistogram()
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self._completions = deque()
+        self._last_export = self._started
+
+        self.prometheus_path = None
+        self._jsonl = None
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self.prometheus_path = os.path.join(directory, f"{campaign}.prom")
+            self._jsonl = open(os.path.join(directory, f"{campaign}.jsonl"),
+                               "a", encoding="utf-8")
+
+    @property
+    def done(self):
+        return self.outcomes[SENT] + self.outcomes[FAILED]
+
+    def record(self, recipient, error, render_time, transport_time, retries):
+        now = time.perf_counter()
+        outcome = SENT if error is None else FAILED
+        self.outcomes[outcome] += 1
+        self.retries += retries
+        self.render.observe(render_time)
+        self.transport.observe(transport_time)
+
+        self._completions.append(now)
+        while self._completions[0] < now - self.window:
+            self._completions.popleft()
+
+        if self._jsonl is not None:
+            self._jsonl.write(json.dumps({
+                "ts": round(time.time(), 3),
+                "campaign": self.campaign,
+                "recipient": recipient,
+                "outcome": outcome,
+                "render_ms": round(render_time * 1000, 3),
+                "transport_ms": round(transport_time * 1000, 3),
+                "retries": retries,
+                "error": None if error is None else str(error),
+            }, ensure_ascii=False) + "\n")
+        if now - self._last_export >= self.export_interval:
+            self.export()
+
+    def throughput(self):
+        """
+        Messages per second over the rolling window (or since the start,
+        if that is shorter).
+        """
+        if not self._completions:
+            return 0.0
+        now = time.perf_counter()
+        span = min(self.window, now - self._started)
+        return len(self._completions) / span if span > 0 else 0.0
+
+    def eta(self):
+        """
+        Estimated seconds until all ``total`` messages are done, or None.
+        """
+        rate = self.throughput()
+        if self.total is None or rate <= 0:
+            return None
+        return max(0, self.total - self.done) / rate
+
+    def progress_text(self):
+        done = f"{self.done}/{self.total}" if self.total else f"{self.done}"
+        text = (f"{done} verarbeitet, {self.outcomes[FAILED]} Fehler, "
+                f"{self.throughput():.1f} Mails/s")
+        eta = self.eta()
+        if eta is not None:
+            text += f", Rest ca. {_format_duration(eta)}"
+        return text
+
+    def prometheus(self):
+        labels = f'campaign="{self.campaign}"'
+        lines = [
+            "# TYPE anthrasend_messages_total counter",
+            *(f'anthrasend_messages_total{{{labels},outcome="{outcome}"}} '
+              f"{count}" for outcome, count in self.outcomes.items()),
+            "# TYPE anthrasend_retries_total counter",
+            f"anthrasend_retries_total{{{labels}}} {self.retries}",
+            "# TYPE anthrasend_render_seconds histogram",
+            *self.render.prometheus("anthrasend_render_seconds", labels),
+            "# TYPE anthrasend_transport_seconds histogram",
+            *self.transport.prometheus("anthrasend_transport_seconds", labels),
+            "# TYPE anthrasend_throughput_messages_per_second gauge",
+            f"anthrasend_throughput_messages_per_second{{{labels}}} "
+            f"{self.throughput():.3f}",
+            "# TYPE anthrasend_started_timestamp_seconds gauge",
+            f"anthrasend_started_timestamp_seconds{{{labels}}} "
+            f"{self.started_at:.0f}",
+        ]
+        eta = self.eta()
+        if eta is not None:
+            lines += [
+                "# TYPE anthrasend_eta_seconds gauge",
+                f"anthrasend_eta_seconds{{{labels}}} {eta:.1f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        self._last_export = time.perf_counter()
+        if self._jsonl is not None:
+            self._jsonl.flush()
+        if self.prometheus_path is not None:
+            # Atomar ersetzen, damit ein Scraper nie eine halbe Datei liest
+            temporary = self.prometheus_path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                file.write(self.prometheus())
+            os.replace(temporary, self.prometheus_path)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._started
+        return (
+            f"{self.outcomes[SENT]} gesendet, {self.outcomes[FAILED]} "
+            f"fehlgeschlagen, {self.retries} Wiederholungen in "
+            f"{_format_duration(elapsed)}; Transport p50/p95/p99: "
+            f"{self.transport.quantile(0.5) * 1000:.0f}/"
+            f"{self.transport.quantile(0.95) * 1000:.0f}/"
+            f"{self.transport.quantile(0.99) * 1000:.0f} ms"
+        )
+
+    def close(self):
+        self.export()
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def create_send_metrics(campaign, total=None):
+    """
+    SendMetrics exporting to ANTHRASEND_METRICS_DIR if set, otherwise
+    in memory only (progress display and summary).
+    """
+    return SendMetrics(
+        campaign, total, directory=os.environ.get("ANTHRASEND_METRICS_DIR"))
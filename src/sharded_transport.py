@@ -0,0 +1,492 @@
+"""
+Sending through several sender accounts.
+
+A single SMTP account or Outlook profile caps both the daily volume and
+the throughput of a campaign. ShardedTransport spreads the messages over
+several accounts. Each account has its own transport (and with it its
+own SMTP connection pool), its own rate limit and its own daily quota.
+It is a MailTransport like the others, so the dispatcher, send journal,
+BCC fan-out and metrics work unchanged; the dispatcher runs as many
+sends at once as all account pools together allow.
+
+The ShardCoordinator decides which account sends a message:
+
+    hash    consistent hashing of the recipient address on a ring with
+            virtual nodes per account, in proportion to its weight: a
+            recipient keeps getting mail from the same account, and
+            adding or removing an account moves only that account's
+            share; while all connections of that account are busy the
+            mail goes to the next one on the ring (bounded loads), so no
+            account waits while another is idle
+    quota   weighted quota: the account that has used the smallest part
+            of its weight today (the weight defaults to the daily quota)
+
+and moves work away from accounts that cannot send:
+
+    - an account that reaches its daily quota, or whose server reports a
+      sending limit (X.4.5, "sending quota"), rests until the next day;
+      usage is kept in ANTHRASEND_ACCOUNT_USAGE across runs,
+    - an account that is throttled (421/452) or cannot be reached is
+      paused with exponential backoff and its rate halved,
+    - an account whose login or sender address is refused is disabled
+      for the run,
+
+and the message goes to the next account (on the hash ring). Only if no
+account is left the send fails with AccountsUnavailable: 421 while an
+account is merely paused, so the dispatcher retries it, and 550 once
+every account is used up for the day, so the recipient is reported as
+failed and sent again by the next run.
+
+ANTHRASEND_ACCOUNTS names a JSON file with the accounts:
+
+    {
+      "strategy": "hash",
+      "accounts": [
+        {"name": "info", "host": "smtp.example.org", "port": 587,
+         "starttls": true, "user": "info@example.org",
+         "password_env": "INFO_PASSWORD", "sender": "info@example.org",
+         "pool_size": 4, "rate": 10, "daily_quota": 10000},
+        {"name": "news", "transport": "outlook",
+         "account": "news@example.org", "daily_quota": 5000}
+      ]
+    }
+
+Passwords are read from the environment variable named in
+``password_env``, never from the file. Outlook accounts share the one
+Outlook process, so they add daily volume but not throughput. Sharded
+over Outlook accounts only, the mails are sent one at a time on the
+calling thread; mixed with SMTP accounts, every worker thread that
+sends through Outlook uses its own COM connection (see OutlookTransport). Messages
+from the spool keep the From header they were rendered with; only the
+envelope sender follows the account.
+"""
+
+import bisect
+import datetime
+import hashlib
+import json
+import os
+import re
+import smtplib
+import sqlite3
+import threading
+
+from mail_transport import (
+    MailTransport, OutlookTransport, SmtpConnectionPool, SmtpTransport,
+    TransportStats)
+from retry_scheduler import CONNECTION, DEFERRED, THROTTLED, classify_error
+from send_dispatcher import AdaptiveRateLimiter
+
+
+HASH = "hash"
+QUOTA = "quota"
+
+# Fehler, die das Konto betreffen statt die Nachricht
+EXHAUSTED = "exhausted"
+PAUSED = "paused"
+DISABLED = "disabled"
+
+# Sendelimit des Kontos (nicht: Postfach des Empfängers voll)
+QUOTA_PATTERN = re.compile(
+    r"\b[45]\.4\.5\b|submissionquota"
+    r"|\b(?:send(?:ing)?|daily|message) (?:quota|limit)",
+    re.IGNORECASE)
+
+
+class AccountsUnavailable(smtplib.SMTPResponseException):
+    """
+    No account can send the message: 421 while accounts are only paused,
+    550 if none can send again today.
+    """
+
+
+def account_problem(error):
+    """
+    EXHAUSTED, PAUSED or DISABLED if ``error`` concerns the sending
+    account, None if it concerns the message or its recipients.
+    """
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        # Manche Server melden das Sendelimit erst beim RCPT
+        if all(QUOTA_PATTERN.search(str(response))
+               for _, response in error.recipients.values()):
+            return EXHAUSTED
+        return None
+    message = str(error)
+    if isinstance(error, (smtplib.SMTPSenderRefused,
+                          smtplib.SMTPDataError,
+                          smtplib.SMTPAuthenticationError)):
+        if QUOTA_PATTERN.search(message):
+            return EXHAUSTED
+        if classify_error(error) in (THROTTLED, DEFERRED):
+            return PAUSED
+        if isinstance(error, smtplib.SMTPDataError):
+            return None
+        return DISABLED
+    if isinstance(error, smtplib.SMTPConnectError):
+        return PAUSED
+    if classify_error(error) in (THROTTLED, CONNECTION):
+        return EXHAUSTED if QUOTA_PATTERN.search(message) else PAUSED
+    if isinstance(error, OSError) and not isinstance(
+            error, smtplib.SMTPException):
+        # Server nicht erreichbar (DNS, Verbindung abgelehnt)
+        return PAUSED
+    return None
+
+
+class Account:
+    """
+    One sender account: its transport, rate limiter, daily quota and
+    today's usage. ``weight`` defaults to the daily quota.
+    """
+
+    def __init__(self, name, transport, rate=None, daily_quota=None,
+                 weight=None):
+        self.name = name
+        self.transport = transport
+        self.limiter = AdaptiveRateLimiter(rate)
+        self.daily_quota = daily_quota
+        self.weight = weight or daily_quota or 1
+        self.used = 0
+        # Reservierte Empfänger und laufende Sendungen
+        self.in_flight = 0
+        self.sending = 0
+        # Tag, an dem das Konto sein Limit erreicht hat
+        self.exhausted_on = None
+        # Grund, falls für diesen Lauf abgeschaltet
+        self.disabled = None
+
+    def __repr__(self):
+        return f"Account({self.name!r})"
+
+    @property
+    def busy(self):
+        return self.sending >= (self.transport.max_concurrency or 1)
+
+    def has_quota(self, count):
+        return (self.daily_quota is None
+                or self.used + self.in_flight + count <= self.daily_quota)
+
+
+def _hash(value):
+    return int.from_bytes(
+        hashlib.sha1(value.encode("utf-8")).digest()[:8], "big")
+
+
+class ShardCoordinator:
+    """
+    Chooses the account for each message and tracks which accounts can
+    send. Thread-safe; ``usage`` (AccountUsage) keeps the daily counts.
+    """
+
+    # Virtuelle Knoten je Konto im Hash-Ring (im Mittel)
+    VIRTUAL_NODES = 64
+
+    def __init__(self, accounts, strategy=HASH, usage=None):
+        if strategy not in (HASH, QUOTA):
+            raise ValueError(f"Unknown sharding strategy: {strategy}")
+        if not accounts:
+            raise ValueError("No sender accounts configured")
+        self.accounts = list(accounts)
+        self.strategy = strategy
+        self.usage = usage
+        self._lock = threading.Lock()
+        self._day = None
+
+        total = sum(account.weight for account in self.accounts)
+        ring = []
+        for index, account in enumerate(self.accounts):
+            nodes = max(1, round(self.VIRTUAL_NODES * len(self.accounts)
+                                 * account.weight / total))
+            ring.extend((_hash(f"{account.name}#{node}"), index)
+                        for node in range(nodes))
+        ring.sort()
+        self._points = [point for point, _ in ring]
+        self._owners = [index for _, index in ring]
+
+    def _roll_day(self):
+        today = datetime.date.today().isoformat()
+        if today != self._day:
+            # Neuer Tag: Kontingente aus der Datenbank (sonst 0) laden
+            self._day = today
+            for account in self.accounts:
+                account.used = (self.usage.sent(account.name, today)
+                                if self.usage is not None else 0)
+
+    def _can_send(self, account, count):
+        return (account.disabled is None
+                and account.exhausted_on != self._day
+                and account.has_quota(count)
+                and not account.limiter.paused)
+
+    def _candidates(self, key):
+        if self.strategy == QUOTA:
+            return sorted(self.accounts,
+                          key=lambda a: (a.used + a.in_flight) / a.weight)
+        # Im Ring ab der Position des Schlüssels weiterlaufen
+        start = bisect.bisect(self._points, _hash(key.casefold()))
+        order = {}
+        for offset in range(len(self._owners)):
+            index = self._owners[(start + offset) % len(self._owners)]
+            if index not in order:
+                order[index] = self.accounts[index]
+                if len(order) == len(self.accounts):
+                    break
+        return order.values()
+
+    def acquire(self, key, count=1, tried=()):
+        """
+        Reserve an account for a message with ``count`` recipients,
+        skipping the accounts in ``tried``.
+        """
+        with self._lock:
+            self._roll_day()
+            candidates = [account for account in self._candidates(key)
+                          if account not in tried
+                          and self._can_send(account, count)]
+            if candidates:
+                account = next((account for account in candidates
+                                if not account.busy), candidates[0])
+                account.in_flight += count
+                account.sending += 1
+                return account
+            if any(account.disabled is None
+                   and account.exhausted_on != self._day
+                   and account.has_quota(count)
+                   for account in self.accounts):
+                raise AccountsUnavailable(
+                    421, "4.3.2 Kein Absenderkonto frei (gedrosselt oder "
+                         "nicht erreichbar)")
+            disabled = "; ".join(f"{account.name}: {account.disabled}"
+                                 for account in self.accounts
+                                 if account.disabled is not None)
+            raise AccountsUnavailable(
+                550, "5.4.5 Alle Absenderkonten sind für heute ausgeschöpft "
+                     "oder gesperrt" + (f" ({disabled})" if disabled else ""))
+
+    def succeeded(self, account, count=1):
+        with self._lock:
+            account.in_flight -= count
+            account.sending -= 1
+            account.used += count
+            day = self._day
+        account.limiter.on_success()
+        if self.usage is not None:
+            self.usage.add(account.name, day, count)
+
+    def failed(self, account, error, count=1):
+        """
+        Release the reservation after a failed send. Returns True if the
+        error concerns the account and the message should be sent
+        through another one.
+        """
+        problem = account_problem(error)
+        with self._lock:
+            account.in_flight -= count
+            account.sending -= 1
+            if problem == EXHAUSTED:
+                account.exhausted_on = self._day
+            elif problem == DISABLED:
+                account.disabled = str(error)
+        if problem == PAUSED:
+            account.limiter.on_throttled()
+        return problem is not None
+
+
+class AccountUsage:
+    """
+    Recipients sent per account and day in SQLite, so daily quotas hold
+    across runs. Counts are committed in batches.
+    """
+
+    def __init__(self, db_path, batch_size=50):
+        self.batch_size = batch_size
+        # Wird aus den Sende-Threads geschrieben, daher mit eigener Sperre
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS account_usage (
+                account TEXT NOT NULL,
+                day TEXT NOT NULL,
+                sent INTEGER NOT NULL,
+                PRIMARY KEY (account, day)
+            )
+            """
+        )
+        self.connection.commit()
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def sent(self, account, day):
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT sent FROM account_usage WHERE account = ? AND day = ?",
+                (account, day)).fetchone()
+            return (row[0] if row else 0) + self._pending.get((account, day), 0)
+
+    def add(self, account, day, count):
+        with self._lock:
+            self._pending[(account, day)] = (
+                self._pending.get((account, day), 0) + count)
+            if sum(self._pending.values()) >= self.batch_size:
+                self._flush()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            with self.connection:
+                self.connection.executemany(
+                    """
+                    INSERT INTO account_usage (account, day, sent)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (account, day) DO UPDATE SET
+                        sent = sent + excluded.sent
+                    """,
+                    [(account, day, sent)
+                     for (account, day), sent in self._pending.items()])
+            self._pending = {}
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class ShardedStats(TransportStats):
+    """
+    Stats of the sharded transport; the text form adds the messages
+    sent per account.
+    """
+
+    def __init__(self, accounts):
+        super().__init__()
+        self.accounts = accounts
+
+    def __str__(self):
+        shares = ", ".join(f"{account.name}: {account.transport.stats.sent}"
+                           for account in self.accounts)
+        return f"{super().__str__()} ({shares})"
+
+
+class ShardedTransport(MailTransport):
+    """
+    Sends each message through one of several accounts, chosen by a
+    ShardCoordinator.
+    """
+
+    name = "sharded"
+
+    def __init__(self, accounts, strategy=HASH, usage=None):
+        self.accounts = list(accounts)
+        super().__init__()
+        self.stats = ShardedStats(self.accounts)
+        self.coordinator = ShardCoordinator(self.accounts, strategy, usage)
+        self.usage = usage
+        # Outlook-Konten teilen sich den einen Outlook-Prozess und zählen
+        # zusammen wie ein Konto
+        outlook = [account for account in self.accounts
+                   if account.transport.name == "outlook"]
+        self.max_concurrency = sum(
+            account.transport.max_concurrency or 1
+            for account in self.accounts if account not in outlook
+        ) + (1 if outlook else 0)
+
+    @property
+    def attachments(self):
+        return self._attachments
+
+    @attachments.setter
+    def attachments(self, attachments):
+        self._attachments = attachments
+        for account in self.accounts:
+            account.transport.attachments = attachments
+
+    def send(self, to_email, subject, body):
+        self._record(self._route, to_email, 1,
+                     "send", to_email, subject, body)
+
+    def send_message(self, to_email, message):
+        self._record(self._route, to_email, 1,
+                     "send_message", to_email, message)
+
+    def send_bcc(self, recipients, subject, body):
+        return self._record(self._route, recipients[0], len(recipients),
+                            "send_bcc", recipients, subject, body)
+
+    def _route(self, key, count, method, *args):
+        tried = set()
+        while True:
+            account = self.coordinator.acquire(key, count, tried)
+            tried.add(account)
+            account.limiter.acquire()
+            try:
+                result = getattr(account.transport, method)(*args)
+            except Exception as error:
+                if self.coordinator.failed(account, error, count):
+                    # Konto kann gerade nicht senden: nächstes versuchen
+                    continue
+                raise
+            self.coordinator.succeeded(account, count)
+            return result
+
+    def close(self):
+        for account in self.accounts:
+            account.transport.close()
+        if self.usage is not None:
+            self.usage.close()
+
+
+def _account(entry):
+    kind = entry.get("transport", "smtp").lower()
+    if kind == "smtp":
+        password_env = entry.get("password_env")
+        pool = SmtpConnectionPool(
+            entry.get("host", "localhost"),
+            int(entry.get("port", 25)),
+            username=entry.get("user"),
+            password=os.environ.get(password_env) if password_env else None,
+            use_starttls=bool(entry.get("starttls", False)),
+            use_ssl=bool(entry.get("ssl", False)),
+            size=int(entry.get("pool_size", 4)),
+        )
+        transport = SmtpTransport(
+            entry.get("sender") or entry.get("user") or "noreply@localhost",
+            pool)
+    elif kind == "outlook":
+        transport = OutlookTransport(account=entry.get("account"))
+    else:
+        raise ValueError(f"Unknown transport: {kind}")
+    return Account(
+        entry.get("name") or entry.get("sender") or entry.get("account"),
+        transport,
+        rate=entry.get("rate"),
+        daily_quota=entry.get("daily_quota"),
+        weight=entry.get("weight"),
+    )
+
+
+def load_accounts(path):
+    """
+    Sharding strategy and Accounts from the JSON file at ``path``.
+    """
+    with open(path, encoding="utf-8") as file:
+        config = json.load(file)
+    accounts = [_account(entry) for entry in config["accounts"]]
+    names = [account.name for account in accounts]
+    if None in names or len(set(names)) != len(names):
+        raise ValueError(f"{path}: every account needs a unique name")
+    return config.get("strategy", HASH), accounts
+
+
+def create_sharded_transport(path):
+    """
+    ShardedTransport over the accounts in ``path``, with the daily usage
+    kept in ANTHRASEND_ACCOUNT_USAGE (default account_usage.sqlite).
+    """
+    strategy, accounts = load_accounts(path)
+    usage = AccountUsage(
+        os.environ.get("ANTHRASEND_ACCOUNT_USAGE", "account_usage.sqlite"))
+    return ShardedTransport(accounts, strategy, usage)
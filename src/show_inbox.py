@@ -1,5 +1,11 @@
 import win32com.client
 
+from bounce_classifier import AUTO_REPLY, NOT_BOUNCE, BounceClassifier
+from bounce_parser import DIAGNOSTIC_HEADINGS
+
+# Erkennt Rückläufer in DE/EN/FR/NL in einem Durchlauf
+classifier = BounceClassifier()
+
 # Outlook-Anwendung öffnen
 outlook = win32com.client.Dispatch("Outlook.Application").GetNamespace("MAPI")
 
@@ -9,17 +15,22 @@ inbox = outlook.GetDefaultFolder(6)  # 6 steht für den Posteingangsordner
 # Alle E-Mails im Posteingang auflisten
 messages = inbox.Items
 for message in messages:
-    if "Unzustellbar:" in message.Subject:
-        print(f"Rückläufer-Mail mit dem Betreff: {message.Subject}")
-        print(message.Body.encode('utf-8'))
-
-        body = message.Body
-        if "Diagnoseinformationen für Administratoren:" in body:
-            start_index = body.index(
-                "Diagnoseinformationen für Administratoren:")
+    if classifier.classify(message.Subject, "").kind in (NOT_BOUNCE, AUTO_REPLY):
+        continue
+
+    body = message.Body
+    result = classifier.classify(message.Subject, body)
+    print(f"Rückläufer-Mail mit dem Betreff: {message.Subject}")
+    print(f"Art: {result.kind}, Status: {result.status or '-'}")
+    print(body.encode('utf-8'))
+
+    for heading in DIAGNOSTIC_HEADINGS:
+        if heading in body:
+            start_index = body.index(heading)
             error_info = body[start_index:]
             print("Fehlerdiagnoseinformationen:")
             print(error_info)
+            break
 
 # Outlook-Anwendung beenden
 del outlook
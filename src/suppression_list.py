@@ -0,0 +1,275 @@
+"""
+Persistent suppression list of addresses that must not be mailed again.
+
+Addresses are stored with a reason (hard bounce, unsubscribed, invalid)
+in a SQLite table and loaded into memory once per run:
+
+    - up to ``bloom_threshold`` addresses as a plain set,
+    - above that as a Bloom filter (about 1.8 bytes per address at 0.1%
+      false positives); a positive answer is confirmed with a primary
+      key lookup, so no recipient is suppressed by mistake.
+
+Either way a lookup is O(1) per recipient. The list is checked before
+any mail content is rendered (see recipient_prep.drop_suppressed).
+Addresses are stored and looked up with recipient_prep.address_key, the
+key the recipient table is de-duplicated with; lists written with the
+older lower-casing are converted once when opened.
+
+Bulk import and export work on CSV files (address, reason, source):
+
+    python suppression_list.py import abmeldungen.csv --reason unsubscribed
+    python suppression_list.py export suppression.csv
+"""
+
+import argparse
+import csv
+import hashlib
+import math
+import os
+import sqlite3
+import time
+
+from bounce_classifier import HARD_BOUNCE
+from recipient_prep import address_key
+
+
+UNSUBSCRIBED = "unsubscribed"
+INVALID = "invalid"
+REASONS = (HARD_BOUNCE, UNSUBSCRIBED, INVALID)
+
+# Schema-Version (PRAGMA user_version): Adressen als address_key
+ADDRESS_KEY_VERSION = 1
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double Hashing: k Positionen aus einem 128-Bit-Digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+
+class SuppressionList:
+    def __init__(self, db_path, bloom_threshold=1_000_000, batch_size=10_000):
+        self.bloom_threshold = bloom_threshold
+        self.batch_size = batch_size
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS suppressions (
+                address TEXT PRIMARY KEY,
+                reason TEXT NOT NULL,
+                source TEXT,
+                added_at REAL NOT NULL
+            ) WITHOUT ROWID
+            """
+        )
+        self.connection.commit()
+        self._normalize_stored()
+        self._load()
+
+    def _normalize_stored(self):
+        """
+        Bring addresses stored by older versions (lower-cased, domain not
+        IDNA encoded) to address_key. Runs once per database.
+        """
+        version, = self.connection.execute("PRAGMA user_version").fetchone()
+        if version >= ADDRESS_KEY_VERSION:
+            return
+        rows = self.connection.execute(
+            "SELECT address, reason, source, added_at FROM suppressions "
+            "ORDER BY added_at").fetchall()
+        changed = [row for row in rows if address_key(row[0]) != row[0]]
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM suppressions WHERE address = ?",
+                [(address,) for address, _, _, _ in changed])
+            # Fällt eine Adresse mit einer vorhandenen zusammen, bleibt
+            # deren Grund
+            self.connection.executemany(
+                "INSERT INTO suppressions VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (address) DO NOTHING",
+                [(address_key(address), reason, source, added_at)
+                 for address, reason, source, added_at in changed])
+            self.connection.execute(
+                f"PRAGMA user_version = {ADDRESS_KEY_VERSION}")
+
+    def _load(self):
+        count, = self.connection.execute(
+            "SELECT COUNT(*) FROM suppressions").fetchone()
+        rows = self.connection.execute("SELECT address FROM suppressions")
+        if count > self.bloom_threshold:
+            # Reserve für Adressen, die während des Laufs dazukommen
+            self._bloom = BloomFilter(int(count * 1.2))
+            for address, in rows:
+                self._bloom.add(address)
+            self._addresses = None
+        else:
+            self._bloom = None
+            self._addresses = {address for address, in rows}
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, address):
+        address = address_key(address)
+        if self._addresses is not None:
+            return address in self._addresses
+        if address not in self._bloom:
+            return False
+        # Bloom-Filter kann irren: Treffer in der Datenbank bestätigen
+        return self.connection.execute(
+            "SELECT 1 FROM suppressions WHERE address = ?",
+            (address,)).fetchone() is not None
+
+    def add(self, address, reason, source=None):
+        return self.add_many([(address, reason, source)])
+
+    def add_many(self, rows):
+        """
+        Add ``(address, reason, source)`` rows in one transaction. Known
+        addresses keep their first reason. Returns the number of new
+        addresses.
+        """
+        now = time.time()
+        rows = [(address_key(address), reason, source, now)
+                for address, reason, source in rows]
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                "INSERT INTO suppressions VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (address) DO NOTHING", rows)
+            added = self.connection.total_changes - before
+        for address, _, _, _ in rows:
+            if self._addresses is not None:
+                self._addresses.add(address)
+            else:
+                self._bloom.add(address)
+        self._count += added
+        return added
+
+    def remove(self, address):
+        """
+        Remove an address, e.g. after a renewed opt-in.
+        """
+        address = address_key(address)
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM suppressions WHERE address = ?", (address,))
+        if self._addresses is not None:
+            self._addresses.discard(address)
+            self._count = len(self._addresses)
+        else:
+            # Aus einem Bloom-Filter kann nicht gelöscht werden
+            self._load()
+
+    def import_csv(self, path, reason=None, source=None):
+        """
+        Import a CSV file with the columns address[, reason[, source]]
+        in batches. ``reason`` and ``source`` fill in missing columns.
+        Returns the number of new addresses.
+        """
+        added = 0
+        source = source or os.path.basename(path)
+        with open(path, newline="", encoding="utf-8-sig") as file:
+            batch = []
+            for row in csv.reader(file):
+                if not row or "@" not in row[0]:
+                    # Leerzeilen und Kopfzeile
+                    continue
+                batch.append((
+                    row[0],
+                    row[1] if len(row) > 1 and row[1] else reason or INVALID,
+                    row[2] if len(row) > 2 and row[2] else source))
+                if len(batch) >= self.batch_size:
+                    added += self.add_many(batch)
+                    batch = []
+            if batch:
+                added += self.add_many(batch)
+        return added
+
+    def export_csv(self, path):
+        """
+        Write all entries as CSV (address, reason, source, added_at).
+        Returns the number of rows written.
+        """
+        rows = self.connection.execute(
+            "SELECT address, reason, source, added_at FROM suppressions "
+            "ORDER BY address")
+        with open(path, "w", newline="", encoding="utf-8") as file:
+            writer = csv.writer(file)
+            writer.writerow(["address", "reason", "source", "added_at"])
+            count = 0
+            while True:
+                batch = rows.fetchmany(self.batch_size)
+                if not batch:
+                    break
+                writer.writerows(batch)
+                count += len(batch)
+        return count
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def create_suppression_list():
+    """
+    Suppression list at ANTHRASEND_SUPPRESSION (default
+    'suppression.sqlite'), or None if the variable is set to an empty
+    string.
+    """
+    path = os.environ.get("ANTHRASEND_SUPPRESSION", "suppression.sqlite")
+    if not path:
+        return None
+    return SuppressionList(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--db", default=os.environ.get(
+        "ANTHRASEND_SUPPRESSION", "suppression.sqlite"))
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--reason", choices=REASONS)
+    import_parser.add_argument("--source")
+    export_parser = commands.add_parser("export")
+    export_parser.add_argument("path")
+    args = parser.parse_args(argv)
+
+    with SuppressionList(args.db) as suppression:
+        if args.command == "import":
+            added = suppression.import_csv(args.path, args.reason, args.source)
+            print(f"{added} Adressen neu gesperrt, {len(suppression)} gesamt.")
+        else:
+            count = suppression.export_csv(args.path)
+            print(f"{count} Adressen nach {args.path} exportiert.")
+
+
+if __name__ == "__main__":
+    main()
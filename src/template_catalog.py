@@ -0,0 +1,333 @@
+"""
+Precompiled subject/body templates for the AnthraSend campaigns.
+
+A catalog holds one subject and body template per language and variant
+(e.g. the French "Responsable de magasin" mail) plus the salutation
+table. Templates use ``string.Template`` syntax (``${anrede}``,
+``${vorname}``) and are compiled once into their literal segments and
+placeholder names. The salutation is bound once per (language, variant,
+salutation) and cached, so rendering a recipient only concatenates the
+literal segments with the first name.
+
+DEFAULT_CATALOG holds the texts sent by AnthraSend3.py and the spool,
+ANTHRASEND_CATALOG those of AnthraSend.py. Catalogs can be loaded from a JSON file with the same structure as
+DEFAULT_CATALOG. Compiled catalogs are cached by file path, size and
+modification time, so a file is parsed and compiled only once per
+process.
+"""
+
+import hashlib
+import json
+import os
+from string import Template
+
+
+PLANNED_CHANGE_DATE = "08.03.2024"
+CURRENT_URL = ">>> job.takko.com <<<"
+
+# Gemeinsamer Text, wird in DE und in der FR-Variante für Filialleiter
+# verwendet (entspricht dem bisherigen common_info)
+_COMMON_INFO = (
+    f"die für den {PLANNED_CHANGE_DATE} angesetzt war, vorerst aufgeschoben wird. Es wird keine Änderung geben, "
+    "bis weitere Informationen bereitgestellt werden.\n\n"
+    f"Bitte verwendet weiterhin die aktuelle URL {CURRENT_URL} für den Zugriff auf d.vinci."
+)
+
+DEFAULT_CATALOG = {
+    "default_salutation": "MX",
+    "salutations": {
+        "MR": {"DE": "Lieber", "EN": "Dear", "FR": "Cher", "NL": "Beste"},
+        "MS": {"DE": "Liebe", "EN": "Dear", "FR": "Chère", "NL": "Beste"},
+        "MX": {"DE": "Liebe(r)", "EN": "Dear", "FR": "Cher(e)", "NL": "Beste"},
+    },
+    "templates": {
+        "DE": {
+            "default": {
+                "subject": "Dringend: Aufschub der geplanten Änderung der URL für d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    f"ich möchte euch darüber informieren, dass {_COMMON_INFO} Ich entschuldige mich "
+                    "für die Unannehmlichkeiten und danke euch für euer Verständnis und eure Flexibilität.\n\n"
+                    "Für Rückfragen stehe ich euch gerne zur Verfügung.\n\n"
+                    "Mit freundlichen Grüßen,\nHendrik Siemens"
+                ),
+            },
+        },
+        "EN": {
+            "default": {
+                "subject": "Urgent: Postponement of the Planned URL Change for d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "I wish to inform you that the planned change of the URL from [job.takko.com] to [application.takko.com], which was "
+                    f"scheduled for {PLANNED_CHANGE_DATE}, has been postponed until further notice. "
+                    f"Please continue to use the current URL {CURRENT_URL} to access d.vinci. I apologize for any inconvenience and "
+                    "thank you for your understanding and flexibility.\n\n"
+                    "Should you have any questions, please do not hesitate to contact me.\n\n"
+                    "Kind regards,\nHendrik Siemens"
+                ),
+            },
+        },
+        "FR": {
+            "default": {
+                "subject": "Urgent: Report de la modification prévue de l'URL pour d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour "
+                    f"le {PLANNED_CHANGE_DATE}, est reportée jusqu'à nouvel ordre. "
+                    f"Veuillez donc continuer à utiliser l'URL actuelle {CURRENT_URL} pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
+                    "vous remercie de votre compréhension et de votre flexibilité.\n\n"
+                    "En cas de questions, n'hésitez pas à me contacter.\n\n"
+                    "Cordialement,\nHendrik Siemens"
+                ),
+            },
+            "store_manager": {
+                "subject": "Urgent: Report de la modification prévue de l'URL pour d.vinci",
+                "body": (
+                    "Bonjour à tous,\n\n"
+                    "Je tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], "
+                    f"prévue pour le {PLANNED_CHANGE_DATE}, est reportée jusqu'à nouvel ordre. {_COMMON_INFO} "
+                    "Je m'excuse pour les désagréments causés et vous remercie de votre compréhension et de votre flexibilité.\n\n"
+                    "En cas de questions, n'hésitez pas à me contacter.\n\n"
+                    "Cordialement,\nHendrik Siemens"
+                ),
+            },
+        },
+        "NL": {
+            "default": {
+                "subject": "Dringend: Uitstel van de geplande URL-wijziging voor d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "Ik wil jullie informeren dat de geplande wijziging van de URL van [job.takko.com] naar [application.takko.com], die gepland stond voor "
+                    f"{PLANNED_CHANGE_DATE}, voorlopig is uitgesteld. Er worden geen wijzigingen aangebracht tot nadere informatie beschikbaar is.\n\n"
+                    f"Gelieve de huidige URL {CURRENT_URL} te blijven gebruiken om toegang te krijgen tot d.vinci. Mijn excuses voor eventuele overlast en "
+                    "dank voor uw begrip en flexibilitet.\n\n"
+                    "Als u vragen heeft, neem dan gerust contact met mij op.\n\n"
+                    "Met vriendelijke groet,\nHendrik Siemens"
+                ),
+            },
+        },
+    },
+}
+
+# Texte von AnthraSend.py: gleiche Anreden, eigener Wortlaut
+ANTHRASEND_CATALOG = {
+    "default_salutation": DEFAULT_CATALOG["default_salutation"],
+    "salutations": DEFAULT_CATALOG["salutations"],
+    "templates": {
+        "DE": {
+            "default": {
+                "subject": "Dringend: Aufschub der geplanten Änderung der URL für d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "ich möchte euch darüber informieren, dass die geplante Änderung der URL von [job.takko.com] zu [application.takko.com], "
+                    f"{_COMMON_INFO} Ich entschuldige mich für die Unannehmlichkeiten und "
+                    "danke euch für euer Verständnis und eure Flexibilität.\n\n"
+                    "Für Rückfragen stehe ich euch gerne zur Verfügung.\n\n"
+                    "Mit freundlichen Grüßen,\nHendrik Siemens"
+                ),
+            },
+        },
+        "EN": {
+            "default": {
+                "subject": "Urgent: Postponement of the Planned URL Change for d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "I wish to inform you that the planned change of the URL from [job.takko.com] to [application.takko.com], which was "
+                    f"scheduled for {PLANNED_CHANGE_DATE}, has been postponed until further notice. There will be no changes made until more information is provided.\n\n"
+                    f"Please continue to use the current URL {CURRENT_URL} to access d.vinci. I apologize for any inconvenience and "
+                    "thank you for your understanding and flexibility.\n\n"
+                    "Should you have any questions, please do not hesitate to contact me.\n\n"
+                    "Kind regards,\nHendrik Siemens"
+                ),
+            },
+        },
+        "FR": {
+            variant: {
+                "subject": "Urgent : Report de la modification prévue de l'URL pour d.vinci",
+                "body": (
+                    f"{greeting},\n\n"
+                    f"{opening} tiens à vous informer que la modification prévue de l'URL de [job.takko.com] à [application.takko.com], prévue pour le {PLANNED_CHANGE_DATE}, "
+                    "est reportée jusqu'à nouvel ordre. Aucun changement ne sera effectué jusqu'à la communication de nouvelles informations.\n\n"
+                    f"Veuillez donc continuer à utiliser l'URL actuelle {CURRENT_URL} pour accéder à d.vinci. Je m'excuse pour les désagréments causés et "
+                    "vous remercie de votre compréhension et de votre flexibilité.\n\n"
+                    "En cas de questions, n'hésitez pas à me contacter.\n\n"
+                    "Cordialement,\nHendrik Siemens"
+                ),
+            }
+            for variant, greeting, opening in (
+                ("default", "${anrede} ${vorname}", "je"),
+                ("store_manager", "Bonjour à tous", "Je"))
+        },
+        "NL": {
+            "default": {
+                "subject": "Dringend: Uitstel van de geplande URL-wijziging voor d.vinci",
+                "body": (
+                    "${anrede} ${vorname},\n\n"
+                    "Ik wil jullie informeren dat de geplande wijziging van de URL van [job.takko.com] naar [application.takko.com], die gepland stond voor "
+                    f"{PLANNED_CHANGE_DATE}, voorlopig is uitgesteld. Er worden geen wijzigingen aangebracht tot nadere informatie beschikbaar is.\n\n"
+                    f"Gelieve de huidige URL {CURRENT_URL} te blijven gebruiken om toegang te krijgen tot d.vinci. Mijn excuses voor eventuele overlast en "
+                    "dank voor uw begrip en flexibilitet.\n\n"
+                    "Als u vragen heeft, neem dan gerust contact met mij op.\n\n"
+                    "Met vriendelijke groet,\nHendrik Siemens"
+                ),
+            },
+        },
+    },
+}
+
+# Vorname-Eintrag, an dem die FR-Filialleiter-Mail erkannt wird
+STORE_MANAGER_MARKER = "Responsable de magasin"
+
+
+def compile_template(source):
+    """
+    Split a ``string.Template`` source into its literal segments and
+    placeholder names: ``(literals, names)`` with
+    ``len(literals) == len(names) + 1``.
+    """
+    literals = []
+    names = []
+    current = []
+    position = 0
+    for match in Template.pattern.finditer(source):
+        current.append(source[position:match.start()])
+        if match.group("escaped") is not None:
+            current.append("$")
+        elif match.group("invalid") is not None:
+            raise ValueError(
+                f"Invalid placeholder in template at index {match.start()}")
+        else:
+            literals.append("".join(current))
+            names.append(match.group("named") or match.group("braced"))
+            current = []
+        position = match.end()
+    current.append(source[position:])
+    literals.append("".join(current))
+    return tuple(literals), tuple(names)
+
+
+def _render(compiled, fields):
+    literals, names = compiled
+    if not names:
+        return literals[0]
+    if len(names) == 1:
+        # Häufigster Fall (nur der Vorname): reine Verkettung
+        return literals[0] + format(fields[names[0]]) + literals[1]
+    parts = [literals[0]]
+    for name, literal in zip(names, literals[1:]):
+        parts.append(format(fields[name]))
+        parts.append(literal)
+    return "".join(parts)
+
+
+class CompiledTemplate:
+    """
+    A subject/body pair split into literal segments and placeholders.
+    """
+
+    __slots__ = ("subject_source", "body_source", "subject", "body")
+
+    def __init__(self, subject_source, body_source):
+        self.subject_source = subject_source
+        self.body_source = body_source
+        self.subject = compile_template(subject_source)
+        self.body = compile_template(body_source)
+
+    @property
+    def fields(self):
+        return set(self.subject[1]) | set(self.body[1])
+
+    def bind(self, **fields):
+        """
+        Return a new template with the given fields substituted and all
+        other placeholders kept.
+        """
+        # '$' in Werten maskieren, damit sie nicht als Platzhalter gelten
+        values = {key: format(value).replace("$", "$$")
+                  for key, value in fields.items()}
+        return CompiledTemplate(
+            Template(self.subject_source).safe_substitute(values),
+            Template(self.body_source).safe_substitute(values),
+        )
+
+    def render(self, fields):
+        return _render(self.subject, fields), _render(self.body, fields)
+
+
+class TemplateCatalog:
+    """
+    All templates and salutations of one campaign in compiled form.
+    """
+
+    _file_cache = {}
+
+    def __init__(self, data):
+        # Kennung des Inhalts, z.B. für das Versandjournal (send_journal.py)
+        self.fingerprint = hashlib.sha1(json.dumps(
+            data, sort_keys=True).encode("utf-8")).hexdigest()
+        self.salutations = data["salutations"]
+        self.default_salutation = data["default_salutation"]
+        self.templates = {
+            language: {
+                variant: CompiledTemplate(texts["subject"], texts["body"])
+                for variant, texts in variants.items()
+            }
+            for language, variants in data["templates"].items()
+        }
+        self._bound = {}
+
+    @classmethod
+    def default(cls):
+        return cls(DEFAULT_CATALOG)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a catalog from a JSON file. The compiled catalog is cached
+        until the file changes.
+        """
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        catalog = cls._file_cache.get(key)
+        if catalog is None:
+            with open(path, encoding="utf-8") as file:
+                catalog = cls(json.load(file))
+            cls._file_cache[key] = catalog
+        return catalog
+
+    @property
+    def languages(self):
+        return tuple(self.templates)
+
+    @staticmethod
+    def variant_for(language, vorname):
+        if (language == "FR" and isinstance(vorname, str)
+                and STORE_MANAGER_MARKER in vorname):
+            return "store_manager"
+        return "default"
+
+    def salutation_text(self, language, salutation):
+        texts = self.salutations.get(
+            salutation, self.salutations[self.default_salutation])
+        return texts[language]
+
+    def bound(self, language, variant, salutation):
+        """
+        Template for one (language, variant, salutation) group with the
+        salutation text already substituted.
+        """
+        key = (language, variant, salutation)
+        template = self._bound.get(key)
+        if template is None:
+            if language not in self.templates:
+                raise ValueError("Unsupported language")
+            template = self.templates[language][variant].bind(
+                anrede=self.salutation_text(language, salutation))
+            self._bound[key] = template
+        return template
+
+    def render(self, language, salutation, vorname):
+        variant = self.variant_for(language, vorname)
+        template = self.bound(language, variant, salutation)
+        return template.render({"vorname": vorname})